@@ -13,11 +13,16 @@ up their account to start sending SMS messages. This is especially suitable for
         'sms_twilio'
     ],
     'external_dependencies': {
-        'python': ['requests','africastalking'],
+        'python': ['requests', 'phonenumbers'],
     },
     'data': [
+        'data/ir_cron_data.xml',
         'views/res_config_settings_views.xml',
         'views/sms_sms_views.xml',
+        'views/sms_africastalking_cost_rollup_views.xml',
+        'views/sms_africastalking_inbound_views.xml',
+        'views/sms_africastalking_route_views.xml',
+        'views/sms_composer_views.xml',
         'wizard/sms_africastalking_account_manage_views.xml',
         'security/ir.model.access.csv'
     ],
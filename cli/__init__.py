@@ -0,0 +1 @@
+from . import sms_at_dispatch
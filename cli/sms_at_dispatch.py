@@ -0,0 +1,50 @@
+import argparse
+import asyncio
+import signal
+
+from odoo.cli.command import Command
+from odoo.tools import config
+
+from ..tools.sms_at_dispatcher import SmsAtDispatcher
+
+
+class SmsAtDispatch(Command):
+    """ Send the outgoing Africastalking SMS queue from a standalone dispatcher """
+    name = 'sms_at_dispatch'
+
+    def run(self, cmdargs):
+        parser = argparse.ArgumentParser(
+            prog=f'{self.prog} {self.name}',
+            description=self.__doc__.strip(),
+            epilog="Other arguments (e.g. -c, -d, --log-level) are the Odoo server options.",
+        )
+        parser.add_argument('--max-in-flight', type=int, default=1000, help="Maximum number of concurrent HTTP requests")
+        parser.add_argument('--claim-size', type=int, default=500, help="Number of sms claimed from the queue at once")
+        parser.add_argument('--commit-size', type=int, default=200, help="Number of request results applied per transaction")
+        parser.add_argument('--commit-interval', type=float, default=1.0, help="Maximum delay (seconds) before applying results")
+        parser.add_argument('--poll-interval', type=float, default=2.0, help="Delay (seconds) between polls of an empty queue")
+        parser.add_argument('--lease-timeout', type=int, default=600, help="Delay (seconds) after which a claimed sms is released")
+        args, odoo_args = parser.parse_known_args(cmdargs)
+        config.parse_config(odoo_args)
+        dbnames = config['db_name']
+        dbname = dbnames[0] if isinstance(dbnames, list) else dbnames
+        if not dbname:
+            parser.error("a database is required (-d)")
+
+        dispatcher = SmsAtDispatcher(
+            dbname,
+            max_in_flight=args.max_in_flight,
+            claim_size=args.claim_size,
+            commit_size=args.commit_size,
+            commit_interval=args.commit_interval,
+            poll_interval=args.poll_interval,
+            lease_timeout=args.lease_timeout,
+        )
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, dispatcher.stop)
+            await dispatcher.run()
+
+        asyncio.run(main())
@@ -1,29 +1,16 @@
 import hmac
 import logging
 import re
+import time
+from contextlib import contextmanager
 
-from odoo.addons.sms_twilio.tools.sms_twilio import generate_twilio_sms_callback_signature
 from odoo.http import Controller, request, route
+from odoo.tools import str2bool
 
+from ..tools.sms_africastalking import AT_TO_SMS_STATE, TWILIO_TO_SMS_STATE, generate_at_sms_callback_signature
+from ..tools.sms_at_metrics import get_metrics
+from ..tools.sms_at_tracing import start_trace
 
-TWILIO_TO_SMS_STATE_ERRORS = {
-    'failed': 'error',
-    'undelivered': 'error',
-}
-
-TWILIO_TO_SMS_STATE = {
-    # https://www.twilio.com/docs/messaging/api/message-resource#message-status-values
-    'queued': 'outgoing',
-    'sending': 'process',
-    'sent': 'pending',
-    'delivered': 'sent',
-    'receiving': 'process',
-    'received': 'pending',
-    'accepted': 'outgoing',
-    'scheduled': 'outgoing',
-    'canceled': 'canceled',
-    **TWILIO_TO_SMS_STATE_ERRORS,
-}
 
 _logger = logging.getLogger(__name__)
 
@@ -32,6 +19,10 @@ class SmsTwilioController(Controller):
 
     @route('/sms_africastalking/status/<string:uuid>', type='http', auth='public', methods=['POST'], csrf=False)
     def update_sms_status(self, uuid, SmsStatus=None, ErrorCode=None, ErrorMessage=None, **kwargs):
+        with self._at_callback_metrics('status'):
+            return self._update_sms_status(uuid, SmsStatus, ErrorCode, ErrorMessage)
+
+    def _update_sms_status(self, uuid, SmsStatus, ErrorCode, ErrorMessage):
         # Verify Odoo Sms Uuid Validity
         if not re.match(r'^[0-9a-f]{32}$', uuid):
             _logger.warning("Twilio SMS: update_sms_status received a non-valid uuid='%s'", uuid)
@@ -42,33 +33,160 @@ class SmsTwilioController(Controller):
             _logger.warning("Twilio SMS: update_sms_status received unknown twilio_status='%s'", SmsStatus)
             raise request.not_found()
 
+        # Resolve tracker, sms and company at once
+        target = request.env['sms.tracker'].sudo()._at_get_callback_target(sms_uuid=uuid)
+        if not target:
+            _logger.warning("Twilio SMS: update_sms_status could not find a matching SMS tracker for sms_uuid=%s", uuid)
+            raise request.not_found()
+
         # Verify Twilio Signature
-        if not self._validate_twilio_signature(request, uuid):
+        if not self._validate_africastalking_signature(request, uuid, target['company_id']):
             _logger.warning("Twilio SMS: update_sms_status could not validate Twilio signature with uuid='%s'", uuid)
             raise request.not_found()
 
-        # Update the tracker with the state
-        sms_tracker_sudo = request.env['sms.tracker'].sudo().search([('sms_uuid', '=', uuid)])
-        if not sms_tracker_sudo:
-            _logger.warning("Twilio SMS: update_sms_status could not find a matching SMS tracker for sms_uuid=%s", uuid)
-            return
+        # Buffered mode: store the report, it will be applied in batch by the drain cron
+        if self._is_buffered_mode():
+            request.env['sms.africastalking.report'].sudo().create({
+                'sms_uuid': uuid,
+                'sms_status': SmsStatus,
+                'error_code': ErrorCode,
+                'error_message': ErrorMessage,
+            })
+            return "OK"
 
-        if SmsStatus in TWILIO_TO_SMS_STATE_ERRORS:
-            sms_tracker_sudo._action_update_from_twilio_error(SmsStatus, ErrorCode, ErrorMessage)
-        else:
-            sms_tracker_sudo._action_update_from_sms_state(TWILIO_TO_SMS_STATE[SmsStatus])
+        # Update the tracker with the state
+        request.env['sms.tracker'].sudo().browse(target['tracker_id'])._action_update_from_at_status(SmsStatus, ErrorCode, ErrorMessage)
 
         # Mark Sms as to be deleted
-        request.env['sms.sms'].sudo().search([('uuid', '=', uuid), ('to_delete', '=', False)]).to_delete = True
+        if target['sms_id'] and not target['to_delete']:
+            request.env['sms.sms'].sudo().browse(target['sms_id']).to_delete = True
 
         return "OK"
 
-    def _validate_africastalking_signature(self, request, uuid):
-        company_sudo = request.env['sms.sms'].sudo().search([('uuid', '=', uuid)])._get_sms_company().sudo()
-        computed_signature = generate_twilio_sms_callback_signature(
+    @route('/sms_africastalking/report', type='http', auth='public', methods=['POST'], csrf=False)
+    def update_sms_report(self, token=None, **post):
+        """ Africastalking delivery reports, as configured in the Africastalking dashboard.
+        They are identified by the messageId returned at sending (``sms_at_sid`` on the tracker).
+        The callback url must carry the ``sms_africastalking.report.token`` system parameter
+        as ``token`` query parameter. """
+        with self._at_callback_metrics('report'):
+            return self._update_sms_report(token, post)
+
+    def _update_sms_report(self, token, post):
+        if not self._at_check_callback_token(token, 'sms_africastalking.report.token'):
+            _logger.warning("Africastalking SMS: update_sms_report received an invalid token")
+            raise request.not_found()
+
+        sms_at_sid = post.get('id')
+        at_status = post.get('status')
+        if not sms_at_sid or at_status not in AT_TO_SMS_STATE:
+            _logger.warning("Africastalking SMS: update_sms_report received an invalid report id='%s' status='%s'", sms_at_sid, at_status)
+            raise request.not_found()
+
+        # Reports are not signed: only accept those of a known messageId as well
+        target = request.env['sms.tracker'].sudo()._at_get_callback_target(sms_at_sid=sms_at_sid)
+        if not target:
+            _logger.warning("Africastalking SMS: update_sms_report could not find a matching SMS tracker for id=%s", sms_at_sid)
+            raise request.not_found()
+
+        if self._is_buffered_mode():
+            request.env['sms.africastalking.report'].sudo().create({
+                'sms_uuid': target['sms_uuid'],
+                'sms_at_sid': sms_at_sid,
+                'sms_status': at_status,
+                'error_code': post.get('failureReason'),
+            })
+            return "OK"
+
+        request.env['sms.tracker'].sudo().browse(target['tracker_id'])._action_update_from_at_report(at_status, post.get('failureReason'))
+        if target['sms_id'] and not target['to_delete']:
+            request.env['sms.sms'].sudo().browse(target['sms_id']).to_delete = True
+
+        return "OK"
+
+    @route('/sms_africastalking/inbound', type='http', auth='public', methods=['POST'], csrf=False)
+    def receive_inbound_sms(self, token=None, **post):
+        """ Incoming sms of the Africastalking shortcodes, as configured in the Africastalking dashboard.
+        The callback url must carry the ``sms_africastalking.inbound.token`` system parameter as
+        ``token`` query parameter: inbound sms may blacklist their sender (opt-outs). """
+        with self._at_callback_metrics('inbound'):
+            return self._receive_inbound_sms(token, post)
+
+    def _receive_inbound_sms(self, token, post):
+        if not self._at_check_callback_token(token, 'sms_africastalking.inbound.token'):
+            _logger.warning("Africastalking SMS: receive_inbound_sms received an invalid token")
+            raise request.not_found()
+
+        sms_at_id, from_number, to_number = post.get('id'), post.get('from'), post.get('to')
+        if not sms_at_id or not from_number or not to_number:
+            _logger.warning("Africastalking SMS: receive_inbound_sms received an invalid message id='%s'", sms_at_id)
+            raise request.not_found()
+
+        # Only accept the sms sent to one of our shortcodes
+        company_id = request.env['res.company']._get_sms_at_company_by_shortcode(to_number)
+        if not company_id:
+            _logger.warning("Africastalking SMS: receive_inbound_sms received a message for unknown shortcode '%s'", to_number)
+            raise request.not_found()
+
+        # Only stored here, partners and opt-outs are processed in batch by the inbound cron
+        request.env['sms.africastalking.inbound'].sudo()._insert_inbound({
+            'sms_at_id': sms_at_id,
+            'company_id': company_id,
+            'from_number': from_number,
+            'to_number': to_number,
+            'body': post.get('text'),
+            'link_id': post.get('linkId'),
+            'network_code': post.get('networkCode'),
+        })
+        return "OK"
+
+    @route('/sms_africastalking/metrics', type='http', auth='public', methods=['GET'], csrf=False)
+    def sms_metrics(self, **kwargs):
+        """ Metrics of the send and callback paths in the Prometheus text format, protected by
+        the ``sms_africastalking.metrics.token`` system parameter (sent as a Bearer token). """
+        token = request.env['ir.config_parameter'].sudo().get_param('sms_africastalking.metrics.token')
+        authorization = request.httprequest.headers.get('Authorization', '')
+        if not token or not hmac.compare_digest(authorization.removeprefix('Bearer '), token):
+            raise request.not_found()
+        gauges = []
+        for lane, (depth, oldest_age) in request.env['sms.sms'].sudo()._at_get_lane_stats().items():
+            gauges += [('sms_at_queue_depth', {'lane': lane}, depth), ('sms_at_queue_oldest_seconds', {'lane': lane}, oldest_age)]
+        return request.make_response(
+            get_metrics(request.env.cr.dbname).render(gauges),
+            headers=[('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')],
+        )
+
+    @contextmanager
+    def _at_callback_metrics(self, kind):
+        metrics = get_metrics(request.env.cr.dbname)
+        mode = 'buffered' if self._is_buffered_mode() else 'direct'
+        metrics.inc('sms_at_callbacks_total', {'kind': kind, 'mode': mode})
+        start = time.monotonic()
+        try:
+            with start_trace(request.env, f'sms_at.callback.{kind}', mode=mode):
+                yield
+        finally:
+            metrics.observe('sms_at_callback_duration_seconds', time.monotonic() - start, {'kind': kind, 'mode': mode})
+
+    def _at_check_callback_token(self, token, param_name):
+        """ Africastalking callbacks are not signed: they must carry the secret of the
+        ``param_name`` system parameter, and are refused while it is not set. """
+        expected_token = request.env['ir.config_parameter'].sudo().get_param(param_name)
+        return bool(expected_token) and hmac.compare_digest(token or '', expected_token)
+
+    def _is_buffered_mode(self):
+        return str2bool(request.env['ir.config_parameter'].sudo().get_param('sms_africastalking.status.buffered', False))
+
+    def _validate_africastalking_signature(self, request, uuid, company_id=None):
+        company_sudo = request.env['res.company'].sudo().browse(company_id) if company_id else request.env.company.sudo()
+        signing_key = request.env['res.company']._get_sms_at_signing_key(company_sudo.id)
+        if not signing_key:
+            return False
+        computed_signature = generate_at_sms_callback_signature(
             company_sudo,
             uuid,
-            request.httprequest.form.to_dict()
+            request.httprequest.form.to_dict(),
+            signing_key=signing_key,
         )
         x_twilio_signature = request.httprequest.headers.get('X-AT-Signature', '')
         return hmac.compare_digest(computed_signature, x_twilio_signature)
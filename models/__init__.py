@@ -1,6 +1,13 @@
 from . import mail_notification
 from . import res_company
 from . import res_config_settings
+from . import sms_africastalking_cost_rollup
+from . import sms_africastalking_inbound
+from . import sms_africastalking_journal
+from . import sms_africastalking_route
+from . import sms_africastalking_stream
+from . import sms_africastalking_tracker_archive
+from . import sms_africastalking_report
 from . import sms_composer
 from . import sms_sms
 from . import sms_tracker
@@ -10,6 +10,7 @@ class MailNotification(models.Model):
             ('at_callback', 'Incorrect callback URL'),
             ('at_from_missing', 'Missing From Number'),
             ('at_from_to', 'From / To identic'),
+            ('at_duplicate', 'Duplicate Suppressed'),
         ],
     )
 
@@ -30,6 +31,7 @@ class MailNotification(models.Model):
         updated_stable = {
             'at_authentication', 'at_callback',
             'at_from_missing', 'at_from_to',
+            'at_duplicate',
         }
         need_update = updated_stable - set(dict(self._fields['failure_type'].selection))
         if need_update:
@@ -1,9 +1,11 @@
 import re
 
-from odoo import fields, models, _
+from odoo import api, fields, models, tools, _
 from odoo.exceptions import UserError
 
 from ..tools.sms_api import SmsApiAfricastalking
+from ..tools.sms_at_client import client_registry
+from ..tools.sms_at_routing import PrefixTrie
 
 
 class ResCompany(models.Model):
@@ -17,6 +19,55 @@ class ResCompany(models.Model):
     sms_at_username = fields.Char("Africastalking Username", groups='base.group_system')
     sms_at_shortcode = fields.Char("Africastalking Shortcode", groups='base.group_system')
     sms_at_api_key = fields.Char("Africastalking API Key", groups='base.group_system')
+    sms_at_enqueue = fields.Boolean(
+        "Africastalking Enqueue Mode", groups='base.group_system',
+        help="Send all the SMS in enqueue mode: Africastalking acknowledges them right away and sends them "
+             "later, they are pending until their delivery report. Without it, only the batches above the "
+             "sms_africastalking.enqueue.threshold system parameter are enqueued.")
+
+    def write(self, vals):
+        if {'sms_at_username', 'sms_at_api_key'} & set(vals):
+            # close pooled connections of the previous credentials
+            for company in self.sudo():
+                if company.sms_at_username:
+                    client_registry.invalidate(company.sms_at_username, company.sms_at_api_key)
+        res = super().write(vals)
+        if {'sms_at_api_key', 'sms_at_shortcode', 'sms_provider'} & set(vals):
+            self.env.registry.clear_cache()  # _get_sms_at_signing_key, _get_sms_at_company_by_shortcode
+        return res
+
+    @api.model
+    @tools.ormcache('company_id')
+    def _get_sms_at_signing_key(self, company_id):
+        """ Key material used to sign/verify the status callbacks of a company """
+        api_key = self.sudo().browse(company_id).sms_at_api_key
+        return api_key.encode() if api_key else None
+
+    @api.model
+    @tools.ormcache('shortcode')
+    def _get_sms_at_company_by_shortcode(self, shortcode):
+        """ Id of the (first) Africastalking company receiving the sms of a shortcode, None if unknown """
+        if not shortcode:
+            return None
+        company = self.sudo().search([('sms_provider', '=', 'africastalking'), ('sms_at_shortcode', '=', shortcode)], limit=1)
+        return company.id or None
+
+    @api.model
+    @tools.ormcache('company_id')
+    def _get_sms_at_routing(self, company_id):
+        """ Routes of a company compiled for the send path
+
+        :return: a tuple (PrefixTrie of prefix -> sender, dict {sender: rate limit},
+            frozenset of the routes to compare the routing of companies)
+        """
+        routes = self.env['sms.africastalking.route'].sudo().search_fetch(
+            [('company_id', '=', company_id)], ['prefix', 'sender', 'rate_limit'],
+        )
+        return (
+            PrefixTrie((route.prefix, route.sender) for route in routes),
+            {route.sender: route.rate_limit for route in routes if route.rate_limit},
+            frozenset((route.prefix, route.sender, route.rate_limit) for route in routes),
+        )
 
     def _get_sms_api_class(self):
         self.ensure_one()
@@ -24,6 +75,24 @@ class ResCompany(models.Model):
             return SmsApiAfricastalking
         return super()._get_sms_api_class()
 
+    def _get_sms_at_account(self):
+        """ Key of the Africastalking account (and sender) used by the company """
+        self.ensure_one()
+        company_sudo = self.sudo()
+        return company_sudo.sms_at_username, company_sudo.sms_at_shortcode
+
+    def _get_sms_at_send_key(self):
+        """ Key of the companies whose sms can be sent by a same API object: same account,
+        and same number normalization, enqueue mode and routes """
+        self.ensure_one()
+        company_sudo = self.sudo()
+        return (
+            *company_sudo._get_sms_at_account(),
+            company_sudo.country_id.code or '',
+            company_sudo.sms_at_enqueue,
+            self._get_sms_at_routing(self.id)[2],
+        )
+
     def _assert_at_username(self):
         self.ensure_one()
         account_sid = self.sms_at_username
@@ -0,0 +1,47 @@
+from odoo import api, fields, models
+from odoo.tools import SQL
+
+
+class SmsAfricastalkingCostRollup(models.Model):
+    """ Daily cost and volume of the Africastalking SMS, maintained incrementally
+    at each send batch so that spend reports never scan the trackers. """
+    _name = 'sms.africastalking.cost.rollup'
+    _description = 'Africastalking SMS Cost Rollup'
+    _order = 'date desc, company_id, shortcode, country_prefix'
+    _log_access = False
+
+    date = fields.Date('Date', required=True, readonly=True)
+    company_id = fields.Many2one('res.company', 'Company', required=True, readonly=True, ondelete='cascade')
+    shortcode = fields.Char('Sender', required=True, readonly=True, default='')
+    country_prefix = fields.Char('Country Prefix', required=True, readonly=True, default='')
+    currency = fields.Char('Currency', required=True, readonly=True, default='')
+    sms_count = fields.Integer('SMS Count', readonly=True, aggregator='sum')
+    segment_count = fields.Integer('Segments', readonly=True, aggregator='sum', help="Billed SMS parts of the long messages")
+    cost = fields.Float('Cost', readonly=True, aggregator='sum')
+
+    _rollup_key_uniq = models.UniqueIndex('(date, company_id, shortcode, country_prefix, currency)')
+
+    @api.model
+    def _add_to_rollups(self, date, rollups):
+        """ Increment the rollups of ``date`` in a single upsert.
+
+        :param rollups: dict {(company id, shortcode, country prefix, currency): [sms count, cost, segment count]}
+        """
+        if not rollups:
+            return
+        self.flush_model()
+        self.env.cr.execute(SQL(
+            """
+            INSERT INTO sms_africastalking_cost_rollup AS rollup (date, company_id, shortcode, country_prefix, currency, sms_count, cost, segment_count)
+                 VALUES %s
+            ON CONFLICT (date, company_id, shortcode, country_prefix, currency)
+              DO UPDATE SET sms_count = rollup.sms_count + EXCLUDED.sms_count,
+                            cost = rollup.cost + EXCLUDED.cost,
+                            segment_count = COALESCE(rollup.segment_count, 0) + EXCLUDED.segment_count
+            """,
+            SQL(', ').join(
+                SQL('(%s, %s, %s, %s, %s, %s, %s, %s)', date, company_id, shortcode, country_prefix, currency, sms_count, cost, segment_count)
+                for (company_id, shortcode, country_prefix, currency), (sms_count, cost, segment_count) in rollups.items()
+            ),
+        ))
+        self.invalidate_model(['sms_count', 'cost', 'segment_count'])
@@ -0,0 +1,107 @@
+import logging
+import threading
+from collections import defaultdict
+
+from odoo import _, api, fields, models
+from odoo.tools import SQL
+
+from ..tools.sms_africastalking import normalize_e164
+from ..tools.sms_at_inbound import AT_OPT_OUT_KEYWORDS, is_opt_out, parse_opt_out_keywords, partner_phone_cache
+
+_logger = logging.getLogger(__name__)
+
+
+class SmsAfricastalkingInbound(models.Model):
+    """ Inbound sms received on the Africastalking shortcodes. The inbound
+    controller only inserts a row (retried deliveries of a same Africastalking
+    id are ignored), the processing cron resolves the partners and applies the
+    opt-outs in batch. """
+    _name = 'sms.africastalking.inbound'
+    _description = 'Africastalking Inbound SMS'
+    _order = 'id desc'
+    _log_access = False
+
+    sms_at_id = fields.Char('Africastalking ID', required=True, readonly=True)
+    company_id = fields.Many2one('res.company', 'Company', readonly=True, ondelete='cascade')
+    from_number = fields.Char('From', required=True, readonly=True)
+    to_number = fields.Char('To', readonly=True)
+    body = fields.Text('Message', readonly=True)
+    link_id = fields.Char('Link ID', readonly=True, help="Id to reply to the message (premium shortcodes)")
+    network_code = fields.Char('Network Code', readonly=True)
+    received_at = fields.Datetime('Received On', required=True, readonly=True, default=fields.Datetime.now)
+    partner_id = fields.Many2one('res.partner', 'Partner', readonly=True, index='btree_not_null', ondelete='set null')
+    is_opt_out = fields.Boolean('Opt-out', readonly=True)
+    state = fields.Selection([('new', 'New'), ('processed', 'Processed')], 'Status', required=True, readonly=True, default='new')
+
+    _sms_at_id_uniq = models.UniqueIndex('(sms_at_id)')
+    _state_new_idx = models.Index('(id) WHERE state = \'new\'')
+
+    @api.model
+    def _insert_inbound(self, values):
+        """ Insert a received sms without the ORM, ignoring the already received ones.
+
+        :return: whether the sms was inserted (False for a retried delivery)
+        """
+        self.env.cr.execute(SQL(
+            """
+            INSERT INTO sms_africastalking_inbound (sms_at_id, company_id, from_number, to_number, body, link_id, network_code, received_at, state)
+                 VALUES (%s, %s, %s, %s, %s, %s, %s, NOW() AT TIME ZONE 'UTC', 'new')
+            ON CONFLICT (sms_at_id) DO NOTHING
+            """,
+            values['sms_at_id'], values.get('company_id'), values['from_number'], values.get('to_number'),
+            values.get('body'), values.get('link_id'), values.get('network_code'),
+        ))
+        return bool(self.env.cr.rowcount)
+
+    @api.model
+    def _cron_process_inbound(self):
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        batch_size = int(self.env['ir.config_parameter'].sudo().get_param('sms_africastalking.inbound.batch.size', 5000))
+        while inbounds := self.search([('state', '=', 'new')], order='id', limit=batch_size):
+            inbounds._process_inbound()
+            if auto_commit:
+                self.env.cr.commit()
+            if len(inbounds) < batch_size:
+                break
+
+    def _process_inbound(self):
+        """ Normalize the senders, link them to their partner and blacklist the senders
+        of an opt-out keyword, with a constant number of queries per batch. """
+        ICP = self.env['ir.config_parameter'].sudo()
+        keywords = parse_opt_out_keywords(ICP.get_param('sms_africastalking.inbound.opt_out_keywords', AT_OPT_OUT_KEYWORDS))
+
+        number_by_inbound = {}
+        for inbound in self:
+            region = inbound.company_id.country_id.code or None
+            number_by_inbound[inbound] = normalize_e164(inbound.from_number, region) or inbound.from_number
+        partner_id_by_number = self._at_get_partner_id_by_number(set(number_by_inbound.values()))
+
+        inbound_ids_by_values = defaultdict(list)
+        opt_out_numbers = set()
+        for inbound, number in number_by_inbound.items():
+            opt_out = is_opt_out(inbound.body, keywords)
+            if opt_out:
+                opt_out_numbers.add(number)
+            inbound_ids_by_values[partner_id_by_number.get(number) or False, opt_out].append(inbound.id)
+        for (partner_id, opt_out), inbound_ids in inbound_ids_by_values.items():
+            self.browse(inbound_ids).write({'partner_id': partner_id, 'is_opt_out': opt_out, 'state': 'processed'})
+
+        if opt_out_numbers:
+            self.env['phone.blacklist'].sudo()._add(list(opt_out_numbers), message=_("Opt-out by SMS reply"))
+            _logger.info("Africastalking SMS: %s numbers blacklisted from inbound opt-outs", len(opt_out_numbers))
+
+    @api.model
+    def _at_get_partner_id_by_number(self, numbers):
+        """ Partner of each E.164 number, through the process-level cache and one search for the missing ones """
+        ttl = int(self.env['ir.config_parameter'].sudo().get_param('sms_africastalking.inbound.partner_cache.ttl', 300))
+        dbname = self.env.cr.dbname
+        partner_id_by_number, missing_numbers = partner_phone_cache.get_many(dbname, numbers, ttl)
+        if missing_numbers:
+            found = dict.fromkeys(missing_numbers, False)
+            for partner in self.env['res.partner'].sudo().search_fetch(
+                [('phone_sanitized', 'in', missing_numbers)], ['phone_sanitized'], order='id',
+            ):
+                found[partner.phone_sanitized] = found[partner.phone_sanitized] or partner.id
+            partner_phone_cache.set_many(dbname, found)
+            partner_id_by_number.update(found)
+        return partner_id_by_number
@@ -0,0 +1,71 @@
+from odoo import api, fields, models
+from odoo.tools import SQL
+
+
+class SmsAfricastalkingJournal(models.Model):
+    """ Sms accepted by Africastalking, written in its own transaction right after
+    each send request. If the sending transaction is rolled back (time limit,
+    crash) after Africastalking accepted some sms, the next run takes their
+    result from the journal instead of sending them again. """
+    _name = 'sms.africastalking.journal'
+    _description = 'Africastalking SMS Send Journal'
+    _order = 'id'
+    _log_access = False
+
+    sms_uuid = fields.Char('SMS UUID', required=True, readonly=True)
+    sms_at_sid = fields.Char('Africastalking SMS SID', readonly=True)
+    sender = fields.Char('Sender', readonly=True)
+    state = fields.Char('Result State', required=True, readonly=True)
+    cost = fields.Float('Cost', readonly=True)
+    currency_code = fields.Char('Currency', readonly=True)
+    accepted_at = fields.Datetime('Accepted On', required=True, readonly=True)
+
+    _sms_uuid_uniq = models.UniqueIndex('(sms_uuid)')
+
+    @api.model
+    def _add_to_journal(self, results):
+        """ Journal the accepted results of a send request (see ``SmsApiAfricastalking._send_sms_batch``) """
+        if not results:
+            return
+        self.env.cr.execute(SQL(
+            """
+            INSERT INTO sms_africastalking_journal (sms_uuid, sms_at_sid, sender, state, cost, currency_code, accepted_at)
+                 VALUES %s
+            ON CONFLICT (sms_uuid) DO NOTHING
+            """,
+            SQL(', ').join(
+                SQL("(%s, %s, %s, %s, %s::float8, %s, NOW() AT TIME ZONE 'UTC')",
+                    result['uuid'], result.get('sms_at_sid'), result.get('sender'), result['state'], result.get('cost'), result.get('currency_code'))
+                for result in results
+            ),
+        ))
+
+    @api.model
+    def _get_journaled_results(self, uuids):
+        """ Results of the already accepted sms among ``uuids``
+
+        :return: a dict {uuid: result}
+        """
+        if not uuids:
+            return {}
+        self.env.cr.execute(SQL(
+            """
+            SELECT sms_uuid, sms_at_sid, sender, state, cost, currency_code
+              FROM sms_africastalking_journal
+             WHERE sms_uuid = ANY(%s)
+            """,
+            list(uuids),
+        ))
+        return {
+            uuid: {
+                'uuid': uuid,
+                'state': state,
+                'failure_type': False,
+                'failure_reason': False,
+                'sms_at_sid': sms_at_sid,
+                'sender': sender,
+                'cost': cost,
+                'currency_code': currency_code,
+            }
+            for uuid, sms_at_sid, sender, state, cost, currency_code in self.env.cr.fetchall()
+        }
@@ -0,0 +1,63 @@
+import logging
+import threading
+from collections import defaultdict
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+
+class SmsAfricastalkingReport(models.Model):
+    """ Staging table of delivery reports received in buffered mode
+    (``sms_africastalking.status.buffered``). The status controller only
+    inserts a row, the drain cron applies them to the trackers in batch. """
+    _name = 'sms.africastalking.report'
+    _description = 'Africastalking SMS Delivery Report'
+    _order = 'id'
+    _log_access = False
+
+    sms_uuid = fields.Char('SMS UUID', required=True)
+    sms_at_sid = fields.Char('Africastalking SMS SID', help="Set for Africastalking native reports, keyed by messageId")
+    sms_status = fields.Char('Status', required=True)
+    error_code = fields.Char('Error Code')
+    error_message = fields.Char('Error Message')
+
+    @api.model
+    def _cron_apply_reports(self):
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        batch_size = int(self.env['ir.config_parameter'].sudo().get_param('sms_africastalking.status.drain.batch.size', 5000))
+        while reports := self.search([], limit=batch_size):
+            reports._apply_reports()
+            if auto_commit:
+                self.env.cr.commit()
+            if len(reports) < batch_size:
+                break
+
+    def _apply_reports(self):
+        """ Apply the reports to their trackers with one update per distinct status,
+        mark their sms as to delete and remove the reports. Only the latest report
+        received for a given sms is taken into account. """
+        latest_report_by_uuid = {report.sms_uuid: report for report in self.sorted('id')}
+        trackers_by_uuid = self.env['sms.tracker'].sudo().search([
+            ('sms_uuid', 'in', list(latest_report_by_uuid)),
+        ]).grouped('sms_uuid')
+
+        tracker_ids_by_status = defaultdict(list)
+        for uuid, report in latest_report_by_uuid.items():
+            if tracker := trackers_by_uuid.get(uuid):
+                tracker_ids_by_status[bool(report.sms_at_sid), report.sms_status, report.error_code, report.error_message] += tracker.ids
+            else:
+                _logger.warning("Africastalking SMS: could not find a matching SMS tracker for sms_uuid=%s", uuid)
+
+        for (is_at_report, sms_status, error_code, error_message), tracker_ids in tracker_ids_by_status.items():
+            trackers = self.env['sms.tracker'].sudo().browse(tracker_ids)
+            if is_at_report:
+                trackers._action_update_from_at_report(sms_status, error_code)
+            else:
+                trackers._action_update_from_at_status(sms_status, error_code, error_message)
+
+        self.env['sms.sms'].sudo().search([
+            ('uuid', 'in', list(latest_report_by_uuid)),
+            ('to_delete', '=', False),
+        ]).to_delete = True
+        self.unlink()
@@ -0,0 +1,55 @@
+import re
+
+from odoo import _, api, fields, models
+from odoo.exceptions import ValidationError
+
+
+class SmsAfricastalkingRoute(models.Model):
+    """ Sender (shortcode or alphanumeric sender ID) to use per destination prefix.
+
+    The routes of a company are compiled into a prefix trie (see
+    ``res.company._get_sms_at_routing``): the route of the longest matching
+    prefix wins, and numbers without route fall back to the shortcode of the
+    company. """
+    _name = 'sms.africastalking.route'
+    _description = 'Africastalking SMS Route'
+    _order = 'company_id, prefix'
+
+    active = fields.Boolean('Active', default=True)
+    company_id = fields.Many2one('res.company', 'Company', required=True, ondelete='cascade', default=lambda self: self.env.company)
+    country_id = fields.Many2one('res.country', 'Country', help="Fills the prefix with the calling code of the country")
+    prefix = fields.Char(
+        'Prefix', required=True, compute='_compute_prefix', store=True, readonly=False, precompute=True,
+        help="International prefix of the destination numbers, without +, e.g. 254 or 25471")
+    sender = fields.Char('Sender', required=True, help="Shortcode or sender ID used for these destinations")
+    rate_limit = fields.Float('Rate Limit', help="Messages per second sent from this sender, 0 to use the global rate limit")
+
+    _prefix_company_uniq = models.UniqueIndex('(company_id, prefix) WHERE active IS TRUE')
+
+    @api.depends('country_id')
+    def _compute_prefix(self):
+        for route in self:
+            if route.country_id.phone_code:
+                route.prefix = str(route.country_id.phone_code)
+
+    @api.constrains('prefix')
+    def _check_prefix(self):
+        for route in self:
+            if not re.fullmatch(r'\d{1,15}', route.prefix or ''):
+                raise ValidationError(_("The prefix of a route must only contain digits, e.g. 254."))
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        routes = super().create(vals_list)
+        self.env.registry.clear_cache()  # res.company._get_sms_at_routing
+        return routes
+
+    def write(self, vals):
+        res = super().write(vals)
+        self.env.registry.clear_cache()  # res.company._get_sms_at_routing
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env.registry.clear_cache()  # res.company._get_sms_at_routing
+        return res
@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+
+class SmsAfricastalkingStream(models.Model):
+    """ Progress of a mass sending streamed by chunks from the composer (see
+    ``sms.composer._action_send_sms_mass``). It outlives the composer, so that
+    sending the same records again after a crash resumes after the last
+    committed chunk instead of creating their sms twice. Removed once the
+    sending is complete. """
+    _name = 'sms.africastalking.stream'
+    _description = 'Africastalking Streamed Mass SMS Progress'
+    _order = 'id desc'
+
+    key = fields.Char('Key', required=True, readonly=True, help="Digest of the model, records and content of the sending")
+    res_model = fields.Char('Model', readonly=True)
+    last_record_id = fields.Integer('Last Record', readonly=True, help="Id of the last record whose SMS are created")
+
+    _key_uniq = models.UniqueIndex('(key)')
+
+    @api.model
+    def _get_stream(self, key, res_model, resume_window):
+        """ Progress of the sending of ``key``. One not updated for ``resume_window``
+        seconds is not resumed: the same records are being sent again on purpose. """
+        stream = self.search([('key', '=', key)], limit=1)
+        if not stream:
+            return self.create({'key': key, 'res_model': res_model})
+        if stream.write_date < fields.Datetime.now() - timedelta(seconds=resume_window):
+            stream.last_record_id = 0
+        return stream
@@ -0,0 +1,79 @@
+from odoo import api, fields, models
+from odoo.tools import SQL
+
+# Notification statuses after which a tracker is not updated anymore
+AT_FINAL_NOTIFICATION_STATUSES = ('sent', 'bounce', 'exception', 'canceled')
+# Same for the mailing traces of the sms campaigns (mass_mailing_sms)
+AT_FINAL_TRACE_STATUSES = ('sent', 'open', 'reply', 'bounce', 'error', 'cancel')
+
+
+class SmsAfricastalkingTrackerArchive(models.Model):
+    """ Compact copy of the sms trackers in a final state, once older than the
+    retention window (``sms_africastalking.tracker.retention_days``). Moving them
+    out keeps ``sms.tracker`` and its uuid / messageId indexes small. """
+    _name = 'sms.africastalking.tracker.archive'
+    _description = 'Africastalking SMS Tracker Archive'
+    _order = 'id desc'
+    _log_access = False
+
+    sms_uuid = fields.Char('SMS UUID', readonly=True)
+    sms_at_sid = fields.Char('Africastalking SMS SID', readonly=True)
+    cost = fields.Float('Cost', readonly=True)
+    currency = fields.Char('Currency', readonly=True)
+    notification_status = fields.Char('Status', readonly=True)
+    failure_type = fields.Char('Failure Type', readonly=True)
+    sent_at = fields.Datetime('Sent On', readonly=True)
+
+    @api.model
+    def _archive_trackers(self, retention_days, batch_size, archive=True):
+        """ Move (or only delete, without ``archive``) a batch of the trackers in a final
+        state created more than ``retention_days`` days ago, in one statement. The state
+        is the one of their notification, or of their mailing trace for the trackers of
+        sms campaigns: the trackers still waiting for a delivery report are kept.
+
+        :return: the number of trackers removed from sms.tracker
+        """
+        self.env['sms.tracker'].flush_model()
+        self.env['mail.notification'].flush_model(['notification_status', 'failure_type'])
+        if 'mailing_trace_id' in self.env['sms.tracker']._fields:
+            self.env['mailing.trace'].flush_model(['trace_status', 'failure_type'])
+            trace_join = SQL("LEFT JOIN mailing_trace trace ON trace.id = tracker.mailing_trace_id")
+            trace_final = SQL("trace.id IS NULL OR trace.trace_status IN %s", AT_FINAL_TRACE_STATUSES)
+            status = SQL("COALESCE(notif.notification_status, trace.trace_status)")
+            failure_type = SQL("COALESCE(notif.failure_type, trace.failure_type)")
+        else:
+            trace_join, trace_final = SQL(), SQL("TRUE")
+            status, failure_type = SQL("notif.notification_status"), SQL("notif.failure_type")
+        moved = SQL(
+            """
+            DELETE FROM sms_tracker tracker
+                  USING (
+                    SELECT tracker.id, %s AS status, %s AS failure_type
+                      FROM sms_tracker tracker
+                 LEFT JOIN mail_notification notif ON notif.id = tracker.mail_notification_id
+                           %s
+                     WHERE tracker.create_date < (NOW() AT TIME ZONE 'UTC') - make_interval(days => %s)
+                       AND (notif.id IS NULL OR notif.notification_status IN %s)
+                       AND (%s)
+                     LIMIT %s
+                       FOR UPDATE OF tracker SKIP LOCKED
+                  ) old
+                  WHERE tracker.id = old.id
+              RETURNING tracker.sms_uuid, tracker.sms_at_sid, tracker.sms_at_cost, tracker.sms_at_currency,
+                        old.status, old.failure_type, tracker.create_date
+            """,
+            status, failure_type, trace_join, retention_days, AT_FINAL_NOTIFICATION_STATUSES, trace_final, batch_size,
+        )
+        if archive:
+            self.env.cr.execute(SQL(
+                """
+                WITH moved AS (%s)
+                INSERT INTO sms_africastalking_tracker_archive (sms_uuid, sms_at_sid, cost, currency, notification_status, failure_type, sent_at)
+                     SELECT * FROM moved
+                """,
+                moved,
+            ))
+        else:
+            self.env.cr.execute(moved)
+        self.env['sms.tracker'].invalidate_model()
+        return self.env.cr.rowcount
@@ -1,16 +1,141 @@
-from odoo import models
+import hashlib
+import json
+import logging
+import threading
+
+from odoo import fields, models
+from odoo.tools import split_every
+
+from ..tools.sms_at_estimate import SegmentCostEstimator, parse_price_table
+
+_logger = logging.getLogger(__name__)
 
 
 class SendSMS(models.TransientModel):
     _inherit = 'sms.composer'
 
+    sms_at_encoding = fields.Selection(
+        [('gsm7', 'GSM-7'), ('ucs2', 'UCS-2 (Unicode)'), ('mixed', 'Mixed')],
+        string='Encoding', readonly=True)
+    sms_at_sms_count = fields.Integer('Estimated SMS', readonly=True)
+    sms_at_segment_count = fields.Integer('Estimated Segments', readonly=True)
+    sms_at_unpriced_segment_count = fields.Integer('Segments Without Price', readonly=True)
+    sms_at_estimated_cost = fields.Float('Estimated Cost', readonly=True)
+    sms_at_estimate_currency = fields.Char('Estimate Currency', readonly=True)
+
     def _prepare_mass_sms_values(self, records):
         results = super()._prepare_mass_sms_values(records)
-        for record, result in zip(records, results):
-            company = self.env.company
-            if "company_id" in record._fields:
-                company = record.company_id
-            elif "record_company_id" in record._fields:
-                company = record.record_company_id
+        company_field = next((fname for fname in ("company_id", "record_company_id") if fname in records._fields), None)
+        if company_field:
+            # read the companies of all records at once
+            records.fetch([company_field])
+        for record in records:
+            company = record[company_field] if company_field else self.env.company
             results[record.id]["record_company_id"] = company.id
+            # campaigns go to the bulk lane of the queue
+            results[record.id]["sms_at_priority"] = 'bulk'
         return results
+
+    def _get_done_record_ids(self, records, recipients_info):
+        """ When streaming by chunks (see ``_action_send_sms_mass``), the numbers of the
+        previous chunks are done as well: the records of a later chunk with one of them
+        are duplicates. """
+        done_ids = super()._get_done_record_ids(records, recipients_info)
+        done_numbers = self.env.context.get('sms_at_stream_done_numbers')
+        if done_numbers is None:
+            return done_ids
+        done_ids = set(done_ids)
+        for record in records:
+            sanitized = recipients_info[record.id]['sanitized']
+            if not sanitized:
+                continue
+            if sanitized in done_numbers:
+                done_ids.add(record.id)
+            done_numbers.add(sanitized)
+        return list(done_ids)
+
+    def _action_send_sms_mass(self, records=None):
+        """ Above ``sms_africastalking.composer.stream.threshold`` records, create (and send)
+        the SMS by chunks of records, committing between chunks so that memory stays flat
+        and progress is kept (see sms.africastalking.stream): sending the same content to
+        the same records again resumes after the last committed chunk. The numbers of the
+        previous chunks are carried over, so that a number is sent once over all the chunks.
+        In that mode, no SMS is returned. """
+        records = records if records is not None else self._get_records()
+        ICP = self.env['ir.config_parameter'].sudo()
+        threshold = int(ICP.get_param('sms_africastalking.composer.stream.threshold', 0))
+        if not threshold or len(records) <= threshold:
+            return super()._action_send_sms_mass(records=records)
+
+        chunk_size = int(ICP.get_param('sms_africastalking.composer.stream.chunk.size', 5000))
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        record_ids = sorted(records.ids)
+        stream = self.env['sms.africastalking.stream'].sudo()._get_stream(
+            self._at_get_stream_key(record_ids), records._name,
+            int(ICP.get_param('sms_africastalking.composer.stream.resume_window', 86400)),
+        )
+        done_numbers = set()
+        if stream.last_record_id:
+            _logger.info("Africastalking SMS: resuming streamed SMS creation after record %s", stream.last_record_id)
+            done_record_ids = [record_id for record_id in record_ids if record_id <= stream.last_record_id]
+            record_ids = record_ids[len(done_record_ids):]
+            # numbers of the chunks sent before the interruption
+            for record_ids_chunk in split_every(chunk_size, done_record_ids, list):
+                recipients_info = self._prepare_recipient_values(records.browse(record_ids_chunk))
+                done_numbers.update(filter(None, (info['sanitized'] for info in recipients_info.values())))
+                self.env.invalidate_all()
+        _logger.info("Africastalking SMS: streaming SMS creation of %s records by chunks of %s", len(record_ids), chunk_size)
+        composer = self.with_context(sms_at_stream_done_numbers=done_numbers)
+        for record_ids_chunk in split_every(chunk_size, record_ids, list):
+            super(SendSMS, composer)._action_send_sms_mass(records=records.browse(record_ids_chunk))
+            stream.last_record_id = record_ids_chunk[-1]
+            if auto_commit:
+                self.env.cr.commit()
+            # drop the records and sms of the chunk from the cache
+            self.env.invalidate_all()
+        stream.unlink()
+        return self.env['sms.sms']
+
+    def _at_get_stream_key(self, record_ids):
+        """ Key of a streamed sending: same model, template, content and records """
+        return hashlib.sha256(json.dumps([self.res_model, self.template_id.id, self.body, record_ids]).encode()).hexdigest()
+
+    def action_sms_at_estimate(self):
+        """ Estimate the segments and the cost of the sms to send, from the rendered
+        bodies, processed in batches of records. """
+        self.ensure_one()
+        ICP = self.env['ir.config_parameter'].sudo()
+        estimator = SegmentCostEstimator(parse_price_table(ICP.get_param('sms_africastalking.price_table')))
+        if self.composition_mode == 'mass':
+            records = self._get_records()
+            batch_size = int(ICP.get_param('sms_africastalking.estimate.batch.size', 10000))
+            for records_batch in split_every(batch_size, records.ids, records.browse):
+                bodies = self._prepare_body_values(records_batch)
+                recipients = self._prepare_recipient_values(records_batch)
+                estimator.add_batch(
+                    [bodies[record_id] for record_id in records_batch.ids],
+                    [recipients[record_id].get('sanitized') or recipients[record_id].get('number') for record_id in records_batch.ids],
+                )
+                # keep memory flat on large campaigns
+                records_batch.invalidate_recordset()
+        else:
+            numbers = [number.strip() for number in (self.sanitized_numbers or self.recipient_single_number_itf or '').split(',') if number.strip()]
+            estimator.add_batch([self.body or ''] * len(numbers), numbers)
+
+        self.write({
+            'sms_at_encoding': next(iter(estimator.encodings)) if len(estimator.encodings) == 1 else 'mixed' if estimator.encodings else False,
+            'sms_at_sms_count': estimator.sms_count,
+            'sms_at_segment_count': estimator.segment_count,
+            'sms_at_unpriced_segment_count': estimator.unpriced_segment_count,
+            'sms_at_estimated_cost': estimator.cost,
+            'sms_at_estimate_currency': ICP.get_param('sms_africastalking.price_currency', 'KES'),
+        })
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'views': [(False, 'form')],
+            'view_mode': 'form',
+            'target': 'new',
+            'context': self.env.context,
+        }
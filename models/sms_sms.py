@@ -1,6 +1,22 @@
+import logging
+import threading
+import time
 from collections import defaultdict
+from datetime import timedelta
 
 from odoo import fields, models, api
+from odoo.tools import SQL, str2bool
+
+from ..tools.sms_africastalking import get_country_prefix
+from ..tools.sms_api import AT_ACCEPTED_STATES, AT_DEFERRED, AT_DEFERRED_FAILURE_TYPES, AT_RETRYABLE_FAILURE_TYPES
+from ..tools.sms_at_batching import AT_BATCH_REASONS, batch_sizers
+from ..tools.sms_at_estimate import count_segments
+from ..tools.sms_at_lanes import AT_LANE_CAPACITIES, AT_PRIORITY_LANES, parse_lane_capacities
+from ..tools.sms_at_metrics import get_metrics
+from ..tools.sms_at_throttle import compute_backoff
+from ..tools.sms_at_tracing import span, start_trace
+
+_logger = logging.getLogger(__name__)
 
 
 class SmsSms(models.Model):
@@ -8,15 +24,25 @@ class SmsSms(models.Model):
 
     sms_at_sid = fields.Char(related="sms_tracker_id.sms_at_sid", depends=['sms_tracker_id'])
     record_company_id = fields.Many2one('res.company', 'Company', ondelete='set null')
+    sms_at_claimed_at = fields.Datetime('Claimed by Dispatcher', readonly=True, copy=False)
+    sms_at_segments = fields.Integer('Segments', readonly=True)
+    sms_at_attempt_count = fields.Integer('Sending Attempts', readonly=True, copy=False)
+    sms_at_next_attempt = fields.Datetime('Next Attempt', readonly=True, copy=False, index='btree_not_null')
+    sms_at_priority = fields.Selection(
+        AT_PRIORITY_LANES, 'Priority', required=True, default='transactional',
+        help="Lane of the sms in the queue: OTP, then transactional sms are sent before bulk ones")
     failure_type = fields.Selection(
         selection_add=[
             ('at_authentication', 'Authentication Error"'),
             ('at_callback', 'Incorrect callback URL'),
             ('at_from_missing', 'Missing From Number'),
             ('at_from_to', 'From / To identical'),
+            ('at_duplicate', 'Duplicate Suppressed'),
         ],
     )
 
+    _outgoing_lane_idx = models.Index("(sms_at_priority, id) WHERE state = 'outgoing'")
+
     # CRUD
     # ------------------------------------------------------------
 
@@ -24,6 +50,8 @@ class SmsSms(models.Model):
     def create(self, vals_list):
         for vals in vals_list:
             vals['record_company_id'] = vals.get('record_company_id') or self.env.company.id  # TODO RIGR in master: move this field to SmsSms, and populate it via vals_list from all flows
+            if 'sms_at_segments' not in vals:
+                vals['sms_at_segments'] = count_segments(vals.get('body') or '')[1]
         return super().create(vals_list)
 
     @api.model
@@ -37,7 +65,7 @@ class SmsSms(models.Model):
         if existing_selection is None:
             return res
 
-        updated_stable = {'at_from_missing', 'at_from_to'}
+        updated_stable = {'at_from_missing', 'at_from_to', 'at_duplicate'}
         need_update = updated_stable - set(dict(self._fields['failure_type'].selection))
         if need_update:
             self.env['ir.model.fields'].invalidate_model(['selection_ids'])
@@ -54,44 +82,475 @@ class SmsSms(models.Model):
     # SEND
     # ------------------------------------------------------------
 
+    def send(self, unlink_failed=False, unlink_sent=True, auto_commit=False, raise_exception=False):
+        # auto_commit is needed by the streamed results of the Africastalking batches, see _send
+        with start_trace(self.env, 'sms.send', sms_count=len(self)):
+            return super(SmsSms, self.with_context(sms_at_auto_commit=auto_commit)).send(
+                unlink_failed=unlink_failed, unlink_sent=unlink_sent, auto_commit=auto_commit, raise_exception=raise_exception,
+            )
+
+    def _send(self, unlink_failed=False, unlink_sent=True, raise_exception=False):
+        # Let SmsApiAfricastalking._send_sms_batch apply its results by sub-batches as they come
+        send_options = {
+            'sms_ids': self.ids,
+            'unlink_failed': unlink_failed,
+            'unlink_sent': unlink_sent,
+            'auto_commit': self.env.context.get('sms_at_auto_commit', False),
+            'flushed_uuids': set(),
+        }
+        return super(SmsSms, self.with_context(sms_at_send_options=send_options))._send(
+            unlink_failed=unlink_failed, unlink_sent=unlink_sent, raise_exception=raise_exception,
+        )
+
+    @api.model
+    def _process_queue(self, ids=None):
+        # only the sms due for a retry are sent by the queue
+        sms_model = self.with_context(sms_at_due_only=True)
+        if ids:
+            return super(SmsSms, sms_model)._process_queue(ids=ids)
+        # Lane-aware version of the queue: same as super, but sms are taken lane by lane
+        # and sent in that order, instead of by id
+        res = None
+        try:
+            auto_commit = not getattr(threading.current_thread(), 'testing', False)
+            res = sms_model.browse(sms_model._at_get_queue_ids()).send(
+                unlink_failed=False, unlink_sent=True, auto_commit=auto_commit, raise_exception=False,
+            )
+        except Exception:
+            _logger.exception("Failed processing SMS queue")
+        return res
+
+    @api.model
+    def _at_get_queue_ids(self):
+        """ Ids of the due outgoing sms to send in this run, lane by lane (see ``AT_PRIORITY_LANES``).
+
+        A run sends at most ``sms_africastalking.queue.limit`` sms. Each lane with a capacity
+        (``sms_africastalking.lanes.capacity``) takes at most that many of them, so that bulk
+        sms always keep part of the run; the next lanes get what the previous ones left.
+        When the standalone dispatcher is enabled, the Africastalking sms are left to it and
+        do not take the room of the sms of the other providers.
+        """
+        ICP = self.env['ir.config_parameter'].sudo()
+        remaining = int(ICP.get_param('sms_africastalking.queue.limit', 10000))
+        capacities = parse_lane_capacities(ICP.get_param('sms_africastalking.lanes.capacity', AT_LANE_CAPACITIES))
+        domain = [
+            ('state', '=', 'outgoing'), ('to_delete', '!=', True),
+            '|', ('sms_at_next_attempt', '=', False), ('sms_at_next_attempt', '<=', fields.Datetime.now()),
+        ]
+        if self._at_is_dispatcher_enabled():
+            # same company as _get_sms_company: the one of the message, else the one of the sms
+            at_company_ids = self.env['res.company'].sudo().search([('sms_provider', '=', 'africastalking')]).ids
+            domain += [
+                ('mail_message_id.record_company_id', 'not in', at_company_ids),
+                '|', ('mail_message_id.record_company_id', '!=', False), ('record_company_id', 'not in', at_company_ids),
+            ]
+        queue_ids = []
+        for lane, _label in AT_PRIORITY_LANES:
+            limit = min(capacities.get(lane, remaining), remaining)
+            if limit <= 0:
+                continue
+            lane_ids = self.search(domain + [('sms_at_priority', '=', lane)], order='id', limit=limit).ids
+            queue_ids += lane_ids
+            remaining -= len(lane_ids)
+        return queue_ids
+
+    # GARBAGE COLLECTION
+    # ------------------------------------------------------------
+
+    @api.model
+    def _cron_at_gc(self):
+        """ Remove, in set-based batches committed one by one, the sms marked as to delete
+        and the old journal entries, then archive the old trackers in a final state
+        (see sms.africastalking.tracker.archive). Stops after ``sms_africastalking.gc.time_budget``
+        seconds, the next run goes on. """
+        ICP = self.env['ir.config_parameter'].sudo()
+        batch_size = int(ICP.get_param('sms_africastalking.gc.batch.size', 10000))
+        deadline = time.monotonic() + int(ICP.get_param('sms_africastalking.gc.time_budget', 300))
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+
+        def run_batches(name, run_batch):
+            total = 0
+            while time.monotonic() < deadline:
+                count = run_batch()
+                total += count
+                if auto_commit:
+                    self.env.cr.commit()
+                if count < batch_size:
+                    break
+            if total:
+                _logger.info("Africastalking SMS: GC removed %s %s", total, name)
+
+        self.flush_model()
+        run_batches('sms', lambda: self._at_gc_sms(batch_size))
+        journal_retention = int(ICP.get_param('sms_africastalking.journal.retention_days', 2))
+        run_batches('journal entries', lambda: self._at_gc_journal(journal_retention, batch_size))
+        tracker_retention = int(ICP.get_param('sms_africastalking.tracker.retention_days', 0))
+        if tracker_retention:
+            archive = str2bool(ICP.get_param('sms_africastalking.tracker.archive', True))
+            run_batches('trackers', lambda: self.env['sms.africastalking.tracker.archive']._archive_trackers(
+                tracker_retention, batch_size, archive=archive,
+            ))
+
+    @api.model
+    def _at_gc_sms(self, batch_size):
+        self.env.cr.execute(SQL(
+            """
+            DELETE FROM sms_sms
+                  WHERE id IN (
+                    SELECT id
+                      FROM sms_sms
+                     WHERE to_delete IS TRUE
+                     LIMIT %s
+                       FOR UPDATE SKIP LOCKED
+                  )
+            """,
+            batch_size,
+        ))
+        self.invalidate_model()
+        return self.env.cr.rowcount
+
+    @api.model
+    def _at_gc_journal(self, retention_days, batch_size):
+        self.env.cr.execute(SQL(
+            """
+            DELETE FROM sms_africastalking_journal
+                  WHERE id IN (
+                    SELECT id
+                      FROM sms_africastalking_journal
+                     WHERE accepted_at < (NOW() AT TIME ZONE 'UTC') - make_interval(days => %s)
+                     LIMIT %s
+                  )
+            """,
+            retention_days, batch_size,
+        ))
+        return self.env.cr.rowcount
+
+    @api.model
+    def _at_get_lane_stats(self):
+        """ Depth and age (seconds) of the oldest sms of each lane of the queue
+
+        :return: a dict {lane: (depth, oldest age)}
+        """
+        self.flush_model(['state', 'to_delete', 'sms_at_priority'])
+        self.env.cr.execute(SQL("""
+            SELECT sms_at_priority, COUNT(*), EXTRACT(EPOCH FROM (NOW() AT TIME ZONE 'UTC') - MIN(create_date))
+              FROM sms_sms
+             WHERE state = 'outgoing'
+               AND to_delete IS NOT TRUE
+          GROUP BY sms_at_priority
+        """))
+        stats = dict.fromkeys(dict(AT_PRIORITY_LANES), (0, 0.0))
+        stats.update((lane, (depth, float(oldest_age or 0.0))) for lane, depth, oldest_age in self.env.cr.fetchall())
+        return stats
+
     def _split_by_api(self):
         # override to handle africastalking, twilio or IAP choice, which is company dependent
-        sms_by_company = defaultdict(lambda: self.env['sms.sms'])  # TODO RIGR: in master, let's be smarter and group by provider/twilio account (e.g.: IAP/twilio1/twilio2)
-        todo_via_super = self.browse()
-        for sms in self:
-            sms_by_company[sms._get_sms_company()] += sms
-        for company, company_sms in sms_by_company.items():
-            if company.sms_provider == "africastalking":
-                sms_api = company._get_sms_api_class()(self.env)
-                sms_api._set_company(company)
+        # When the standalone dispatcher is enabled, Africastalking sms are left in the queue for it
+        leave_to_dispatcher = self._at_is_dispatcher_enabled() and not self.env.context.get('sms_at_dispatcher')
+        sms_to_split = self
+        if self.env.context.get('sms_at_due_only'):
+            now = fields.Datetime.now()
+            sms_to_split = self.filtered(lambda sms: not sms.sms_at_next_attempt or sms.sms_at_next_attempt <= now)
+        for sms_api, company_sms in sms_to_split._split_by_at_api():
+            if sms_api is None:
+                yield from super(SmsSms, company_sms)._split_by_api()
+            elif leave_to_dispatcher:
+                continue
+            elif not sms_api._at_is_sending_allowed():
+                # circuit breaker open (gateway errors or insufficient balance): keep them queued
+                _logger.warning("Africastalking SMS: sending suspended, %s sms left in the queue", len(company_sms))
+                company_sms._at_defer(sms_api)
+            else:
                 yield sms_api, company_sms
+
+    def _split_by_at_api(self):
+        """ Yield (sms_api, sms) for Africastalking sms and (None, sms) for the other ones.
+
+        Africastalking sms are grouped by provider account (username + shortcode) and send
+        settings rather than by company, so that companies sharing an account and settings
+        share one API object (see ``res.company._get_sms_at_send_key``).
+        """
+        sms_ids_by_key = defaultdict(list)
+        company_by_key = {}
+        todo_via_super_ids = []
+        with span('sms.split_by_api', sms_count=len(self)):
+            company_by_sms = self._at_get_company_by_sms()
+        key_by_company = {}
+        for sms_id, company in company_by_sms.items():
+            if company.sms_provider == "africastalking":
+                if company not in key_by_company:
+                    key_by_company[company] = company._get_sms_at_send_key()
+                key = key_by_company[company]
+                company_by_key.setdefault(key, company)
+                sms_ids_by_key[key].append(sms_id)
             else:
-                todo_via_super += company_sms
-        if todo_via_super:
-            yield from super(SmsSms, todo_via_super)._split_by_api()
+                todo_via_super_ids.append(sms_id)
+        for key, sms_ids in sms_ids_by_key.items():
+            company = company_by_key[key]
+            sms_api = company._get_sms_api_class()(self.env)
+            sms_api._set_company(company)
+            yield sms_api, self.browse(sms_ids)
+        if todo_via_super_ids:
+            yield None, self.browse(todo_via_super_ids)
+
+    def _at_is_dispatcher_enabled(self):
+        return str2bool(self.env['ir.config_parameter'].sudo().get_param('sms_africastalking.dispatcher.enabled', False))
+
+    def _at_prepare_messages(self):
+        """ Same structure as the messages given to ``_send_sms_batch`` by ``_send`` """
+        return [{
+            'content': body,
+            'numbers': [{'number': sms.number, 'uuid': sms.uuid} for sms in body_sms_records],
+        } for body, body_sms_records in self.grouped('body').items()]
 
     def _get_sms_company(self):
         return self.mail_message_id.record_company_id or self.record_company_id or super()._get_sms_company()
 
     def _get_send_batch_size(self):
-        companies = self._get_sms_company()
-        if companies and any(company.sms_provider == 'africastalking' for company in companies):
-            return int(self.env['ir.config_parameter'].sudo().get_param('sms_africastalking.session.batch.size', 10))
+        at_accounts = self._at_get_accounts()
+        if at_accounts:
+            ICP = self.env['ir.config_parameter'].sudo()
+            batch_size = int(ICP.get_param('sms_africastalking.session.batch.size', 10))
+            if not str2bool(ICP.get_param('sms_africastalking.session.batch.adaptive', False)):
+                return batch_size
+            sizes = []
+            for account in at_accounts:
+                sizer = batch_sizers.get(account)
+                size, reason = sizer.compute(
+                    min_size=int(ICP.get_param('sms_africastalking.session.batch.min', 10)),
+                    max_size=int(ICP.get_param('sms_africastalking.session.batch.max', 1000)),
+                    time_budget=int(ICP.get_param('sms_africastalking.session.batch.time_budget', 60)),
+                    default_size=batch_size,
+                )
+                _logger.info("Africastalking SMS: batch size %s for account %s: %s", size, account[0], reason)
+                self._at_record_batch_size_metrics(account, sizer.get_info())
+                sizes.append(size)
+            # batches mix the sms of all the accounts: the size of the slowest one
+            return min(sizes)
         return super()._get_send_batch_size()
 
+    def _at_get_accounts(self):
+        """ Africastalking accounts (see ``res.company._get_sms_at_account``) of the sms """
+        return {
+            company._get_sms_at_account()
+            for company in set(self._at_get_company_by_sms().values())
+            if company.sms_provider == 'africastalking'
+        }
+
+    def _split_batch(self):
+        """ In queue runs, stop taking batches once the next one is predicted to end after
+        ``sms_africastalking.queue.time_budget`` seconds from the start of the run, from the
+        measured sending time per sms of the accounts (see ``AdaptiveBatchSizer``). The
+        remaining sms stay queued for a run triggered right away. """
+        if not self.env.context.get('sms_at_due_only'):
+            yield from super()._split_batch()
+            return
+        time_budget = int(self.env['ir.config_parameter'].sudo().get_param('sms_africastalking.queue.time_budget', 90))
+        seconds_per_sms = max(
+            (batch_sizers.get(account).get_info()['seconds_per_sms'] or 0.0 for account in self._at_get_accounts()),
+            default=0.0,
+        )
+        start = time.monotonic()
+        for index, batch_ids in enumerate(super()._split_batch()):
+            # the first batch is always sent, so that the queue moves on whatever the latency
+            if index and time.monotonic() - start + len(batch_ids) * seconds_per_sms > time_budget:
+                _logger.info("Africastalking SMS: time budget of the queue run reached after %.0fs, sms left for the next run",
+                             time.monotonic() - start)
+                self._at_trigger_queue(fields.Datetime.now())
+                return
+            yield batch_ids
+
+    def _at_record_batch_size_metrics(self, account, info):
+        """ Expose the adaptive batch size as gauges, as it is only known by the worker running the queue """
+        metrics = get_metrics(self.env.cr.dbname)
+        labels = {'account': account[0], 'shortcode': account[1] or ''}
+        metrics.set_gauge('sms_at_batch_size', info['size'], labels)
+        for reason_code in AT_BATCH_REASONS:
+            metrics.set_gauge('sms_at_batch_size_reason', float(reason_code == info['reason_code']), {**labels, 'reason': reason_code})
+        if info['seconds_per_sms'] is not None:
+            metrics.set_gauge('sms_at_batch_seconds_per_sms', info['seconds_per_sms'], labels)
+            metrics.set_gauge('sms_at_batch_error_rate', info['error_rate'], labels)
+
+    @api.model
+    def _get_at_batch_size_info(self):
+        """ Current adaptive batch size of each Africastalking account of this worker, and why
+        (see the sms_at_batch_* metrics for the ones of all the workers) """
+        return {
+            f'{username}/{shortcode}': sizer.get_info()
+            for (username, shortcode), sizer in batch_sizers.items()
+        }
+
     def _handle_call_result_hook(self, results):
         """
-        Store the sid of Africastalking on the SMS tracking record (as SMS will be deleted)
+        Store the sid and cost of Africastalking on the SMS tracking record (as SMS will be deleted)
+        and add the sent SMS to the cost rollups.
         :param results: a list of dict in the form [{
             'uuid': Odoo's id of the SMS,
             'state': State of the SMS in Odoo,
             'sms_at_sid': Africastalking's id of the SMS,
+            'cost': cost of the SMS reported by Africastalking,
+            'currency_code': currency of the cost,
         }, ...]
         """
-        at_sms = self.filtered(lambda s: s._get_sms_company().sms_provider == 'africastalking')
-        grouped_at_sms = at_sms.grouped("uuid")
-        for result in results:
-            sms = grouped_at_sms.get(result.get('uuid'))
-            if sms and sms.sms_tracker_id and result.get('sms_at_sid'):
-                sms.sms_tracker_id.sms_at_sid = result['sms_at_sid']
+        with span('sms.handle_call_result_hook', results=len(results)):
+            self._at_handle_call_result_hook(results)
+
+    def _at_handle_call_result_hook(self, results):
+        results = self._at_filter_flushed_results(results)
+        company_by_sms = self._at_get_company_by_sms()
+        at_sms = self.browse([sms_id for sms_id, company in company_by_sms.items() if company.sms_provider == 'africastalking'])
+        at_uuids = set(at_sms.mapped('uuid'))
+        at_results = [
+            result for result in results
+            if result.get('sms_at_sid') and result.get('uuid') in at_uuids
+        ]
+        if at_results:
+            # One statement for the whole batch instead of one write per tracker
+            self.env['sms.tracker'].flush_model(['sms_uuid', 'sms_at_sid', 'sms_at_cost', 'sms_at_currency'])
+            self.env.cr.execute(SQL(
+                """
+                UPDATE sms_tracker
+                   SET sms_at_sid = result.sms_at_sid,
+                       sms_at_cost = result.sms_at_cost,
+                       sms_at_currency = result.sms_at_currency
+                  FROM (VALUES %s) AS result(sms_uuid, sms_at_sid, sms_at_cost, sms_at_currency)
+                 WHERE sms_tracker.sms_uuid = result.sms_uuid
+             RETURNING sms_tracker.id
+                """,
+                SQL(', ').join(
+                    SQL('(%s, %s, %s::float8, %s)', result['uuid'], result['sms_at_sid'], result.get('cost'), result.get('currency_code'))
+                    for result in at_results
+                ),
+            ))
+            self.env['sms.tracker'].browse([row[0] for row in self.env.cr.fetchall()]).invalidate_recordset(
+                ['sms_at_sid', 'sms_at_cost', 'sms_at_currency'],
+            )
+            self._at_update_cost_rollups(at_results, company_by_sms)
         super(SmsSms, self - at_sms)._handle_call_result_hook(results)
+
+    def _postprocess_iap_sent_sms(self, iap_results, failure_reason=None, unlink_failed=False, unlink_sent=True):
+        iap_results = self._at_filter_flushed_results(iap_results)
+        # Requests deferred by the circuit breaker were not sent, and the ones rejected for an
+        # insufficient balance tripped it: put their sms back in the queue
+        deferred_uuids = {
+            result['uuid'] for result in iap_results
+            if result['state'] == AT_DEFERRED or result['state'] in AT_DEFERRED_FAILURE_TYPES
+        }
+        if deferred_uuids:
+            for sms_api, deferred_sms in self.filtered(lambda sms: sms.uuid in deferred_uuids)._split_by_at_api():
+                if sms_api is not None:
+                    deferred_sms._at_defer(sms_api)
+        # Transient failures are retried later instead of being final
+        retried_uuids = self._at_schedule_retries([
+            result['uuid'] for result in iap_results if result['state'] in AT_RETRYABLE_FAILURE_TYPES
+        ])
+        if deferred_uuids or retried_uuids:
+            iap_results = [result for result in iap_results if result['uuid'] not in deferred_uuids | retried_uuids]
+        self._at_record_queue_latency(iap_results)
+        res = super()._postprocess_iap_sent_sms(iap_results, failure_reason=failure_reason, unlink_failed=unlink_failed, unlink_sent=unlink_sent)
+        # Enqueued sms stay in the 'process' state until their delivery report: they are not
+        # claimed anymore, so that the dispatcher does not put them back in the queue
+        processing_uuids = {result['uuid'] for result in iap_results if result['state'] == 'processing'}
+        if processing_uuids:
+            self.filtered(lambda sms: sms.uuid in processing_uuids and sms.sms_at_claimed_at).sms_at_claimed_at = False
+        return res
+
+    def _at_defer(self, sms_api):
+        """ Put back in the queue the sms held by the open circuit breaker of ``sms_api``, due
+        at the end of its cooldown: meanwhile the queue runs and the dispatcher claims skip
+        them, instead of picking the same blocked sms at each run. """
+        resume_time = sms_api._at_get_resume_time()
+        self.write({'state': 'outgoing', 'sms_at_claimed_at': False, 'sms_at_next_attempt': resume_time})
+        self._at_trigger_queue(resume_time)
+
+    @api.model
+    def _at_trigger_queue(self, at):
+        """ Run the sms queue at ``at``, when the sms put back in the queue are due: its cron may
+        otherwise run much later """
+        self.env.ref('sms.ir_cron_sms_scheduler_action')._trigger(at=at)
+
+    def _at_filter_flushed_results(self, results):
+        """ Drop the results already applied by the streamed batches (see ``_send``), e.g. the
+        errors set on the whole batch by ``_send`` when a later request raises """
+        flushed_uuids = (self.env.context.get('sms_at_send_options') or {}).get('flushed_uuids')
+        if not flushed_uuids:
+            return results
+        return [result for result in results if result['uuid'] not in flushed_uuids]
+
+    def _at_record_queue_latency(self, results):
+        """ Time spent by the accepted sms from their creation, per lane """
+        accepted_uuids = {result['uuid'] for result in results if result['state'] in AT_ACCEPTED_STATES}
+        if not accepted_uuids:
+            return
+        metrics = get_metrics(self.env.cr.dbname)
+        now = fields.Datetime.now()
+        for sms in self:
+            if sms.uuid in accepted_uuids and sms.create_date:
+                metrics.observe('sms_at_queue_latency_seconds', (now - sms.create_date).total_seconds(), {'lane': sms.sms_at_priority})
+
+    def _at_schedule_retries(self, uuids):
+        """ Put the sms of ``uuids`` back in the queue with a jittered exponential backoff,
+        unless they reached the maximum number of attempts.
+
+        :return: the set of uuids of the sms that will be retried
+        """
+        if not uuids:
+            return set()
+        ICP = self.env['ir.config_parameter'].sudo()
+        max_attempts = int(ICP.get_param('sms_africastalking.retry.max_attempts', 5))
+        base_delay = int(ICP.get_param('sms_africastalking.retry.base_delay', 60))
+        max_delay = int(ICP.get_param('sms_africastalking.retry.max_delay', 3600))
+        uuids = set(uuids)
+        now = fields.Datetime.now()
+        retried_uuids = set()
+        next_attempts = []
+        # one write per attempt number, the sms of a same attempt being retried together
+        for attempt, attempt_sms in self.filtered(lambda sms: sms.uuid in uuids).grouped(
+            lambda sms: sms.sms_at_attempt_count + 1,
+        ).items():
+            if attempt >= max_attempts:
+                continue
+            next_attempt = now + timedelta(seconds=compute_backoff(attempt, base_delay, max_delay))
+            attempt_sms.write({
+                'state': 'outgoing',
+                'sms_at_claimed_at': False,
+                'sms_at_attempt_count': attempt,
+                'sms_at_next_attempt': next_attempt,
+            })
+            retried_uuids.update(attempt_sms.mapped('uuid'))
+            next_attempts.append(next_attempt)
+        if retried_uuids:
+            _logger.info("Africastalking SMS: %s sms will be retried after a gateway error", len(retried_uuids))
+            self._at_trigger_queue(min(next_attempts))
+        return retried_uuids
+
+    def _at_update_cost_rollups(self, results, company_by_sms):
+        """ Add the sent sms of ``results`` (and their segments) to the daily cost rollups,
+        per sender actually used """
+        sms_by_uuid = self.grouped('uuid')
+        rollups = defaultdict(lambda: [0, 0.0, 0])
+        for result in results:
+            if result.get('state') not in AT_ACCEPTED_STATES or not (sms := sms_by_uuid.get(result['uuid'])):
+                continue
+            company = company_by_sms[sms.id]
+            sender = result.get('sender') or company.sudo().sms_at_shortcode or ''
+            key = (company.id, sender, get_country_prefix(sms.number), result.get('currency_code') or '')
+            rollups[key][0] += 1
+            rollups[key][1] += result.get('cost') or 0.0
+            rollups[key][2] += sms.sms_at_segments
+        self.env['sms.africastalking.cost.rollup']._add_to_rollups(fields.Date.context_today(self), rollups)
+
+    def _at_get_company_by_sms(self):
+        """ Same as ``_get_sms_company`` for each sms, but in one prefetched pass.
+
+        :return: a dict {sms id: company}
+        """
+        self.fetch(['mail_message_id', 'record_company_id'])
+        self.mail_message_id.fetch(['record_company_id'])
+        default_company = self.browse()._get_sms_company()
+        company_by_sms = {
+            sms.id: sms.mail_message_id.record_company_id or sms.record_company_id or default_company
+            for sms in self
+        }
+        self.env['res.company'].concat(*company_by_sms.values()).fetch(['sms_provider'])
+        return company_by_sms
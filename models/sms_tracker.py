@@ -1,4 +1,7 @@
-from odoo import models, fields
+from odoo import api, models, fields
+from odoo.tools import SQL
+
+from ..tools.sms_africastalking import AT_TO_SMS_STATE, AT_TO_SMS_STATE_ERRORS, TWILIO_TO_SMS_STATE, TWILIO_TO_SMS_STATE_ERRORS
 
 AT_CODE_TO_FAILURE_TYPE = {
     # https://www.twilio.com/docs/messaging/guides/debugging-tools#error-codes
@@ -9,13 +12,31 @@ AT_CODE_TO_FAILURE_TYPE = {
     '30006': "not_allowed",  # Landline or unreachable carrier
     '30007': "rejected",  # Carrier violation
     '30008': "not_delivered",  # Unknown error
+    # https://developers.africastalking.com/docs/sms/notifications (failureReason)
+    'InsufficientCredit': "rejected",
+    'InvalidLinkId': "rejected",
+    'UserIsInactive': "invalid_destination",
+    'UserInBlackList': "not_allowed",
+    'UserAccountSuspended': "not_allowed",
+    'NotNetworkSubcriber': "invalid_destination",
+    'UserNotSubscribedToProduct': "not_allowed",
+    'UserDoesNotExist': "invalid_destination",
+    'DeliveryFailure': "not_delivered",
+    'DoNotDisturbRejection': "rejected",
+    # status
+    'Expired': "expired",
 }
 
 
 class SmsTracker(models.Model):
     _inherit = 'sms.tracker'
 
-    sms_at_sid = fields.Char(string='Africastalking SMS SID', readonly=True)
+    sms_at_sid = fields.Char(string='Africastalking SMS SID', readonly=True, index='btree_not_null')
+    sms_at_cost = fields.Float(string='Africastalking Cost', readonly=True)
+    sms_at_currency = fields.Char(string='Africastalking Cost Currency', readonly=True)
+
+    # oldest trackers first, see sms.africastalking.tracker.archive
+    _create_date_idx = models.Index('(create_date)')
 
     def _action_update_from_at_error(self, sms_status, error_code, error_message):
         """Update the SMS tracker with the Twilio Status and Error code/msg"""
@@ -24,3 +45,46 @@ class SmsTracker(models.Model):
             or (None if sms_status == "failed" else "not_delivered")
         )
         return self.with_context(sms_known_failure_reason=error_message)._action_update_from_provider_error(failure_type)
+
+    def _action_update_from_at_status(self, sms_status, error_code=None, error_message=None):
+        """Update the SMS tracker from a status callback"""
+        if sms_status in TWILIO_TO_SMS_STATE_ERRORS:
+            return self._action_update_from_twilio_error(sms_status, error_code, error_message)
+        return self._action_update_from_sms_state(TWILIO_TO_SMS_STATE[sms_status])
+
+    def _action_update_from_at_report(self, at_status, failure_reason=None):
+        """Update the SMS tracker from an Africastalking delivery report (keyed by messageId)"""
+        if at_status in AT_TO_SMS_STATE_ERRORS:
+            failure_type = AT_CODE_TO_FAILURE_TYPE.get(failure_reason) or AT_CODE_TO_FAILURE_TYPE.get(at_status) or "not_delivered"
+            return self.with_context(sms_known_failure_reason=failure_reason)._action_update_from_provider_error(failure_type)
+        return self._action_update_from_sms_state(AT_TO_SMS_STATE[at_status])
+
+    @api.model
+    def _at_get_callback_target(self, sms_uuid=None, sms_at_sid=None):
+        """ Resolve in a single query the tracker, the sms (if not deleted yet) and the company
+        of a status callback, identified either by Odoo's uuid or by Africastalking's messageId.
+
+        :return: a dict with tracker_id, sms_id, sms_uuid, to_delete and company_id, or None
+        """
+        self.env.flush_all()  # flush pending updates as we query the tables directly
+        self.env.cr.execute(SQL(
+            """
+            SELECT tracker.id,
+                   sms.id,
+                   tracker.sms_uuid,
+                   sms.to_delete,
+                   COALESCE(sms_message.record_company_id, sms.record_company_id, notif_message.record_company_id)
+              FROM sms_tracker tracker
+         LEFT JOIN sms_sms sms ON sms.uuid = tracker.sms_uuid
+         LEFT JOIN mail_message sms_message ON sms_message.id = sms.mail_message_id
+         LEFT JOIN mail_notification notif ON notif.id = tracker.mail_notification_id
+         LEFT JOIN mail_message notif_message ON notif_message.id = notif.mail_message_id
+             WHERE %s
+             LIMIT 1
+            """,
+            SQL("tracker.sms_uuid = %s", sms_uuid) if sms_uuid else SQL("tracker.sms_at_sid = %s", sms_at_sid),
+        ))
+        row = self.env.cr.fetchone()
+        if not row:
+            return None
+        return dict(zip(('tracker_id', 'sms_id', 'sms_uuid', 'to_delete', 'company_id'), row))
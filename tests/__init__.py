@@ -0,0 +1,6 @@
+from . import test_sms_at_benchmark
+from . import test_sms_at_callbacks
+from . import test_sms_at_composer
+from . import test_sms_at_queue
+from . import test_sms_at_send
+from . import test_sms_at_tools
@@ -0,0 +1,162 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urljoin
+
+import requests
+
+from odoo.addons.sms_africastalking.tools.sms_africastalking import compute_at_callback_signature
+
+AT_RECIPIENT_ERRORS = {
+    401: 'RiskHold',
+    402: 'InvalidSenderId',
+    403: 'InvalidPhoneNumber',
+    404: 'UnsupportedNumberType',
+    405: 'InsufficientBalance',
+    406: 'UserInBlacklist',
+    407: 'CouldNotRoute',
+    409: 'DoNotDisturbRejection',
+}
+
+
+class FakeAfricastalkingGateway:
+    """ Local stand-in of the Africastalking SMS API, for tests and benchmarks.
+
+    It answers ``POST /version1/messaging`` in the Africastalking format (one
+    entry per recipient in ``Recipients``) and can inject latency, HTTP errors
+    and per-recipient error status codes (401-409). It keeps the messageIds it
+    returned so that delivery callbacks can be posted back to Odoo.
+
+    Use it as a context manager, and point the module to it with the
+    ``sms_africastalking.api.url`` system parameter set to ``gateway.url``.
+    """
+
+    def __init__(self, latency=0.0, http_error_rate=0.0, recipient_error_rate=0.0,
+                 error_codes=tuple(AT_RECIPIENT_ERRORS), cost='KES 0.8000', seed=0):
+        self.latency = latency
+        self.http_error_rate = http_error_rate
+        self.recipient_error_rate = recipient_error_rate
+        self.error_codes = error_codes
+        self.cost = cost
+        self.random = random.Random(seed)
+        self.request_count = 0
+        self.sent = []  # list of (messageId, number)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+                status, payload = gateway._handle(self.path, self.headers, form)
+                body = json.dumps(payload).encode() if isinstance(payload, dict) else payload.encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json' if isinstance(payload, dict) else 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def _handle(self, path, headers, form):
+        if path != '/version1/messaging':
+            return 404, 'Not Found'
+        if not headers.get('apiKey'):
+            return 401, 'The supplied authentication is invalid'
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.request_count += 1
+            if self.http_error_rate and self.random.random() < self.http_error_rate:
+                return 500, 'Internal Server Error'
+            recipients = []
+            for number in filter(None, (form.get('to') or '').split(',')):
+                if self.recipient_error_rate and self.random.random() < self.recipient_error_rate:
+                    status_code = self.random.choice(self.error_codes)
+                    recipients.append({
+                        'statusCode': status_code,
+                        'number': number,
+                        'status': AT_RECIPIENT_ERRORS.get(status_code, 'Failed'),
+                        'cost': '0',
+                        'messageId': 'None',
+                    })
+                    continue
+                message_id = f'ATXid_{uuid.uuid4().hex}'
+                self.sent.append((message_id, number))
+                recipients.append({
+                    'statusCode': 101,
+                    'number': number,
+                    'status': 'Success',
+                    'cost': self.cost,
+                    'messageId': message_id,
+                })
+        return 201, {
+            'SMSMessageData': {
+                'Message': f'Sent to {len(recipients)}/{len(recipients)} Total Cost: {self.cost}',
+                'Recipients': recipients,
+            },
+        }
+
+    # ------------------------------------------------------------
+    # CALLBACKS
+    # ------------------------------------------------------------
+
+    def post_status_callbacks(self, base_url, sms_uuids, api_key, sms_status='delivered'):
+        """ Post signed callbacks to ``/sms_africastalking/status/<uuid>``, as configured per sms.
+
+        :return: the list of HTTP status codes of the responses
+        """
+        status_codes = []
+        with requests.Session() as session:
+            for sms_uuid in sms_uuids:
+                url = urljoin(base_url, f'/sms_africastalking/status/{sms_uuid}')
+                params = {'SmsStatus': sms_status}
+                signature = compute_at_callback_signature(url, params, api_key.encode())
+                response = session.post(url, data=params, headers={'X-AT-Signature': signature}, timeout=30)
+                status_codes.append(response.status_code)
+        return status_codes
+
+    def post_delivery_reports(self, base_url, token, status='Success', failure_reason=None):
+        """ Post Africastalking native delivery reports of all the sent messages to ``/sms_africastalking/report``,
+        ``token`` being the ``sms_africastalking.report.token`` system parameter. """
+        status_codes = []
+        with requests.Session() as session:
+            for message_id, number in self.sent:
+                params = {'id': message_id, 'status': status, 'phoneNumber': number, 'networkCode': '63902'}
+                if failure_reason:
+                    params['failureReason'] = failure_reason
+                response = session.post(
+                    urljoin(base_url, '/sms_africastalking/report'), params={'token': token}, data=params, timeout=30,
+                )
+                status_codes.append(response.status_code)
+        return status_codes
@@ -0,0 +1,114 @@
+import logging
+import os
+import time
+import tracemalloc
+from uuid import uuid4
+
+from odoo.tests import HttpCase, tagged
+
+from odoo.addons.sms_africastalking.tools.sms_api import SmsApiAfricastalking
+from .common import FakeAfricastalkingGateway
+
+_logger = logging.getLogger(__name__)
+
+BENCHMARK_SIZES = [int(size) for size in os.environ.get('SMS_AT_BENCHMARK_SIZES', '1000,10000,100000').split(',')]
+
+
+@tagged('post_install', '-at_install', '-standard', 'sms_at_benchmark')
+class TestSmsAtBenchmark(HttpCase):
+    """ Throughput benchmarks of the Africastalking send and callback paths, against a
+    local stand-in of the Africastalking API. Not run by default: use
+    ``--test-tags sms_at_benchmark``; sizes can be given through the
+    SMS_AT_BENCHMARK_SIZES environment variable (e.g. 1000,10000). """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.gateway = FakeAfricastalkingGateway()
+        cls.gateway.start()
+        cls.addClassCleanup(cls.gateway.stop)
+
+        cls.company = cls.env.company
+        cls.company.write({
+            'sms_provider': 'africastalking',
+            'sms_at_username': 'benchmark',
+            'sms_at_api_key': 'benchmarkapikey',
+            'sms_at_shortcode': 'ODOO',
+        })
+        cls.env['ir.config_parameter'].sudo().set_param('sms_africastalking.api.url', cls.gateway.url)
+
+    def setUp(self):
+        super().setUp()
+        # callbacks are signed with the url computed from the base url of the company
+        self.env['ir.config_parameter'].sudo().set_param('web.base.url', self.base_url())
+
+    def _benchmark(self, name, size, func):
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            result = func()
+        finally:
+            elapsed = time.perf_counter() - start
+            _current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        _logger.info(
+            "sms_at_benchmark %s n=%s: %.0f msgs/s (%.3fs), peak memory %.1f MiB",
+            name, size, size / elapsed, elapsed, peak / 2 ** 20,
+        )
+        return result
+
+    def _create_sms(self, size, with_tracker=False):
+        sms = self.env['sms.sms'].create([{
+            'body': 'Benchmark message',
+            'number': f'+2547{index:08d}',
+            'state': 'outgoing',
+            'record_company_id': self.company.id,
+        } for index in range(size)])
+        if with_tracker:
+            self.env['sms.tracker'].create([{'sms_uuid': uuid} for uuid in sms.mapped('uuid')])
+        return sms
+
+    def test_send_sms_batch(self):
+        for size in BENCHMARK_SIZES:
+            with self.subTest(size=size):
+                messages = [{
+                    'content': 'Benchmark message',
+                    'numbers': [{'uuid': uuid4().hex, 'number': f'+2547{index:08d}'} for index in range(size)],
+                }]
+                sms_api = SmsApiAfricastalking(self.env)
+                sms_api._set_company(self.company)
+                results = self._benchmark('_send_sms_batch', size, lambda: sms_api._send_sms_batch(messages))
+                self.assertEqual(len(results), size)
+                self.assertTrue(all(result['state'] == 'sent' for result in results))
+
+    def test_split_by_api(self):
+        for size in BENCHMARK_SIZES:
+            with self.subTest(size=size):
+                sms = self._create_sms(size)
+                sms.invalidate_recordset()
+                splits = self._benchmark('_split_by_api', size, lambda: list(sms._split_by_api()))
+                self.assertEqual(sum(len(split_sms) for _sms_api, split_sms in splits), size)
+
+    def test_handle_call_result_hook(self):
+        for size in BENCHMARK_SIZES:
+            with self.subTest(size=size):
+                sms = self._create_sms(size, with_tracker=True)
+                results = [{
+                    'uuid': uuid,
+                    'state': 'sent',
+                    'sms_at_sid': f'ATXid_{uuid}',
+                    'failure_type': False,
+                    'failure_reason': False,
+                } for uuid in sms.mapped('uuid')]
+                sms.invalidate_recordset()
+                self._benchmark('_handle_call_result_hook', size, lambda: sms._handle_call_result_hook(results))
+                self.assertEqual(sms[-1:].sms_tracker_id.sms_at_sid, results[-1]['sms_at_sid'])
+
+    def test_status_callbacks(self):
+        for size in BENCHMARK_SIZES:
+            with self.subTest(size=size):
+                sms = self._create_sms(size, with_tracker=True)
+                status_codes = self._benchmark('status callbacks', size, lambda: self.gateway.post_status_callbacks(
+                    self.base_url(), sms.mapped('uuid'), self.company.sms_at_api_key,
+                ))
+                self.assertEqual(set(status_codes), {200})
@@ -0,0 +1,144 @@
+from odoo.tests import HttpCase, tagged
+
+from .common import FakeAfricastalkingGateway
+
+
+@tagged('post_install', '-at_install', 'sms_africastalking')
+class TestSmsAtCallbacks(HttpCase):
+    """ Status callbacks, delivery reports, inbound sms and metrics endpoints """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.gateway = FakeAfricastalkingGateway()
+        cls.gateway.start()
+        cls.addClassCleanup(cls.gateway.stop)
+
+        cls.company = cls.env.company
+        cls.company.write({
+            'sms_provider': 'africastalking',
+            'sms_at_username': 'callbacks',
+            'sms_at_api_key': 'callbacksapikey',
+            'sms_at_shortcode': '20880',
+        })
+        cls.ICP = cls.env['ir.config_parameter'].sudo()
+        cls.partner = cls.env['res.partner'].create({'name': 'Callback Partner', 'phone': '+254711000001'})
+
+    def setUp(self):
+        super().setUp()
+        # callbacks are signed with the url computed from the base url of the company
+        self.ICP.set_param('web.base.url', self.base_url())
+        self.gateway.sent = []
+
+    def _create_tracked_sms(self, count=1, sms_at_sid=None):
+        message = self.partner.message_post(body='Tracked', message_type='sms')
+        sms = self.env['sms.sms'].create([{
+            'number': self.partner.phone,
+            'body': 'Tracked',
+            'state': 'pending',
+            'partner_id': self.partner.id,
+            'mail_message_id': message.id,
+        } for _index in range(count)])
+        notifications = self.env['mail.notification'].create([{
+            'mail_message_id': message.id,
+            'res_partner_id': self.partner.id,
+            'notification_type': 'sms',
+            'notification_status': 'pending',
+        } for _index in range(count)])
+        self.env['sms.tracker'].create([{
+            'sms_uuid': uuid,
+            'sms_at_sid': sms_at_sid,
+            'mail_notification_id': notification.id,
+        } for uuid, notification in zip(sms.mapped('uuid'), notifications)])
+        return sms, notifications
+
+    def _url_open(self, url, **kwargs):
+        # the requests are served by another cursor of the test transaction
+        self.env.flush_all()
+        response = self.url_open(url, **kwargs)
+        self.env.invalidate_all()
+        return response
+
+    def test_status_callback_buffered(self):
+        """ In buffered mode, callbacks are only stored, and applied in batch by the drain cron """
+        self.ICP.set_param('sms_africastalking.status.buffered', True)
+        sms, notifications = self._create_tracked_sms(count=2)
+        self.env.flush_all()
+
+        status_codes = self.gateway.post_status_callbacks(self.base_url(), sms.mapped('uuid'), self.company.sms_at_api_key)
+        self.env.invalidate_all()
+        self.assertEqual(status_codes, [200, 200])
+        reports = self.env['sms.africastalking.report'].search([('sms_uuid', 'in', sms.mapped('uuid'))])
+        self.assertEqual(len(reports), 2)
+        self.assertEqual(set(notifications.mapped('notification_status')), {'pending'})
+
+        self.env['sms.africastalking.report']._cron_apply_reports()
+        self.assertEqual(set(notifications.mapped('notification_status')), {'sent'})
+        self.assertTrue(all(sms.mapped('to_delete')))
+        self.assertFalse(reports.exists())
+
+    def test_status_callback_signature(self):
+        sms, notifications = self._create_tracked_sms()
+        self.env.flush_all()
+        self.assertEqual(self.gateway.post_status_callbacks(self.base_url(), sms.mapped('uuid'), 'wrongapikey'), [404])
+        self.assertEqual(self.gateway.post_status_callbacks(self.base_url(), ['0' * 32], self.company.sms_at_api_key), [404])
+        self.assertEqual(self.gateway.post_status_callbacks(self.base_url(), sms.mapped('uuid'), self.company.sms_at_api_key), [200])
+        self.env.invalidate_all()
+        self.assertEqual(notifications.notification_status, 'sent')
+        self.assertTrue(sms.to_delete)
+
+    def test_delivery_report_token(self):
+        """ Native delivery reports are refused without the report token, then applied on their messageId """
+        sms, notifications = self._create_tracked_sms(sms_at_sid='ATXid_report')
+        self.gateway.sent = [('ATXid_report', self.partner.phone), ('ATXid_unknown', self.partner.phone)]
+        self.env.flush_all()
+        self.assertEqual(self.gateway.post_delivery_reports(self.base_url(), 'reporttoken'), [404, 404], "No token configured")
+
+        self.ICP.set_param('sms_africastalking.report.token', 'reporttoken')
+        self.env.flush_all()
+        self.assertEqual(self.gateway.post_delivery_reports(self.base_url(), 'wrongtoken'), [404, 404])
+        self.assertEqual(self.gateway.post_delivery_reports(self.base_url(), 'reporttoken'), [200, 404])
+        self.env.invalidate_all()
+        self.assertEqual(notifications.notification_status, 'sent')
+        self.assertTrue(sms.to_delete)
+
+    def test_inbound(self):
+        """ Inbound sms are stored once per Africastalking id, the cron links their partner and applies the opt-outs """
+        self.ICP.set_param('sms_africastalking.inbound.token', 'inboundtoken')
+        post = {'id': 'inbound_1', 'from': self.partner.phone, 'to': '20880', 'text': 'STOP', 'date': '2026-01-01 10:00:00'}
+        for token, data in [
+            ('wrongtoken', post),
+            ('inboundtoken', dict(post, to='')),
+            ('inboundtoken', dict(post, to='30880')),
+        ]:
+            with self.subTest(token=token, to=data['to']):
+                response = self._url_open(f'/sms_africastalking/inbound?token={token}', data=data)
+                self.assertEqual(response.status_code, 404)
+        Inbound = self.env['sms.africastalking.inbound']
+        self.assertFalse(Inbound.search([('sms_at_id', '=', 'inbound_1')]))
+
+        for data in (post, post, dict(post, id='inbound_2', text='Hello')):
+            response = self._url_open('/sms_africastalking/inbound?token=inboundtoken', data=data)
+            self.assertEqual(response.status_code, 200)
+        inbounds = Inbound.search([('sms_at_id', 'in', ['inbound_1', 'inbound_2'])], order='id')
+        self.assertEqual(len(inbounds), 2, "Retried deliveries are stored once")
+        self.assertEqual(inbounds.company_id, self.company)
+        self.assertEqual(set(inbounds.mapped('state')), {'new'})
+
+        Inbound._cron_process_inbound()
+        self.assertEqual(set(inbounds.mapped('state')), {'processed'})
+        self.assertEqual(inbounds.partner_id, self.partner)
+        self.assertEqual(inbounds.mapped('is_opt_out'), [True, False])
+        self.assertTrue(self.env['phone.blacklist'].search([('number', '=', self.partner.phone)]))
+
+    def test_metrics_endpoint(self):
+        self.env['sms.sms'].create({'number': self.partner.phone, 'body': 'Queued', 'state': 'outgoing', 'sms_at_priority': 'otp'})
+        self.assertEqual(self._url_open('/sms_africastalking/metrics').status_code, 404, "No token configured")
+
+        self.ICP.set_param('sms_africastalking.metrics.token', 'metricstoken')
+        response = self._url_open('/sms_africastalking/metrics', headers={'Authorization': 'Bearer wrongtoken'})
+        self.assertEqual(response.status_code, 404)
+        response = self._url_open('/sms_africastalking/metrics', headers={'Authorization': 'Bearer metricstoken'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('sms_at_queue_depth{lane="otp"}', response.text)
+        self.assertIn('sms_at_queue_oldest_seconds{lane="otp"}', response.text)
@@ -0,0 +1,78 @@
+from odoo.tests import TransactionCase, tagged
+
+
+@tagged('sms_africastalking')
+class TestSmsAtComposer(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.env.company.write({
+            'sms_provider': 'africastalking',
+            'sms_at_username': 'test',
+            'sms_at_api_key': 'testapikey',
+            'sms_at_shortcode': 'ODOO',
+        })
+        cls.ICP = cls.env['ir.config_parameter'].sudo()
+        cls.ICP.set_param('sms_africastalking.composer.stream.threshold', 1)
+        cls.ICP.set_param('sms_africastalking.composer.stream.chunk.size', 2)
+
+    def _create_partners(self, phones):
+        return self.env['res.partner'].create([
+            {'name': f'Partner {index}', 'phone': phone}
+            for index, phone in enumerate(phones)
+        ])
+
+    def _get_composer(self, partners, body='Hello'):
+        return self.env['sms.composer'].create({
+            'body': body,
+            'composition_mode': 'mass',
+            'res_model': 'res.partner',
+            'res_ids': repr(partners.ids),
+        })
+
+    def _get_sms(self, partners, body='Hello'):
+        return self.env['sms.sms'].search([('partner_id', 'in', partners.ids), ('body', '=', body)])
+
+    def test_stream_duplicates_across_chunks(self):
+        """ A number of a previous chunk is a duplicate, as within a chunk """
+        partners = self._create_partners(['+254711000001', '+254711000002', '+254711000001', '+254711000003'])
+        self._get_composer(partners)._action_send_sms_mass()
+
+        sms_by_partner = self._get_sms(partners).grouped('partner_id')
+        self.assertEqual(len(sms_by_partner), 4)
+        self.assertEqual([sms_by_partner[partner].state for partner in partners], ['outgoing', 'outgoing', 'canceled', 'outgoing'])
+        self.assertEqual(sms_by_partner[partners[2]].failure_type, 'sms_duplicate')
+
+    def test_stream_resume(self):
+        """ Sending the same records again resumes after the last committed chunk, the numbers
+        of the chunks sent before still being duplicates """
+        partners = self._create_partners(['+254711000001', '+254711000002', '+254711000001', '+254711000003'])
+        composer = self._get_composer(partners, body='Resumed')
+        stream = self.env['sms.africastalking.stream'].create({
+            'key': composer._at_get_stream_key(partners.ids),
+            'res_model': 'res.partner',
+            'last_record_id': partners[1].id,
+        })
+        composer._action_send_sms_mass()
+
+        sms_by_partner = self._get_sms(partners, body='Resumed').grouped('partner_id')
+        self.assertEqual(list(sms_by_partner), list(partners[2:]), "The first chunk is not sent again")
+        self.assertEqual(sms_by_partner[partners[2]].failure_type, 'sms_duplicate')
+        self.assertEqual(sms_by_partner[partners[3]].state, 'outgoing')
+        self.assertFalse(stream.exists(), "Removed once the sending is complete")
+
+    def test_stream_resume_window(self):
+        """ A stream not updated within the resume window is sent again from the start """
+        partners = self._create_partners(['+254711000001', '+254711000002', '+254711000003'])
+        composer = self._get_composer(partners, body='Sent again')
+        stream = self.env['sms.africastalking.stream'].create({
+            'key': composer._at_get_stream_key(partners.ids),
+            'res_model': 'res.partner',
+            'last_record_id': partners[1].id,
+        })
+        stream.flush_recordset()
+        self.env.cr.execute("UPDATE sms_africastalking_stream SET write_date = write_date - interval '2 days' WHERE id = %s", [stream.id])
+        stream.invalidate_recordset()
+        composer._action_send_sms_mass()
+        self.assertEqual(len(self._get_sms(partners, body='Sent again')), 3)
@@ -0,0 +1,185 @@
+import asyncio
+from datetime import timedelta
+from unittest import skipIf
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.tests import HttpCase, tagged
+
+from odoo.addons.sms_africastalking.tools.sms_api import SmsApiAfricastalking
+from odoo.addons.sms_africastalking.tools.sms_at_dedup import RecentSendIndex, recent_sends
+from odoo.addons.sms_africastalking.tools.sms_at_dispatcher import SmsAtDispatcher, aiohttp
+from .common import FakeAfricastalkingGateway
+
+
+@tagged('post_install', '-at_install', 'sms_africastalking')
+class TestSmsAtQueue(HttpCase):
+    """ Streamed send batches and standalone dispatcher, against a local stand-in of the
+    Africastalking API. Both commit through their own cursors, which are test cursors
+    of the current transaction in an HttpCase. """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.gateway = FakeAfricastalkingGateway()
+        cls.gateway.start()
+        cls.addClassCleanup(cls.gateway.stop)
+
+        cls.company = cls.env.company
+        cls.company.write({
+            'sms_provider': 'africastalking',
+            'sms_at_username': 'queue',
+            'sms_at_api_key': 'queueapikey',
+            'sms_at_shortcode': 'ODOO',
+        })
+        cls.ICP = cls.env['ir.config_parameter'].sudo()
+        cls.ICP.set_param('sms_africastalking.api.url', cls.gateway.url)
+        cls.ICP.set_param('sms_africastalking.send.recipients_per_request', 2)
+
+    def setUp(self):
+        super().setUp()
+        self.env['sms.sms'].search([]).unlink()
+        self.gateway.sent = []
+
+    def _create_sms(self, count, with_tracker=True, **values):
+        sms = self.env['sms.sms'].create([{
+            'number': f'+2547110000{index:02d}',
+            'body': 'Queued',
+            'state': 'outgoing',
+            'record_company_id': self.company.id,
+            **values,
+        } for index in range(count)])
+        if with_tracker:
+            self.env['sms.tracker'].create([{'sms_uuid': uuid} for uuid in sms.mapped('uuid')])
+        return sms
+
+    def _patch_flush_results(self):
+        return patch.object(
+            SmsApiAfricastalking, '_at_flush_results', autospec=True, side_effect=SmsApiAfricastalking._at_flush_results,
+        )
+
+    # ------------------------------------------------------------
+    # STREAMED RESULTS
+    # ------------------------------------------------------------
+
+    def test_send_streamed_by_size(self):
+        """ Results are applied every ``stream_size`` results, the remaining ones at the end of the batch """
+        self.ICP.set_param('sms_africastalking.send.stream_size', 2)
+        self.ICP.set_param('sms_africastalking.send.stream_interval', 1000)
+        sms = self._create_sms(5)
+        with self._patch_flush_results() as flush_results:
+            sms.send(auto_commit=True)
+
+        # 3 requests of 2, 2 and 1 recipients: the last one is applied with the batch
+        self.assertEqual(flush_results.call_count, 2)
+        self.assertEqual([len(call.args[1]) for call in flush_results.call_args_list], [2, 2])
+        self.assertEqual(len(self.gateway.sent), 5)
+        self.assertEqual(set(sms.mapped('state')), {'pending'})
+        self.assertTrue(all(sms.mapped('to_delete')))
+        self.assertEqual(
+            set(sms.sms_tracker_id.mapped('sms_at_sid')), {message_id for message_id, _number in self.gateway.sent},
+        )
+        self.assertEqual(len(self.env['sms.africastalking.journal']._get_journaled_results(sms.mapped('uuid'))), 5)
+
+    def test_send_streamed_by_interval(self):
+        """ Results are also applied once ``stream_interval`` seconds passed since the previous flush """
+        self.ICP.set_param('sms_africastalking.send.stream_size', 1000)
+        self.ICP.set_param('sms_africastalking.send.stream_interval', 0)
+        sms = self._create_sms(5)
+        with self._patch_flush_results() as flush_results:
+            sms.send(auto_commit=True)
+
+        self.assertEqual(flush_results.call_count, 3)
+        self.assertEqual(set(sms.mapped('state')), {'pending'})
+        self.assertTrue(all(sms.sms_tracker_id.mapped('sms_at_sid')))
+
+    def test_send_not_streamed(self):
+        """ Without ``stream_size``, results are applied with the batch """
+        self.ICP.set_param('sms_africastalking.send.stream_size', 0)
+        sms = self._create_sms(3)
+        with self._patch_flush_results() as flush_results:
+            sms.send()
+        self.assertFalse(flush_results.called)
+        self.assertEqual(set(sms.mapped('state')), {'pending'})
+
+    # ------------------------------------------------------------
+    # DISPATCHER
+    # ------------------------------------------------------------
+
+    def _dispatch(self, dispatcher, jobs):
+        """ Send ``jobs`` the way ``SmsAtDispatcher.run`` does, and apply their results """
+        async def send_jobs():
+            results = asyncio.Queue()
+            async with aiohttp.ClientSession() as http:
+                for job in jobs:
+                    await dispatcher._send(http, job, results)
+            return [results.get_nowait() for _index in range(results.qsize())]
+
+        dispatcher._apply_results(asyncio.run(send_jobs()))
+        self.env.invalidate_all()
+
+    def _claim_jobs(self, dispatcher):
+        self.env.flush_all()
+        jobs = dispatcher._claim_jobs()
+        self.env.invalidate_all()
+        return jobs
+
+    @skipIf(aiohttp is None, "aiohttp is not installed")
+    def test_dispatcher_send(self):
+        """ Due sms of Africastalking companies are claimed, sent, journaled and applied """
+        self.ICP.set_param('sms_africastalking.dedup.window', 60)
+        sms = self._create_sms(3)
+        not_due = self._create_sms(1, sms_at_next_attempt=fields.Datetime.now() + timedelta(hours=1))
+        other_company = self.env['res.company'].create({'name': 'Other Provider'})
+        other_sms = self._create_sms(1, record_company_id=other_company.id)
+        dispatcher = SmsAtDispatcher(self.env.cr.dbname, claim_size=10)
+
+        jobs = self._claim_jobs(dispatcher)
+        self.assertEqual(len(jobs), 2, "3 sms in requests of 2 recipients")
+        self.assertEqual({info['uuid'] for job in jobs for info in job['number_infos']}, set(sms.mapped('uuid')))
+        self.assertEqual(set(sms.mapped('state')), {'process'})
+        self.assertTrue(all(sms.mapped('sms_at_claimed_at')))
+        self.assertEqual((not_due + other_sms).mapped('state'), ['outgoing', 'outgoing'])
+        self.assertFalse(self._claim_jobs(dispatcher), "Claimed sms are not claimed again")
+
+        self._dispatch(dispatcher, jobs)
+        self.assertEqual(len(self.gateway.sent), 3)
+        self.assertEqual(set(sms.mapped('state')), {'pending'})
+        self.assertTrue(all(sms.mapped('to_delete')))
+        self.assertTrue(all(sms.sms_tracker_id.mapped('sms_at_sid')))
+        self.assertEqual(len(self.env['sms.africastalking.journal']._get_journaled_results(sms.mapped('uuid'))), 3)
+        self.assertTrue(recent_sends.seen(RecentSendIndex.make_key(self.company._get_sms_at_account(), sms[0].number, 'Queued'), 60),
+                        "Sent sms are registered for the deduplication")
+
+    @skipIf(aiohttp is None, "aiohttp is not installed")
+    def test_dispatcher_release_expired_claims(self):
+        """ Claims older than the lease are put back in the queue, the other ones are kept """
+        sms = self._create_sms(2, with_tracker=False)
+        dispatcher = SmsAtDispatcher(self.env.cr.dbname, claim_size=10, lease_timeout=600)
+        self._claim_jobs(dispatcher)
+        self.env.cr.execute(
+            "UPDATE sms_sms SET sms_at_claimed_at = sms_at_claimed_at - interval '1 hour' WHERE id = %s", [sms[0].id],
+        )
+
+        dispatcher._release_expired_claims()
+        self.env.invalidate_all()
+        self.assertEqual(sms.mapped('state'), ['outgoing', 'process'])
+        self.assertFalse(sms[0].sms_at_claimed_at)
+        self.assertTrue(sms[1].sms_at_claimed_at)
+
+    @skipIf(aiohttp is None, "aiohttp is not installed")
+    def test_dispatcher_renew_claims(self):
+        """ Only the sms still claimed by a job, and not accepted yet, are sent after a renewal """
+        sms = self._create_sms(3, with_tracker=False)
+        self.ICP.set_param('sms_africastalking.send.recipients_per_request', 3)
+        dispatcher = SmsAtDispatcher(self.env.cr.dbname, claim_size=10)
+        [job] = self._claim_jobs(dispatcher)
+
+        # released then claimed again by another run, and accepted by a previous run
+        self.env.cr.execute(
+            "UPDATE sms_sms SET sms_at_claimed_at = sms_at_claimed_at + interval '1 second' WHERE id = %s", [sms[0].id],
+        )
+        self.env['sms.africastalking.journal']._add_to_journal([{'uuid': sms[1].uuid, 'state': 'sent'}])
+
+        number_infos = dispatcher._renew_claims(job)
+        self.assertEqual([info['uuid'] for info in number_infos], [sms[2].uuid])
@@ -0,0 +1,379 @@
+from datetime import timedelta
+
+from odoo import fields
+from odoo.tests import TransactionCase, tagged
+
+from odoo.addons.sms_africastalking.tools.sms_api import SmsApiAfricastalking, _at_update_breaker
+from odoo.addons.sms_africastalking.tools.sms_at_batching import batch_sizers
+from odoo.addons.sms_africastalking.tools.sms_at_client import AfricastalkingClientError
+from odoo.addons.sms_africastalking.tools.sms_at_throttle import CircuitBreaker
+
+
+@tagged('sms_africastalking')
+class TestSmsAtSend(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.company = cls.env.company
+        cls.company.write({
+            'sms_provider': 'africastalking',
+            'sms_at_username': 'test',
+            'sms_at_api_key': 'testapikey',
+            'sms_at_shortcode': 'ODOO',
+        })
+        cls.ICP = cls.env['ir.config_parameter'].sudo()
+
+    def _get_sms_api(self):
+        sms_api = SmsApiAfricastalking(self.env)
+        sms_api._set_company(self.company)
+        return sms_api
+
+    def _make_response(self, recipients, message='Sent'):
+        return {'SMSMessageData': {'Message': message, 'Recipients': recipients}}
+
+    def _make_recipient(self, number, status_code=101, message_id='None', cost='KES 0.8000'):
+        return {'statusCode': status_code, 'number': number, 'status': 'Success', 'cost': cost, 'messageId': message_id}
+
+    # ------------------------------------------------------------
+    # RESPONSES
+    # ------------------------------------------------------------
+
+    def test_prepare_results_number_mapping(self):
+        """ Recipients are matched on the digits of their number, whatever their order """
+        sms_api = self._get_sms_api()
+        number_infos = [
+            {'uuid': 'uuid1', 'number': '+254711000001'},
+            {'uuid': 'uuid2', 'number': '+254711000002'},
+            {'uuid': 'uuid3', 'number': '+254711000003'},
+        ]
+        response = sms_api._at_process_send_response(self._make_response([
+            self._make_recipient('+254711000002', message_id='ATXid_2'),
+            self._make_recipient('254711000003', status_code=403, cost='0'),
+            self._make_recipient('+254711000001', message_id='ATXid_1'),
+        ]), None)
+        results = sms_api._at_prepare_results(number_infos, response, sender='ODOO')
+
+        self.assertEqual([result['uuid'] for result in results], ['uuid1', 'uuid2', 'uuid3'])
+        self.assertEqual([result['state'] for result in results], ['sent', 'sent', 'at_invalid_phone_number'])
+        self.assertEqual([result.get('sms_at_sid') for result in results], ['ATXid_1', 'ATXid_2', None])
+        self.assertEqual(results[0]['cost'], 0.8)
+        self.assertEqual(results[0]['currency_code'], 'KES')
+        self.assertEqual(results[0]['sender'], 'ODOO')
+
+    def test_prepare_results_positional_fallback(self):
+        """ Recipients whose number cannot be matched are paired by position, the missing ones fail """
+        sms_api = self._get_sms_api()
+        number_infos = [{'uuid': 'uuid1', 'number': '+254711000001'}, {'uuid': 'uuid2', 'number': '+254711000002'}]
+        response = sms_api._at_process_send_response(self._make_response([
+            self._make_recipient('0711000001', message_id='ATXid_1'),
+        ]), None)
+        results = sms_api._at_prepare_results(number_infos, response, enqueued=True)
+        self.assertEqual(results[0]['state'], 'processing', "Enqueued sms are processing until their report")
+        self.assertEqual(results[0]['sms_at_sid'], 'ATXid_1')
+        self.assertEqual(results[1]['state'], 'at_gateway_error')
+
+    def test_prepare_results_errors(self):
+        sms_api = self._get_sms_api()
+        number_infos = [{'uuid': 'uuid1', 'number': '+254711000001'}]
+        for error, response, expected_state in [
+            (AfricastalkingClientError('Connection reset'), None, 'at_gateway_error'),
+            (AfricastalkingClientError('Bad Gateway', 502), None, 'at_gateway_error'),
+            (AfricastalkingClientError('The supplied authentication is invalid', 401), None, 'at_authentication'),
+            (AfricastalkingClientError('Forbidden', 403), None, 'at_authentication'),
+            (AfricastalkingClientError('Bad Request', 400), None, 'unknown'),
+            (AfricastalkingClientError('<html>Accepted</html>', 201), None, 'sent'),
+            (None, self._make_response([], message='InvalidSenderId'), 'at_invalid_sender_id'),
+            (None, {}, 'at_gateway_error'),
+        ]:
+            with self.subTest(error=error, response=response):
+                results = sms_api._at_prepare_results(number_infos, sms_api._at_process_send_response(response, error))
+                self.assertEqual(results[0]['state'], expected_state)
+
+    def test_breaker_counts_gateway_errors_only(self):
+        breaker = CircuitBreaker(failure_threshold=2)
+        for _index in range(3):
+            _at_update_breaker(breaker, None, AfricastalkingClientError('Unauthorized', 401))
+        _at_update_breaker(breaker, None, AfricastalkingClientError('<html>Accepted</html>', 201))
+        self.assertFalse(breaker.is_open(), "Rejected or accepted requests are not gateway failures")
+        _at_update_breaker(breaker, None, AfricastalkingClientError('Service Unavailable', 503))
+        _at_update_breaker(breaker, None, AfricastalkingClientError('Connection reset'))
+        self.assertTrue(breaker.is_open())
+        self.assertEqual(breaker.reason, breaker.REASON_GATEWAY)
+
+        breaker = CircuitBreaker()
+        _at_update_breaker(breaker, self._make_response([self._make_recipient('+254711000001', status_code=405)]), None)
+        self.assertEqual(breaker.reason, breaker.REASON_BALANCE)
+
+    def test_breaker_min_balance(self):
+        """ The breaker only closes once the balance covers one message """
+        sms_api = self._get_sms_api()
+        breaker = sms_api._get_at_circuit_breaker()
+        self.addCleanup(breaker.close)
+        self.addCleanup(setattr, breaker, 'balance_checked_at', None)
+        self.ICP.set_param('sms_africastalking.breaker.cooldown', 0)
+        self.ICP.set_param('sms_africastalking.price_table', '{"254": 0.8, "256": 25}')
+        breaker.trip(breaker.REASON_BALANCE)
+        breaker.set_balance(10.0)
+        self.assertFalse(sms_api._at_is_sending_allowed(), "Below the price of one segment to the most expensive prefix")
+        self.assertTrue(breaker.is_open())
+        self.ICP.set_param('sms_africastalking.balance.min', 5)
+        self.assertTrue(sms_api._at_is_sending_allowed())
+        self.assertFalse(breaker.is_open())
+
+    def test_insufficient_balance_deferred(self):
+        """ Sms rejected for an insufficient balance stay queued until the end of the cooldown """
+        breaker = self._get_sms_api()._get_at_circuit_breaker()
+        self.addCleanup(breaker.close)
+        breaker.trip(breaker.REASON_BALANCE)
+        sms = self.env['sms.sms'].create({'number': '+254711000001', 'body': 'Hello', 'state': 'process'})
+        sms._postprocess_iap_sent_sms([{
+            'uuid': sms.uuid, 'state': 'at_insufficient_balance', 'failure_type': 'at_insufficient_balance',
+        }])
+        self.assertEqual(sms.state, 'outgoing')
+        self.assertFalse(sms.failure_type)
+        self.assertGreater(sms.sms_at_next_attempt, fields.Datetime.now())
+
+    # ------------------------------------------------------------
+    # REQUESTS
+    # ------------------------------------------------------------
+
+    def test_prepare_send_requests(self):
+        """ Invalid numbers and duplicates are not sent, even without shortcode """
+        self.company.sms_at_shortcode = False
+        self.ICP.set_param('sms_africastalking.dedup.window', 60)
+        send_requests, rejected_results = self._get_sms_api()._at_prepare_send_requests([{
+            'content': 'Hello',
+            'numbers': [
+                {'uuid': 'uuid1', 'number': '+254711000001'},
+                {'uuid': 'uuid2', 'number': '+254 711 000 001'},
+                {'uuid': 'uuid3', 'number': 'not a number'},
+                {'uuid': 'uuid4', 'number': '+254711000002'},
+            ],
+        }])
+        self.assertEqual(len(send_requests), 1)
+        body, sender, number_infos = send_requests[0]
+        self.assertEqual((body, sender), ('Hello', False))
+        self.assertEqual(number_infos, [{'uuid': 'uuid1', 'number': '+254711000001'}, {'uuid': 'uuid4', 'number': '+254711000002'}])
+        self.assertEqual(rejected_results['uuid2']['state'], 'at_duplicate')
+        self.assertEqual(rejected_results['uuid3']['state'], 'at_invalid_phone_number')
+
+    def test_prepare_send_requests_routing(self):
+        """ Numbers are sent from the sender of their route, the senders taking turns """
+        self.env['sms.africastalking.route'].create([
+            {'company_id': self.company.id, 'prefix': '254', 'sender': 'KE'},
+            {'company_id': self.company.id, 'prefix': '256', 'sender': 'UG'},
+        ])
+        self.ICP.set_param('sms_africastalking.send.recipients_per_request', 1)
+        send_requests, _rejected_results = self._get_sms_api()._at_prepare_send_requests([{
+            'content': 'Hello',
+            'numbers': [
+                {'uuid': 'uuid1', 'number': '+254711000001'},
+                {'uuid': 'uuid2', 'number': '+254711000002'},
+                {'uuid': 'uuid3', 'number': '+254711000003'},
+                {'uuid': 'uuid4', 'number': '+256772123456'},
+                {'uuid': 'uuid5', 'number': '+255712345678'},
+            ],
+        }])
+        self.assertEqual([sender for _body, sender, _number_infos in send_requests], ['KE', 'UG', 'ODOO', 'KE', 'KE'])
+
+    def test_register_sent(self):
+        """ Accepted numbers are duplicates within the deduplication window, the failed ones are not """
+        self.ICP.set_param('sms_africastalking.dedup.window', 60)
+        sms_api = self._get_sms_api()
+        sms_api._at_register_sent(
+            [('Registered', 'ODOO', [{'uuid': 'uuid1', 'number': '+254711000011'}, {'uuid': 'uuid2', 'number': '+254711000012'}])],
+            {'uuid1': {'uuid': 'uuid1', 'state': 'sent'}, 'uuid2': {'uuid': 'uuid2', 'state': 'at_gateway_error'}},
+        )
+        _send_requests, rejected_results = sms_api._at_prepare_send_requests([{
+            'content': 'Registered',
+            'numbers': [{'uuid': 'uuid3', 'number': '+254711000011'}, {'uuid': 'uuid4', 'number': '+254711000012'}],
+        }])
+        self.assertEqual(list(rejected_results), ['uuid3'])
+        self.assertEqual(rejected_results['uuid3']['state'], 'at_duplicate')
+
+    def test_journal_replay(self):
+        """ Sms journaled as accepted are not sent again, their journaled result is used """
+        self.env['sms.africastalking.journal']._add_to_journal([{
+            'uuid': 'uuid1', 'state': 'sent', 'sms_at_sid': 'ATXid_1', 'sender': 'ODOO', 'cost': 0.8, 'currency_code': 'KES',
+        }])
+        send_requests, rejected_results = self._get_sms_api()._at_prepare_send_requests([{
+            'content': 'Hello',
+            'numbers': [{'uuid': 'uuid1', 'number': '+254711000001'}, {'uuid': 'uuid2', 'number': '+254711000002'}],
+        }])
+        self.assertEqual([info['uuid'] for _body, _sender, number_infos in send_requests for info in number_infos], ['uuid2'])
+        self.assertEqual(rejected_results['uuid1']['state'], 'sent')
+        self.assertEqual(rejected_results['uuid1']['sms_at_sid'], 'ATXid_1')
+        self.assertEqual(rejected_results['uuid1']['sender'], 'ODOO')
+        self.assertEqual(rejected_results['uuid1']['cost'], 0.8)
+
+    # ------------------------------------------------------------
+    # QUEUE
+    # ------------------------------------------------------------
+
+    def test_schedule_retries(self):
+        self.ICP.set_param('sms_africastalking.retry.max_attempts', 3)
+        self.ICP.set_param('sms_africastalking.retry.base_delay', 60)
+        sms = self.env['sms.sms'].create([{
+            'number': '+254711000001',
+            'body': 'Hello',
+            'state': 'process',
+            'sms_at_attempt_count': attempt_count,
+        } for attempt_count in (0, 0, 1, 2)])
+        now = fields.Datetime.now()
+
+        retried_uuids = sms._at_schedule_retries(sms.mapped('uuid'))
+        self.assertEqual(retried_uuids, set(sms[:3].mapped('uuid')))
+        self.assertEqual(sms[:3].mapped('sms_at_attempt_count'), [1, 1, 2])
+        self.assertEqual(set(sms[:3].mapped('state')), {'outgoing'})
+        for retried_sms, max_delay in zip(sms[:3], (60, 60, 120)):
+            self.assertTrue(now <= retried_sms.sms_at_next_attempt <= now + timedelta(seconds=max_delay + 1))
+        self.assertEqual(sms[3].sms_at_attempt_count, 2, "Maximum number of attempts reached")
+        self.assertEqual(sms[3].state, 'process')
+        self.assertFalse(sms[3].sms_at_next_attempt)
+        self.assertTrue(self.env['ir.cron.trigger'].search_count([
+            ('cron_id', '=', self.env.ref('sms.ir_cron_sms_scheduler_action').id),
+            ('call_at', '=', min(sms[:3].mapped('sms_at_next_attempt'))),
+        ]), "The queue runs when the first retry is due")
+
+    def test_queue_ids(self):
+        """ Due sms are taken lane by lane, within the capacity of each lane """
+        self.env['sms.sms'].search([]).unlink()
+        self.ICP.set_param('sms_africastalking.queue.limit', 5)
+        self.ICP.set_param('sms_africastalking.lanes.capacity', 'otp:2,transactional:2')
+        sms_by_lane = {
+            lane: self.env['sms.sms'].create([{
+                'number': '+254711000001', 'body': 'Hello', 'state': 'outgoing', 'sms_at_priority': lane,
+            } for _index in range(3)])
+            for lane in ('bulk', 'transactional', 'otp')
+        }
+        self.env['sms.sms'].create([
+            {'number': '+254711000001', 'body': 'Not due', 'state': 'outgoing', 'sms_at_priority': 'otp',
+             'sms_at_next_attempt': fields.Datetime.now() + timedelta(hours=1)},
+            {'number': '+254711000001', 'body': 'Deleted', 'state': 'outgoing', 'sms_at_priority': 'otp', 'to_delete': True},
+            {'number': '+254711000001', 'body': 'Sent', 'state': 'sent', 'sms_at_priority': 'otp'},
+        ])
+
+        self.assertEqual(
+            self.env['sms.sms']._at_get_queue_ids(),
+            sms_by_lane['otp'][:2].ids + sms_by_lane['transactional'][:2].ids + sms_by_lane['bulk'][:1].ids,
+        )
+
+        self.ICP.set_param('sms_africastalking.queue.limit', 100)
+        self.assertEqual(len(self.env['sms.sms']._at_get_queue_ids()), 7, "Bulk gets what the other lanes left")
+
+    def test_queue_ids_dispatcher(self):
+        """ With the dispatcher, queue runs only take the sms of the other providers """
+        self.env['sms.sms'].search([]).unlink()
+        other_company = self.env['res.company'].create({'name': 'Other Provider'})
+        _at_sms, other_sms = self.env['sms.sms'].create([{
+            'number': '+254711000001', 'body': 'Hello', 'state': 'outgoing', 'record_company_id': company.id,
+        } for company in (self.company, other_company)])
+        self.ICP.set_param('sms_africastalking.queue.limit', 1)
+        self.ICP.set_param('sms_africastalking.dispatcher.enabled', True)
+        self.assertEqual(self.env['sms.sms']._at_get_queue_ids(), other_sms.ids)
+
+    def test_batch_size_accounts(self):
+        """ Adaptive batches take the size of the slowest account of their sms """
+        other_company = self.env['res.company'].create({
+            'name': 'Other Account',
+            'sms_provider': 'africastalking',
+            'sms_at_username': 'other',
+            'sms_at_api_key': 'otherapikey',
+        })
+        sms = self.env['sms.sms'].create([{
+            'number': '+254711000001', 'body': 'Hello', 'state': 'outgoing', 'record_company_id': company.id,
+        } for company in (self.company, other_company)])
+        self.ICP.set_param('sms_africastalking.session.batch.adaptive', True)
+        for company, seconds_per_sms in ((self.company, 0.01), (other_company, 0.1)):
+            sizer = batch_sizers.get(company._get_sms_at_account())
+            self.patch(sizer, 'seconds_per_sms', seconds_per_sms)
+            self.patch(sizer, 'error_rate', 0.0)
+            self.patch(sizer, 'size', 1000)
+        # 60s budget at 70%: 4200 sms clamped to 1000 for the first account, 420 for the other one
+        self.assertEqual(sms[0]._get_send_batch_size(), 1000)
+        self.assertEqual(sms._get_send_batch_size(), 420)
+
+    def test_queue_run_time_budget(self):
+        """ Queue runs stop taking batches once the next one would end after their time budget """
+        sms = self.env['sms.sms'].create([{'number': '+254711000001', 'body': 'Hello', 'state': 'outgoing'} for _index in range(25)])
+        self.ICP.set_param('sms_africastalking.session.batch.size', 10)
+        self.ICP.set_param('sms_africastalking.queue.time_budget', 8)
+        self.patch(batch_sizers.get(self.company._get_sms_at_account()), 'seconds_per_sms', 1.0)
+        self.assertEqual(len(list(sms._split_batch())), 3, "Only queue runs have a time budget")
+        self.assertEqual(len(list(sms.with_context(sms_at_due_only=True)._split_batch())), 1, "The first batch is always sent")
+
+    # ------------------------------------------------------------
+    # ROLLUPS / GC
+    # ------------------------------------------------------------
+
+    def test_cost_rollups(self):
+        """ Accepted sms are added to the rollup of their sender and country, with their segments """
+        self.env['sms.africastalking.cost.rollup'].search([]).unlink()
+        sms = self.env['sms.sms'].create([
+            {'number': '+254711000001', 'body': 'Hello', 'state': 'outgoing'},
+            {'number': '+254711000002', 'body': 'a' * 200, 'state': 'outgoing'},
+            {'number': '+256772000003', 'body': 'Hello', 'state': 'outgoing'},
+            {'number': '+254711000004', 'body': 'Hello', 'state': 'outgoing'},
+        ])
+        self.env['sms.tracker'].create([{'sms_uuid': uuid} for uuid in sms.mapped('uuid')])
+        results = [
+            {'uuid': sms[0].uuid, 'state': 'sent', 'sms_at_sid': 'ATXid_1', 'cost': 1.0, 'currency_code': 'KES'},
+            {'uuid': sms[1].uuid, 'state': 'sent', 'sms_at_sid': 'ATXid_2', 'cost': 2.0, 'currency_code': 'KES', 'sender': 'ODOO'},
+            {'uuid': sms[2].uuid, 'state': 'processing', 'sms_at_sid': 'ATXid_3', 'cost': 25.0, 'currency_code': 'UGX', 'sender': 'UG'},
+            {'uuid': sms[3].uuid, 'state': 'at_invalid_phone_number'},
+        ]
+        sms._handle_call_result_hook(results)
+
+        self.assertEqual(sms[1].sms_tracker_id.sms_at_sid, 'ATXid_2')
+        self.assertEqual(sms[1].sms_tracker_id.sms_at_cost, 2.0)
+        rollups = self.env['sms.africastalking.cost.rollup'].search([])
+        self.assertEqual(
+            sorted((rollup.shortcode, rollup.country_prefix, rollup.currency, rollup.sms_count, rollup.segment_count, rollup.cost) for rollup in rollups),
+            [('ODOO', '254', 'KES', 2, 3, 3.0), ('UG', '256', 'UGX', 1, 1, 25.0)],
+        )
+
+        # incremented by the next batches
+        sms[3]._handle_call_result_hook([{'uuid': sms[3].uuid, 'state': 'sent', 'sms_at_sid': 'ATXid_4', 'cost': 1.0, 'currency_code': 'KES'}])
+        rollups.invalidate_recordset()
+        self.assertEqual(sorted(rollups.mapped('sms_count')), [1, 3])
+        self.assertEqual(sorted(rollups.mapped('segment_count')), [1, 4])
+
+    def test_gc(self):
+        """ GC removes the sms to delete, the old journal entries and archives the old trackers in a final state """
+        self.ICP.set_param('sms_africastalking.tracker.retention_days', 1)
+        sms_to_delete, sms_outgoing = self.env['sms.sms'].create([
+            {'number': '+254711000001', 'body': 'Hello', 'state': 'sent', 'to_delete': True},
+            {'number': '+254711000002', 'body': 'Hello', 'state': 'outgoing'},
+        ])
+        journal = self.env['sms.africastalking.journal']
+        journal._add_to_journal([{'uuid': 'old_uuid', 'state': 'sent'}, {'uuid': 'new_uuid', 'state': 'sent'}])
+        self.env.cr.execute("UPDATE sms_africastalking_journal SET accepted_at = accepted_at - interval '3 days' WHERE sms_uuid = 'old_uuid'")
+
+        partner = self.env['res.partner'].create({'name': 'Tracked', 'phone': '+254711000003'})
+        message = partner.message_post(body='Tracked', message_type='sms')
+        notifications = self.env['mail.notification'].create([{
+            'mail_message_id': message.id,
+            'res_partner_id': partner.id,
+            'notification_type': 'sms',
+            'notification_status': status,
+        } for status in ('sent', 'pending')])
+        trackers = self.env['sms.tracker'].create([
+            {'sms_uuid': 'tracker_sent', 'sms_at_sid': 'ATXid_sent', 'mail_notification_id': notifications[0].id},
+            {'sms_uuid': 'tracker_pending', 'mail_notification_id': notifications[1].id},
+            {'sms_uuid': 'tracker_orphan'},
+            {'sms_uuid': 'tracker_recent', 'mail_notification_id': notifications[0].id},
+        ])
+        trackers.flush_recordset()
+        self.env.cr.execute("UPDATE sms_tracker SET create_date = create_date - interval '2 days' WHERE id IN %s", [tuple(trackers[:3].ids)])
+
+        self.env['sms.sms']._cron_at_gc()
+
+        self.assertFalse(sms_to_delete.exists())
+        self.assertTrue(sms_outgoing.exists())
+        self.assertEqual(set(journal._get_journaled_results(['old_uuid', 'new_uuid'])), {'new_uuid'})
+        self.assertEqual(trackers.exists(), trackers[1] + trackers[3], "Recent or not final trackers are kept")
+        archives = self.env['sms.africastalking.tracker.archive'].search([('sms_uuid', 'in', ['tracker_sent', 'tracker_orphan'])])
+        self.assertEqual(len(archives), 2)
+        self.assertEqual(archives.filtered(lambda archive: archive.sms_uuid == 'tracker_sent').sms_at_sid, 'ATXid_sent')
+        self.assertEqual(archives.filtered(lambda archive: archive.sms_uuid == 'tracker_sent').notification_status, 'sent')
@@ -0,0 +1,167 @@
+import json
+import os
+import socket
+import tempfile
+
+from odoo.tests import BaseCase, tagged
+
+from odoo.addons.sms_africastalking.tools.sms_africastalking import normalize_e164
+from odoo.addons.sms_africastalking.tools.sms_at_dedup import RecentSendIndex
+from odoo.addons.sms_africastalking.tools.sms_at_estimate import count_segments, parse_price_table
+from odoo.addons.sms_africastalking.tools.sms_at_lanes import parse_lane_capacities
+from odoo.addons.sms_africastalking.tools.sms_at_metrics import MetricsRegistry
+from odoo.addons.sms_africastalking.tools.sms_at_routing import PrefixTrie
+from odoo.addons.sms_africastalking.tools.sms_at_throttle import TokenBucket, TokenBucketRegistry, compute_backoff
+
+
+@tagged('sms_africastalking')
+class TestSmsAtTools(BaseCase):
+    """ Helpers of the send path that do not need a database """
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(10)
+        self.assertEqual(bucket.capacity, 10)
+        self.assertAlmostEqual(bucket.reserve(5), 0.0)
+        self.assertAlmostEqual(bucket.reserve(5), 0.0, delta=0.01)
+        # no burst left: one token every 1/10s
+        self.assertAlmostEqual(bucket.reserve(1), 0.1, delta=0.01)
+
+    def test_token_bucket_multi_recipient(self):
+        """ Requests of more recipients than the capacity pay for all of them """
+        bucket = TokenBucket(10)
+        delays = [bucket.reserve(100) for _index in range(5)]
+        for delay, expected in zip(delays, (9, 19, 29, 39, 49)):
+            self.assertAlmostEqual(delay, expected, delta=0.1)
+        self.assertAlmostEqual(bucket.get_delay(), 49, delta=0.1, msg="The debt is not consumed again")
+        self.assertAlmostEqual(bucket.get_delay(), 49, delta=0.1)
+
+    def test_token_bucket_registry(self):
+        registry = TokenBucketRegistry()
+        self.assertIsNone(registry.get('account', 0))
+        bucket = registry.get('account', 10)
+        self.assertIs(registry.get('account', 10), bucket)
+        self.assertIs(registry.get('account', 20), bucket, "A new rate reconfigures the bucket")
+        self.assertEqual(bucket.rate, 20)
+        self.assertIsNot(registry.get('other', 10), bucket)
+
+    def test_normalize_e164(self):
+        self.assertEqual(normalize_e164('+254 711 234 567'), '+254711234567')
+        self.assertEqual(normalize_e164('0711234567', 'KE'), '+254711234567')
+        self.assertIsNone(normalize_e164('0711234567'), "National numbers need a region")
+        self.assertIsNone(normalize_e164('+2547112'))
+        self.assertIsNone(normalize_e164('not a number'))
+        self.assertIsNone(normalize_e164(False))
+
+    def test_dedup_keys(self):
+        make_key = RecentSendIndex.make_key
+        self.assertEqual(make_key(('user', 'ODOO'), '+254711234567', 'Hello'), make_key(('user', 'ODOO'), '+254711234567', 'Hello'))
+        self.assertNotEqual(make_key(('user', 'ODOO'), '+254711234567', 'Hello'), make_key(('user', 'ODOO'), '+254711234567', 'Hello!'))
+        self.assertNotEqual(make_key(('user', 'ODOO'), '+254711234567', 'Hello'), make_key(('other', 'ODOO'), '+254711234567', 'Hello'))
+        # accounts without shortcode
+        self.assertEqual(make_key(('user', False), '+254711234567', 'Hello'), make_key(('user', ''), '+254711234567', 'Hello'))
+
+    def test_dedup_index(self):
+        index = RecentSendIndex(max_size=2)
+        keys = [RecentSendIndex.make_key(('user', 'ODOO'), f'+25471123456{digit}', 'Hello') for digit in range(3)]
+        index.add(keys[:1])
+        self.assertTrue(index.seen(keys[0], 60))
+        self.assertFalse(index.seen(keys[0], 0), "Out of the window")
+        self.assertFalse(index.seen(keys[1], 60))
+        index.add(keys[1:])
+        self.assertFalse(index.seen(keys[0], 60), "Oldest entry dropped above max_size")
+        self.assertTrue(index.seen(keys[2], 60))
+
+    def test_count_segments(self):
+        self.assertEqual(count_segments(''), ('gsm7', 0))
+        self.assertEqual(count_segments('Hello'), ('gsm7', 1))
+        self.assertEqual(count_segments('a' * 160), ('gsm7', 1))
+        self.assertEqual(count_segments('a' * 161), ('gsm7', 2))
+        self.assertEqual(count_segments('a' * 306), ('gsm7', 2))
+        self.assertEqual(count_segments('a' * 307), ('gsm7', 3))
+        # extended characters take 2 septets
+        self.assertEqual(count_segments('€' * 80), ('gsm7', 1))
+        self.assertEqual(count_segments('€' * 81), ('gsm7', 2))
+        # a single non GSM-7 character switches the whole body to UCS-2
+        self.assertEqual(count_segments('a' * 69 + 'ł'), ('ucs2', 1))
+        self.assertEqual(count_segments('a' * 70 + 'ł'), ('ucs2', 2))
+        # characters out of the BMP take 2 UTF-16 code units
+        self.assertEqual(count_segments('😀' * 35), ('ucs2', 1))
+        self.assertEqual(count_segments('😀' * 36), ('ucs2', 2))
+
+    def test_parse_price_table(self):
+        self.assertEqual(parse_price_table('{"254": 0.8, "256": 25}'), {'254': 0.8, '256': 25.0})
+        self.assertEqual(parse_price_table(''), {})
+        with self.assertLogs('odoo.addons.sms_africastalking.tools.sms_at_estimate', 'WARNING'):
+            self.assertEqual(parse_price_table('{"254": 0.8,'), {})
+        with self.assertLogs('odoo.addons.sms_africastalking.tools.sms_at_estimate', 'WARNING'):
+            self.assertEqual(parse_price_table('[1, 2]'), {})
+        with self.assertLogs('odoo.addons.sms_africastalking.tools.sms_at_estimate', 'WARNING'):
+            self.assertEqual(parse_price_table('{"254": "x", "255": null, "256": true, "257": 1}'), {'257': 1.0})
+
+    def test_compute_backoff(self):
+        for _index in range(20):
+            self.assertTrue(30 <= compute_backoff(1, 60, 3600) <= 60)
+            self.assertTrue(60 <= compute_backoff(2, 60, 3600) <= 120)
+            # capped to max_delay
+            self.assertTrue(1800 <= compute_backoff(10, 60, 3600) <= 3600)
+
+    def test_parse_lane_capacities(self):
+        self.assertEqual(parse_lane_capacities('otp:1000,transactional:4000'), {'otp': 1000, 'transactional': 4000})
+        self.assertEqual(parse_lane_capacities(' otp : 10 ,bulk:5'), {'otp': 10, 'bulk': 5})
+        self.assertEqual(parse_lane_capacities(''), {})
+        with self.assertLogs('odoo.addons.sms_africastalking.tools.sms_at_lanes', 'WARNING'):
+            self.assertEqual(parse_lane_capacities('otp:many,unknown:3,transactional:2'), {'transactional': 2})
+
+    def test_prefix_trie(self):
+        trie = PrefixTrie([('254', 'KE'), ('25471', 'SAFARICOM'), ('256', 'UG')])
+        self.assertEqual(trie.lookup('+254711234567'), 'SAFARICOM', "Longest prefix wins")
+        self.assertEqual(trie.lookup('+254733234567'), 'KE')
+        self.assertEqual(trie.lookup('256772123456'), 'UG')
+        self.assertEqual(trie.lookup('+255712345678', 'ODOO'), 'ODOO', "No route: default sender")
+        self.assertIsNone(trie.lookup('+255712345678'))
+        self.assertEqual(PrefixTrie().lookup('+254711234567', 'ODOO'), 'ODOO')
+
+    # ------------------------------------------------------------
+    # METRICS
+    # ------------------------------------------------------------
+
+    def _get_metrics_registry(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        registry = MetricsRegistry('test_sms_at_metrics')
+        registry.directory = os.path.join(directory.name, 'metrics')
+        return registry
+
+    def _write_metrics_file(self, registry, filename, counters):
+        with open(os.path.join(registry.directory, filename), 'w') as f:
+            json.dump({'counters': counters, 'histograms': {}, 'gauges': {}}, f)
+
+    def test_metrics_collect(self):
+        registry = self._get_metrics_registry()
+        # the directory does not exist before the first flush
+        self.assertEqual(dict(registry.collect()['counters']), {})
+        registry.inc('sms_at_messages_total', {'account': 'test', 'state': 'sent'}, 3)
+        registry.observe('sms_at_send_request_duration_seconds', 0.2, {'account': 'test'})
+        registry.set_gauge('sms_at_batch_size', 100, {'account': 'test', 'shortcode': ''})
+        registry.flush()
+        self.assertIn(f'{socket.gethostname()}-{os.getpid()}.json', os.listdir(registry.directory))
+
+        key = MetricsRegistry._key('sms_at_messages_total', {'account': 'test', 'state': 'sent'})
+        # dead process of this host: archived; process of another host: merged as is
+        dead_pid = 2 ** 30
+        self._write_metrics_file(registry, f'{socket.gethostname()}-{dead_pid}.json', {key: 2})
+        self._write_metrics_file(registry, f'other-host-{dead_pid}.json', {key: 5})
+        merged = registry.collect()
+        self.assertEqual(merged['counters'][key], 10)
+        filenames = os.listdir(registry.directory)
+        self.assertNotIn(f'{socket.gethostname()}-{dead_pid}.json', filenames)
+        self.assertIn(f'other-host-{dead_pid}.json', filenames)
+        self.assertIn('archive.json', filenames)
+        self.assertEqual(registry.collect()['counters'][key], 10, "Archived counters are still counted, once")
+
+        rendered = registry.render([('sms_at_queue_depth', {'lane': 'otp'}, 4)])
+        self.assertIn('sms_at_messages_total{account="test",state="sent"} 10.0', rendered)
+        self.assertIn('sms_at_batch_size{account="test",shortcode=""} 100', rendered)
+        self.assertIn('sms_at_queue_depth{lane="otp"} 4', rendered)
+        self.assertIn('sms_at_send_request_duration_seconds_bucket{account="test",le="0.25"} 1', rendered)
+        self.assertIn('# TYPE sms_at_send_request_duration_seconds histogram', rendered)
@@ -1,2 +1,12 @@
 from . import sms_api
-from . import sms_africastalking
\ No newline at end of file
+from . import sms_africastalking
+from . import sms_at_client
+from . import sms_at_throttle
+from . import sms_at_batching
+from . import sms_at_metrics
+from . import sms_at_dedup
+from . import sms_at_estimate
+from . import sms_at_inbound
+from . import sms_at_lanes
+from . import sms_at_routing
+from . import sms_at_tracing
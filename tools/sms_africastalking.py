@@ -1,18 +1,62 @@
 import base64
+import functools
 import hashlib
 import hmac
 
+import phonenumbers
+
 from odoo.tools.urls import urljoin
 
 from odoo.addons.phone_validation.tools import phone_validation
 
+TWILIO_TO_SMS_STATE_ERRORS = {
+    'failed': 'error',
+    'undelivered': 'error',
+}
+
+TWILIO_TO_SMS_STATE = {
+    # https://www.twilio.com/docs/messaging/api/message-resource#message-status-values
+    'queued': 'outgoing',
+    'sending': 'process',
+    'sent': 'pending',
+    'delivered': 'sent',
+    'receiving': 'process',
+    'received': 'pending',
+    'accepted': 'outgoing',
+    'scheduled': 'outgoing',
+    'canceled': 'canceled',
+    **TWILIO_TO_SMS_STATE_ERRORS,
+}
+
+# https://developers.africastalking.com/docs/sms/notifications
+AT_TO_SMS_STATE_ERRORS = {
+    'Rejected': 'error',
+    'Failed': 'error',
+    'AbsentSubscriber': 'error',
+    'Expired': 'error',
+}
+
+AT_TO_SMS_STATE = {
+    'Sent': 'pending',
+    'Submitted': 'pending',
+    'Buffered': 'pending',
+    'Success': 'sent',
+    **AT_TO_SMS_STATE_ERRORS,
+}
+
+
 def get_at_status_callback_url(company, uuid):
     base_url = company.get_base_url()  # When testing locally, this should be replaced by a real url (not localhost, e.g. with ngrok)
     return urljoin(base_url, f'/sms_africastalking/status/{uuid}')
 
 
-def generate_at_sms_callback_signature(company, sms_uuid, callback_params):
+def generate_at_sms_callback_signature(company, sms_uuid, callback_params, signing_key=None):
+    """ :param signing_key: the (cached) encoded api key of the company, read from the company if not given """
     url = get_at_status_callback_url(company, sms_uuid)
+    return compute_at_callback_signature(url, callback_params, signing_key or company.sms_at_api_key.encode())
+
+
+def compute_at_callback_signature(url, callback_params, signing_key):
     # Sort the POST parameters by key and concatenate them to URL
     sorted_params = ''.join(f"{k}{v}" for k, v in sorted(callback_params.items()))
     data = url + sorted_params
@@ -20,8 +64,29 @@ def generate_at_sms_callback_signature(company, sms_uuid, callback_params):
     # Compute HMAC-SHA1 digest and then base64 encode
     return base64.b64encode(
         hmac.new(
-            company.sms_at_api_key.encode(),
+            signing_key,
             data.encode(),
             hashlib.sha1
         ).digest()
     ).decode()
+
+
+@functools.lru_cache(maxsize=4096)
+def get_country_prefix(number):
+    """ Country calling code of an E.164 number (e.g. '254'), '' if it cannot be parsed """
+    try:
+        return str(phonenumbers.parse(number or '', None).country_code)
+    except phonenumbers.NumberParseException:
+        return ''
+
+
+@functools.lru_cache(maxsize=65536)
+def normalize_e164(number, region=None):
+    """ E.164 format of ``number`` (national numbers are read in ``region``), None if invalid """
+    try:
+        parsed = phonenumbers.parse(number or '', region)
+    except phonenumbers.NumberParseException:
+        return None
+    if not phonenumbers.is_valid_number(parsed):
+        return None
+    return phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164)
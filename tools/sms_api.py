@@ -1,16 +1,100 @@
 import logging
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import timedelta
+from itertools import zip_longest
 
-import africastalking
 import requests
-from africastalking.Service import AfricasTalkingException
 
-from odoo import _
+from odoo import _, fields
 from odoo.addons.sms.tools import sms_api
 from odoo.exceptions import ValidationError
-from .sms_africastalking import get_at_status_callback_url
+from odoo.tools import split_every
+from .sms_africastalking import get_at_status_callback_url, normalize_e164
+from .sms_at_batching import batch_sizers
+from .sms_at_client import AfricastalkingClientError, client_registry
+from .sms_at_dedup import recent_sends
+from .sms_at_estimate import parse_price_table
+from .sms_at_metrics import get_metrics
+from .sms_at_throttle import circuit_breakers, rate_limiters
+from .sms_at_tracing import current_trace, span, start_trace
 
 _logger = logging.getLogger(__name__)
 
+# https://developers.africastalking.com/docs/sms/sending/bulk
+# 100: Processed, 101: Sent, 102: Queued
+AT_SUCCESS_STATUS_CODES = (100, 101, 102)
+# States of the results of the sms accepted by Africastalking ('processing': enqueued)
+AT_ACCEPTED_STATES = ('sent', 'processing')
+AT_INSUFFICIENT_BALANCE_STATUS_CODE = 405
+# Error of the requests not sent because the circuit breaker is open: their sms stay queued
+AT_DEFERRED = 'at_deferred'
+# Transient failures (HTTP 5xx, network errors, statusCode 500-502), retried with a backoff
+AT_RETRYABLE_FAILURE_TYPES = ('at_gateway_error',)
+# Failures of the recipients of an account that cannot send for now (the request trips the
+# circuit breaker): like AT_DEFERRED, their sms stay queued until the breaker closes again
+AT_DEFERRED_FAILURE_TYPES = ('at_insufficient_balance',)
+# Request level rejections (empty Recipients) of the SMSMessageData Message
+AT_MESSAGE_TO_FAILURE_TYPE = {
+    'InvalidSenderId': 'at_invalid_sender_id',
+    'InvalidPhoneNumber': 'at_invalid_phone_number',
+}
+
+
+def _at_number_key(number):
+    return re.sub(r'\D', '', number or '')
+
+
+def _at_call_send(client, rate_limiter, breaker, body, to_numbers, sender, enqueue=False):
+    """ Network part of a send request, does not use the env so it can run in another thread.
+    Nothing is sent once the circuit breaker of the account is open.
+
+    :return: a tuple (raw response, AfricastalkingClientError or AT_DEFERRED, duration of the request)
+    """
+    if breaker and breaker.is_open():
+        return None, AT_DEFERRED, 0.0
+    if rate_limiter:
+        rate_limiter.acquire(len(to_numbers))
+    start = time.monotonic()
+    try:
+        response, error = client.send_sms(body, to_numbers, sender, enqueue), None
+    except AfricastalkingClientError as e:
+        response, error = None, e
+    except requests.exceptions.RequestException as e:
+        response, error = None, AfricastalkingClientError(str(e))
+    if error is not None:
+        _logger.warning('Africastalking SMS API error: %s', error)
+    if breaker:
+        _at_update_breaker(breaker, response, error)
+    return response, error, time.monotonic() - start
+
+
+def _at_is_retryable_error(error):
+    """ Whether a failed request may succeed later: server and network errors only """
+    return error.status_code is None or error.status_code >= 500
+
+
+def _at_is_unreadable_success(error):
+    """ Whether a request was accepted (2xx) but its response could not be read """
+    return error.status_code is not None and 200 <= error.status_code < 300
+
+
+def _at_update_breaker(breaker, response, error):
+    if error is not None:
+        # rejected requests (e.g. a wrong API key) say nothing about the gateway
+        if _at_is_retryable_error(error):
+            breaker.record_failure()
+        return
+    recipients = (response or {}).get('SMSMessageData', {}).get('Recipients') or []
+    if any(recipient.get('statusCode') == AT_INSUFFICIENT_BALANCE_STATUS_CODE for recipient in recipients if recipient):
+        breaker.trip(breaker.REASON_BALANCE)
+    else:
+        breaker.record_success()
+
 
 class SmsApiAfricastalking(sms_api.SmsApiBase):
     PROVIDER_TO_SMS_FAILURE_TYPE = sms_api.SmsApiBase.PROVIDER_TO_SMS_FAILURE_TYPE | {
@@ -19,91 +103,483 @@ class SmsApiAfricastalking(sms_api.SmsApiBase):
         'at_callback'       : 'at_callback',
         'at_from_missing'   : 'at_from_missing',
         'at_from_to'        : 'at_from_to',
+        'at_duplicate'      : 'at_duplicate',
     }
-    AT_SMS = None  # Will be set in __init__
     company_sudo = None  # Will be set in __init__
+
     def __init__(self, env, account=None):
         super().__init__(env, account=account)
-        company_sudo = (self.company or self.env.company).sudo()
+        self._set_at_company((self.company or self.env.company).sudo())
+
+    def _set_company(self, company):
+        super()._set_company(company)
+        self._set_at_company((company or self.env.company).sudo())
+
+    def _set_at_company(self, company_sudo):
         if company_sudo.sms_provider == 'africastalking':
             company_sudo._assert_at_username()
             self.company_sudo = company_sudo
-            try:
-                africastalking.initialize(company_sudo.sms_at_username, company_sudo.sms_at_api_key)
-                self.AT_SMS = africastalking.SMS
-            except AfricasTalkingException as e:
-                # Show a notification toast message
-                _logger.warning('Africastalking SMS API initialization error: %s', str(e))
-                raise ValidationError("Africastalking SMS client could not be initialized: %s", str(e))
-            except requests.exceptions.RequestException as e:
-                _logger.warning('Africastalking SMS API initialization error: %s', str(e))
-                raise ValidationError("Africastalking SMS client could not be initialized: %s", str(e))
-
-    def _sms_at_send_request(self, session, to_number, body, uuid):
+
+    def _get_at_client(self):
+        """ Return the pooled keep-alive client of the company's Africastalking account. """
         if not self.company_sudo:
             raise ValueError("Africastalking SMS configuration is missing")
-        if not self.AT_SMS:
-            raise ValueError("Africastalking SMS client could not be initialized")
-        company_sudo = self.company_sudo
-        sender = company_sudo.sms_at_shortcode
-        recipients = [to_number]
+        if not self.company_sudo.sms_at_api_key:
+            raise ValidationError(_("Africastalking SMS client could not be initialized: missing API key"))
+        base_url = self.env['ir.config_parameter'].sudo().get_param('sms_africastalking.api.url')
+        with span('at.initialize'):
+            return client_registry.get(self.company_sudo.sms_at_username, self.company_sudo.sms_at_api_key, base_url or None)
+
+    def _get_at_rate_limiter(self, sender=None):
+        """ Rate limiter of a sender of the account: the rate of its route if any,
+        else ``sms_africastalking.send.rate_limit`` """
+        sender = sender or self.company_sudo.sms_at_shortcode
+        rate = self.env['res.company']._get_sms_at_routing(self.company_sudo.id)[1].get(sender)
+        if not rate:
+            rate = float(self.env['ir.config_parameter'].sudo().get_param('sms_africastalking.send.rate_limit', 0))
+        return rate_limiters.get((self.company_sudo.sms_at_username, sender or ''), rate)
+
+    def _get_at_sender_router(self):
+        """ :return: a function giving the sender to use for an E.164 number (see sms.africastalking.route) """
+        trie = self.env['res.company']._get_sms_at_routing(self.company_sudo.id)[0]
+        default_sender = self.company_sudo.sms_at_shortcode
+        return lambda number: trie.lookup(number, default_sender)
+
+    def _get_at_send_concurrency(self):
+        return max(int(self.env['ir.config_parameter'].sudo().get_param('sms_africastalking.send.concurrency', 1)), 1)
+
+    def _get_at_circuit_breaker(self):
+        failure_threshold = int(self.env['ir.config_parameter'].sudo().get_param('sms_africastalking.breaker.failure_threshold', 5))
+        return circuit_breakers.get(self.company_sudo._get_sms_at_account(), failure_threshold)
+
+    def _at_is_sending_allowed(self):
+        """ Whether the circuit breaker of the account lets messages be sent. Once its
+        cooldown is over, an open breaker closes only if the (cached) balance of the
+        account can be fetched and covers at least one message (see ``_get_at_min_balance``). """
+        breaker = self._get_at_circuit_breaker()
+        if not breaker.is_open():
+            return True
+        ICP = self.env['ir.config_parameter'].sudo()
+        if not breaker.cooldown_elapsed(int(ICP.get_param('sms_africastalking.breaker.cooldown', 300))):
+            return False
+        balance = self._at_get_balance(int(ICP.get_param('sms_africastalking.balance.ttl', 60)))
+        if balance is None or balance <= 0 or balance < self._get_at_min_balance():
+            _logger.warning('Africastalking SMS: sending still suspended for account %s (%s, balance: %s)',
+                            self.company_sudo.sms_at_username, breaker.reason, balance)
+            breaker.postpone()
+            return False
+        _logger.info('Africastalking SMS: resuming sending for account %s (balance: %s)', self.company_sudo.sms_at_username, balance)
+        breaker.close()
+        return True
+
+    def _get_at_min_balance(self):
+        """ Balance below which sending stays suspended: ``sms_africastalking.balance.min``, or
+        else the highest price of one segment of ``sms_africastalking.price_table``, so that a
+        balance lower than the cost of one message does not close the breaker for the next
+        request to trip it again """
+        ICP = self.env['ir.config_parameter'].sudo()
+        min_balance = float(ICP.get_param('sms_africastalking.balance.min', 0))
+        if not min_balance:
+            min_balance = max(parse_price_table(ICP.get_param('sms_africastalking.price_table')).values(), default=0.0)
+        return min_balance
+
+    def _at_get_resume_time(self):
+        """ When the sms held by the open circuit breaker of the account are due again: at the end of its cooldown """
+        cooldown = int(self.env['ir.config_parameter'].sudo().get_param('sms_africastalking.breaker.cooldown', 300))
+        return fields.Datetime.now() + timedelta(seconds=self._get_at_circuit_breaker().cooldown_remaining(cooldown))
+
+    def _at_get_balance(self, ttl=60):
+        """ Balance of the account (cached for ``ttl`` seconds), None if it could not be fetched """
+        breaker = self._get_at_circuit_breaker()
+        balance = breaker.get_cached_balance(ttl)
+        if balance is not None:
+            return balance
         try:
-            response = self.AT_SMS.send(body,recipients,sender)
-            _logger.info('Raw response from Africastalking SMS API: %s', response)
-            return self._at_get_sms_response_payload(response)
-        except AfricasTalkingException as e:
-            _logger.warning('Africastalking SMS API error: %s', str(e))
-            return {
-                'error_message': str(e),
-                'status_code': 500,
-                'status': 'InternalServerError',
-            }
-        except requests.exceptions.RequestException as e:
-            _logger.warning('Africastalking SMS API error: %s', str(e))
-            return {
-                'error_message': str(e),
-                'status_code': 500,
-                'status': 'InternalServerError',
-            }
+            user_data = self._get_at_client().fetch_user_data()
+        except (AfricastalkingClientError, requests.exceptions.RequestException) as e:
+            _logger.warning('Africastalking SMS: could not fetch the balance: %s', str(e))
+            return None
+        balance_string = (user_data.get('UserData') or {}).get('balance') or ''
+        try:
+            balance = float(balance_string.split(' ')[-1])
+        except ValueError:
+            _logger.warning('Africastalking SMS: unexpected balance %r', balance_string)
+            return None
+        breaker.set_balance(balance)
+        return balance
+
+    def _get_at_enqueue(self, sms_count):
+        """ Whether to send in enqueue mode: always for the companies that enable it,
+        otherwise for the batches of at least ``sms_africastalking.enqueue.threshold`` sms """
+        if self.company_sudo.sms_at_enqueue:
+            return True
+        threshold = int(self.env['ir.config_parameter'].sudo().get_param('sms_africastalking.enqueue.threshold', 0))
+        return bool(threshold) and sms_count >= threshold
+
+    def _at_process_send_response(self, response, error):
+        if error is AT_DEFERRED:
+            return {'deferred': True}
+        if error is not None:
+            return self._at_get_error_payload(error)
+        # sampled summary of the response instead of logging each raw response
+        if trace := current_trace():
+            message_data = (response or {}).get('SMSMessageData') or {}
+            trace.log('at.response', message=message_data.get('Message'), recipients=len(message_data.get('Recipients') or []))
+        return self._at_get_sms_response_payload(response)
+
+    def _at_get_error_payload(self, error):
+        """ Payload of a request without Africastalking response. Only the server and
+        network errors are gateway errors (retried), 401 and 403 come from the API key
+        and the other HTTP errors from the request itself. A successful response that
+        cannot be read means the sms were accepted: they must not be sent again. """
+        if _at_is_unreadable_success(error):
+            return {'unreadable': True, 'error_message': str(error), 'http_status': error.status_code}
+        if _at_is_retryable_error(error):
+            failure_type = 'at_gateway_error'
+        elif error.status_code in (401, 403):
+            failure_type = 'at_authentication'
+        else:
+            failure_type = 'unknown'
+        return {
+            'error_message': str(error),
+            'failure_type': failure_type,
+            'http_status': error.status_code,
+        }
 
     def _send_sms_batch(self, messages, delivery_reports_url=False):
         """ Send a batch of SMS using Africastalking.
         See params and returns in original method sms/tools/sms_api.py
-        In addition to the uuid and state, we add the sms_at_sid to the returns (one per sms)
+        In addition to the uuid and state, we add the sms_at_sid, cost and currency_code
+        to the returns (one per sms). Sms sent in enqueue mode (see ``_get_at_enqueue``)
+        are in the 'processing' state until their delivery report.
+
+        Numbers sharing the same body and sender (within a message or across messages)
+        are sent as multi-recipient requests of at most ``_get_at_recipients_per_request``
+        numbers, the sender of each number being resolved from the routing table. Requests
+        are sent from a bounded thread pool of ``sms_africastalking.send.concurrency``
+        threads (at least one per sender), taking the senders in turn; each sender has its
+        own rate limiter.
+        Results are returned in the order of ``messages``.
+
+        When called from ``SmsSms.send`` (see ``sms_at_send_options`` in the context),
+        results are streamed: every ``sms_africastalking.send.stream_size`` results (500),
+        or ``sms_africastalking.send.stream_interval`` seconds (10), they are applied to
+        their sms and trackers (and committed with ``auto_commit``) while the next requests
+        are in flight, and only the results not applied yet are returned. Streaming thus
+        only applies to batches larger or slower than that: the default batches of
+        ``sms_africastalking.session.batch.size`` (10) sms are applied at once, unless
+        sized by the adaptive batches.
         """
-        # Use a session as we have to sequentially call twilio, might save time
-        session = requests.Session()
+        with start_trace(self.env, 'at.send_sms_batch', account=self.company_sudo.sms_at_username):
+            return self._at_send_sms_batch(messages)
 
-        res = []
+    def _at_send_sms_batch(self, messages):
+        with span('at.prepare_requests'):
+            send_requests, results_by_uuid = self._at_prepare_send_requests(messages)
+        self._at_record_results_metrics(results_by_uuid.values())
+        if not send_requests:
+            return self._at_get_batch_results(messages, results_by_uuid)
+
+        start = time.monotonic()
+        # Only the network calls are done in the pool: the env must stay in this thread
+        client, breaker = self._get_at_client(), self._get_at_circuit_breaker()
+        rate_limiter_by_sender = {sender: self._get_at_rate_limiter(sender) for _body, sender, _number_infos in send_requests}
+        sent_count = sum(len(number_infos_chunk) for _body, _sender, number_infos_chunk in send_requests)
+        enqueue = self._get_at_enqueue(sent_count)
+        send_options = self.env.context.get('sms_at_send_options')
+        trace = current_trace()
+        ICP = self.env['ir.config_parameter'].sudo()
+        stream_size = int(ICP.get_param('sms_africastalking.send.stream_size', 500)) if send_options else 0
+        stream_interval = float(ICP.get_param('sms_africastalking.send.stream_interval', 10))
+
+        def call_send(send_request):
+            body, sender, number_infos_chunk = send_request
+            with span('at.http_request', trace, sender=sender, recipients=len(number_infos_chunk)):
+                return _at_call_send(
+                    client, rate_limiter_by_sender[sender], breaker,
+                    body, [info['number'] for info in number_infos_chunk], sender, enqueue,
+                )
+
+        error_count = 0
+        pending_results = []
+        flushed_at = time.monotonic()
+        concurrency = min(max(self._get_at_send_concurrency(), len(rate_limiter_by_sender)), len(send_requests))
+        with ExitStack() as stack:
+            # responses are consumed in order as they complete, from the pool or sequentially
+            if concurrency > 1:
+                executor = stack.enter_context(ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='sms_at_send'))
+                # if consuming the responses fails, the requests not started yet must not be sent
+                # as their results would not be journaled
+                stack.callback(executor.shutdown, cancel_futures=True)
+                raw_responses = executor.map(call_send, send_requests)
+            else:
+                raw_responses = map(call_send, send_requests)
+            # Accepted sms are journaled in their own transaction, see sms.africastalking.journal
+            journal_cr = stack.enter_context(self.env.registry.cursor())
+            journal = self.env(cr=journal_cr)['sms.africastalking.journal'].sudo()
+            for send_request, (response, error, duration) in zip(send_requests, raw_responses):
+                number_infos_chunk = send_request[2]
+                if error is not AT_DEFERRED:
+                    self._at_record_request_metrics(duration)
+                if error is not None and error is not AT_DEFERRED:
+                    error_count += len(number_infos_chunk)
+                with span('at.parse_response'):
+                    chunk_results = self._at_prepare_results(
+                        number_infos_chunk, self._at_process_send_response(response, error), enqueue, send_request[1],
+                    )
+                if accepted_results := [result for result in chunk_results if result['state'] in AT_ACCEPTED_STATES]:
+                    with span('at.journal'):
+                        journal._add_to_journal(accepted_results)
+                        journal_cr.commit()
+                self._at_record_results_metrics(chunk_results)
+                self._at_register_sent([send_request], {result['uuid']: result for result in chunk_results})
+                if not stream_size:
+                    results_by_uuid.update((result['uuid'], result) for result in chunk_results)
+                    continue
+                pending_results += chunk_results
+                if len(pending_results) >= stream_size or time.monotonic() - flushed_at >= stream_interval:
+                    with span('at.flush_results', results=len(pending_results)):
+                        self._at_flush_results(pending_results, send_options)
+                    pending_results = []
+                    flushed_at = time.monotonic()
+        results_by_uuid.update((result['uuid'], result) for result in pending_results)
+        batch_sizers.get(self.company_sudo._get_sms_at_account()).record(sent_count, time.monotonic() - start, error_count)
+        return self._at_get_batch_results(messages, results_by_uuid)
+
+    def _at_get_batch_results(self, messages, results_by_uuid):
+        """ Results of ``_send_sms_batch`` in the order of ``messages``, without the streamed ones """
+        return [
+            results_by_uuid[number_info['uuid']]
+            for message in messages
+            for number_info in message.get('numbers') or []
+            if number_info['uuid'] in results_by_uuid
+        ]
+
+    def _at_flush_results(self, results, send_options):
+        """ Apply a sub-batch of results the way ``SmsSms._send`` applies the results of a batch """
+        sms = self.env['sms.sms'].sudo().browse(send_options['sms_ids'])
+        uuids = {result['uuid'] for result in results}
+        sms = sms.filtered(lambda sms: sms.uuid in uuids)
+        sms._handle_call_result_hook(results)
+        sms._postprocess_iap_sent_sms(results, unlink_failed=send_options['unlink_failed'], unlink_sent=send_options['unlink_sent'])
+        send_options['flushed_uuids'].update(uuids)
+        if send_options['auto_commit'] and not getattr(threading.current_thread(), 'testing', False):
+            self.env.cr.commit()
+
+    def _at_record_request_metrics(self, duration):
+        get_metrics(self.env.cr.dbname).observe(
+            'sms_at_send_request_duration_seconds', duration, {'account': self.company_sudo.sms_at_username},
+        )
+
+    def _at_record_results_metrics(self, results):
+        metrics = get_metrics(self.env.cr.dbname)
+        account = self.company_sudo.sms_at_username
+        for result in results:
+            metrics.inc('sms_at_messages_total', {'account': account, 'state': result['state']})
+            if result.get('failure_type'):
+                metrics.inc('sms_at_failures_total', {'account': account, 'failure_type': result['failure_type']})
+            if result.get('cost') and result.get('currency_code'):
+                metrics.inc('sms_at_cost_total', {'account': account, 'currency': result['currency_code']}, result['cost'])
+
+    def _at_prepare_send_requests(self, messages):
+        """ Group the numbers of ``messages`` by body and sender into multi-recipient requests.
+
+        Numbers are normalized to E.164 first: invalid numbers and duplicates of a
+        (number, body) sent within the deduplication window are not sent, nor the sms
+        already accepted by Africastalking in a rolled back transaction (their journaled
+        result is used instead).
+
+        :return: a tuple (send requests, results of the sms that are not sent) where
+            send requests is a list of tuples (body, sender, [{'uuid': ..., 'number': ...}, ...])
+            and results is a dict {uuid: result}
+        """
+        numbers_by_body, rejected_results = self._at_prepare_numbers(messages)
+        recipients_per_request = self._get_at_recipients_per_request()
+        get_sender = self._get_at_sender_router()
+        numbers_by_body_sender = defaultdict(list)
+        for body, number_infos in numbers_by_body.items():
+            for number_info in number_infos:
+                numbers_by_body_sender[body, get_sender(number_info['number'])].append(number_info)
+        send_requests_by_sender = defaultdict(list)
+        for (body, sender), number_infos in numbers_by_body_sender.items():
+            send_requests_by_sender[sender] += [
+                (body, sender, number_infos_chunk)
+                for number_infos_chunk in split_every(recipients_per_request, number_infos, list)
+            ]
+        # Round-robin over the senders: the pool sends the requests in that order, so that
+        # its threads do not all wait on the rate limiter of one sender
+        send_requests = [
+            send_request
+            for round_requests in zip_longest(*send_requests_by_sender.values())
+            for send_request in round_requests
+            if send_request is not None
+        ]
+        return send_requests, rejected_results
+
+    def _at_prepare_numbers(self, messages):
+        """ Normalize the numbers of ``messages`` and drop the ones that should not be sent.
+
+        :return: a tuple ({body: [number_info, ...]}, {uuid: result of the dropped sms})
+        """
+        region = self.company_sudo.country_id.code or None
+        account = self.company_sudo._get_sms_at_account()
+        dedup_window = int(self.env['ir.config_parameter'].sudo().get_param('sms_africastalking.dedup.window', 0))
+        numbers_by_body = defaultdict(list)
+        rejected_results = self.env['sms.africastalking.journal'].sudo()._get_journaled_results([
+            number_info['uuid'] for message in messages for number_info in message.get('numbers') or []
+        ])
+        if rejected_results:
+            _logger.info('Africastalking SMS: %s sms already accepted, not sent again', len(rejected_results))
+        batch_keys = set()
         for message in messages:
             body = message.get('content') or ''
             for number_info in message.get('numbers') or []:
-                uuid = number_info['uuid']
-                response = self._sms_at_send_request(session, number_info['number'], body, uuid)
-                fields_values = {
-                    'failure_reason':  _("Unknown failure at sending, please contact Odoo support"),
-                    'state': 'server_error',
-                    'uuid': uuid,
-                }
-                if response is not None:
-                    response_json = response
-                    if response_json.get('error_message') or response_json.get('error'):
-                        failure_type = self._at_error_code_to_odoo_state(response_json)
-                        error_message = response_json.get('message') or response_json.get('error_message') or self._get_sms_api_error_messages().get(failure_type)
-                        fields_values.update({
-                            'failure_reason': error_message,
-                            'failure_type': failure_type,
-                            'state': failure_type,
-                        })
-                    else:
-                        fields_values.update({
-                            'failure_reason': False,
-                            'failure_type': False,
-                            'sms_at_sid': response_json.get('sms_at_sid'),
-                            'state': 'sent',
-                        })
-                res.append(fields_values)
-        return res
+                if number_info['uuid'] in rejected_results:
+                    continue
+                number = normalize_e164(number_info['number'], region)
+                if not number:
+                    rejected_results[number_info['uuid']] = self._at_prepare_rejected_result(number_info['uuid'], 'at_invalid_phone_number')
+                    continue
+                if dedup_window:
+                    key = recent_sends.make_key(account, number, body)
+                    if key in batch_keys or recent_sends.seen(key, dedup_window):
+                        rejected_results[number_info['uuid']] = self._at_prepare_rejected_result(number_info['uuid'], 'at_duplicate')
+                        continue
+                    batch_keys.add(key)
+                numbers_by_body[body].append({'uuid': number_info['uuid'], 'number': number})
+        return numbers_by_body, rejected_results
+
+    def _at_prepare_rejected_result(self, uuid, failure_type):
+        return {
+            'uuid': uuid,
+            'state': failure_type,
+            'failure_type': failure_type,
+            'failure_reason': self._get_sms_api_error_messages().get(failure_type),
+        }
+
+    def _at_register_sent(self, send_requests, results_by_uuid):
+        """ Remember the accepted (number, body) of ``send_requests`` for the deduplication
+        window, after their requests (by the send path and by the dispatcher) """
+        if not int(self.env['ir.config_parameter'].sudo().get_param('sms_africastalking.dedup.window', 0)):
+            return
+        account = self.company_sudo._get_sms_at_account()
+        recent_sends.add(
+            recent_sends.make_key(account, number_info['number'], body)
+            for body, _sender, number_infos in send_requests
+            for number_info in number_infos
+            if results_by_uuid.get(number_info['uuid'], {}).get('state') in AT_ACCEPTED_STATES
+        )
+
+    def _at_prepare_dispatch_jobs(self, messages):
+        """ Prepare the send requests of ``messages`` for the standalone dispatcher.
+
+        Jobs only hold plain data (no env) as they are sent outside of any cursor.
+
+        :return: a tuple (jobs, results of the sms that are not sent)
+        """
+        client = self._get_at_client()
+        breaker = self._get_at_circuit_breaker()
+        send_requests, rejected_results = self._at_prepare_send_requests(messages)
+        rate_limiter_by_sender = {sender: self._get_at_rate_limiter(sender) for _body, sender, _number_infos in send_requests}
+        enqueue = self._get_at_enqueue(sum(len(number_infos) for _body, _sender, number_infos in send_requests))
+        return [{
+            'company_id': self.company_sudo.id,
+            'client': client,
+            'rate_limiter': rate_limiter_by_sender[sender],
+            'breaker': breaker,
+            'sender': sender,
+            'enqueue': enqueue,
+            'body': body,
+            'number_infos': number_infos,
+        } for body, sender, number_infos in send_requests], list(rejected_results.values())
+
+    def _get_at_recipients_per_request(self):
+        return max(int(self.env['ir.config_parameter'].sudo().get_param('sms_africastalking.send.recipients_per_request', 100)), 1)
+
+    def _at_prepare_results(self, number_infos, response, enqueued=False, sender=None):
+        """ Map the response of a (multi-recipient) send request back to the Odoo sms.
+
+        :param number_infos: list of dict ``{'uuid': ..., 'number': ...}`` sent in the request
+        :param response: the dict returned by ``_at_process_send_response``
+        :param enqueued: whether the request was sent in enqueue mode
+        :param sender: the sender of the request, added to the results of the accepted sms
+        :return: a list of results (see ``_send_sms_batch``), one per number_info, in the same order
+        """
+        if response is None:
+            return [self._at_prepare_fields_values(info['uuid'], None) for info in number_infos]
+        if response.get('deferred'):
+            # circuit breaker open: not sent, the sms stay in the queue (see SmsSms._postprocess_iap_sent_sms)
+            return [{'uuid': info['uuid'], 'state': AT_DEFERRED} for info in number_infos]
+        if response.get('unreadable'):
+            # accepted but without the details of the recipients: considered sent (and thus
+            # journaled) rather than sent twice. Without messageId, no delivery report will
+            # match them, even enqueued.
+            _logger.warning("Africastalking SMS: unreadable response to an accepted request of %s sms: %s",
+                            len(number_infos), response['error_message'])
+            return [
+                self._at_prepare_fields_values(info['uuid'], {'status_code': AT_SUCCESS_STATUS_CODES[0]}, False, sender)
+                for info in number_infos
+            ]
+        if response.get('error_message') or response.get('error'):
+            return [self._at_prepare_fields_values(info['uuid'], response) for info in number_infos]
+
+        # AT answers with E.164 numbers, match on digits only to be tolerant on formatting
+        recipients_by_number = defaultdict(deque)
+        for recipient in response.get('recipients') or []:
+            recipients_by_number[_at_number_key(recipient.get('recipient_number'))].append(recipient)
+
+        recipient_by_uuid = {}
+        unmatched_infos = []
+        for info in number_infos:
+            recipients = recipients_by_number.get(_at_number_key(info['number']))
+            if recipients:
+                recipient_by_uuid[info['uuid']] = recipients.popleft()
+            else:
+                unmatched_infos.append(info)
+        # Recipients are returned in the order of the request: pair the leftovers by position
+        unmatched_recipients = [recipient for recipients in recipients_by_number.values() for recipient in recipients]
+        for info, recipient in zip(unmatched_infos, unmatched_recipients):
+            recipient_by_uuid[info['uuid']] = recipient
+
+        return [
+            self._at_prepare_fields_values(info['uuid'], recipient_by_uuid.get(info['uuid']) or {
+                'error_message': _("Africastalking SMS: No recipient information in response"),
+                'status_code': 500,
+                'status': 'InternalServerError',
+            }, enqueued, sender)
+            for info in number_infos
+        ]
+
+    def _at_prepare_fields_values(self, uuid, response_json, enqueued=False, sender=None):
+        fields_values = {
+            'failure_reason':  _("Unknown failure at sending, please contact Odoo support"),
+            'state': 'server_error',
+            'uuid': uuid,
+        }
+        if response_json is not None:
+            if (
+                response_json.get('error_message') or response_json.get('error')
+                or response_json.get('status_code') not in AT_SUCCESS_STATUS_CODES
+            ):
+                failure_type = response_json.get('failure_type') or self._at_error_code_to_odoo_state(response_json)
+                error_message = response_json.get('message') or response_json.get('error_message') or self._get_sms_api_error_messages().get(failure_type)
+                fields_values.update({
+                    'failure_reason': error_message,
+                    'failure_type': failure_type,
+                    'state': failure_type,
+                })
+            else:
+                fields_values.update({
+                    'failure_reason': False,
+                    'failure_type': False,
+                    'sms_at_sid': response_json.get('sms_at_sid'),
+                    'cost': response_json.get('cost'),
+                    'currency_code': response_json.get('currency_code'),
+                    'sender': sender,
+                    # enqueued sms are only accepted: processing until their delivery report
+                    'state': 'processing' if enqueued else 'sent',
+                })
+        return fields_values
 
     def _at_error_code_to_odoo_state(self, response_json):
         error_code = response_json.get('code') or response_json.get('status_code') or response_json.get('error_code')
@@ -126,7 +602,7 @@ class SmsApiAfricastalking(sms_api.SmsApiBase):
             return "at_user_in_blacklist"
         elif error_code == 407:
             return "at_could_not_route"
-        elif error_code == 407:
+        elif error_code == 409:
             return "at_do_not_disturb_rejection"
         _logger.warning('Africastalking SMS: Unknown error "%s" (code: %s)', response_json.get('message'), error_code)
         return "unknown"
@@ -147,6 +623,7 @@ class SmsApiAfricastalking(sms_api.SmsApiBase):
             'at_callback': _("Africastalking callback URL issue, please check your configuration"),  # not used for now
             'at_from_missing': _("Africastalking missing From number, please check your configuration"),
             'at_from_to': _("Africastalking From and To numbers cannot be the same"),
+            'at_duplicate': _("Duplicate of a message recently sent to the same number, not sent"),
             'at_authentication': _("Africastalking authentication error, please check your API key"),
             'at_acc_unverified': _("Africastalking account unverified, please verify your account"),
             'at_sms_credit': _("Africastalking SMS credit error, please check your account balance"),
@@ -170,28 +647,34 @@ class SmsApiAfricastalking(sms_api.SmsApiBase):
         #     }
         # }
 
-        # We just need the payload of the first recipient
+        # Each recipient gets its own payload, matched back to the sms by number
 
-        payload = response.get('SMSMessageData', {}).get('Recipients', [])
-        if not payload or not isinstance(payload, list) or not payload[0]:
+        message_data = response.get('SMSMessageData') or {}
+        recipients = message_data.get('Recipients', [])
+        if not recipients or not isinstance(recipients, list):
             _logger.warning("Africastalking SMS: No recipient information in response: %s", response)
+            # The Message of a rejected request (e.g. InvalidSenderId) is final, a response
+            # without any is a gateway error
+            message = message_data.get('Message')
             return {
-                'error_message': _("Africastalking SMS: No recipient information in response"),
-                'status_code': 500,
-                'status': 'InternalServerError',
+                'error_message': message or _("Africastalking SMS: No recipient information in response"),
+                'failure_type': AT_MESSAGE_TO_FAILURE_TYPE.get(message, 'unknown') if message else 'at_gateway_error',
             }
-        payload = payload[0]
+        return {
+            'recipients': [self._at_get_recipient_payload(recipient) for recipient in recipients if recipient],
+        }
+
+    def _at_get_recipient_payload(self, payload):
         # Extract cost as the float after the space in "KES 0.8000"
+        cost = None
+        currency = None
         cost_string = payload.get('cost')
         if cost_string and isinstance(cost_string, str) and ' ' in cost_string:
+            currency, amount = cost_string.split(' ', 1)
             try:
-                cost = float(cost_string.split(' ')[1])
+                cost = float(amount)
             except ValueError:
                 cost = None
-        if cost_string and isinstance(cost_string, str) and ' ' in cost_string:
-            currency = cost_string.split(' ')[0]
-        else:
-            currency = None
         return {
             'status_code': payload.get('statusCode'),
             'sms_at_sid': payload.get('messageId'),
@@ -199,4 +682,4 @@ class SmsApiAfricastalking(sms_api.SmsApiBase):
             'status': payload.get('status'),
             'cost': cost,
             'currency_code': currency,
-        }
\ No newline at end of file
+        }
@@ -0,0 +1,104 @@
+import threading
+import time
+
+# Part of the time budget actually targeted, the rest absorbs latency spikes
+AT_BATCH_SAFETY_FACTOR = 0.7
+# Smoothing of the measurements (weight of the latest batch)
+AT_BATCH_EWMA_ALPHA = 0.3
+# Above this error rate the batch size is halved whatever the latency
+AT_BATCH_MAX_ERROR_RATE = 0.5
+# Why the batch size was picked, exposed as the sms_at_batch_size_reason metric
+AT_BATCH_REASONS = ('no_measurement', 'error_rate', 'latency', 'min_size', 'max_size')
+
+
+class AdaptiveBatchSizer:
+    """ Batch size controller of one Africastalking account.
+
+    It tracks the (smoothed) sending time per sms and the error rate of the
+    last batches, and picks the largest batch that can be sent within the
+    time budget, growing at most twofold between two batches.
+    """
+
+    def __init__(self):
+        self.seconds_per_sms = None
+        self.error_rate = 0.0
+        self.samples = 0
+        self.size = None
+        self.reason = "no measurement yet"
+        self.reason_code = 'no_measurement'
+        self.updated_at = None
+        self._lock = threading.Lock()
+
+    def record(self, sms_count, duration, error_count=0):
+        if not sms_count:
+            return
+        with self._lock:
+            seconds_per_sms = duration / sms_count
+            error_rate = error_count / sms_count
+            if self.seconds_per_sms is None:
+                self.seconds_per_sms = seconds_per_sms
+                self.error_rate = error_rate
+            else:
+                self.seconds_per_sms += AT_BATCH_EWMA_ALPHA * (seconds_per_sms - self.seconds_per_sms)
+                self.error_rate += AT_BATCH_EWMA_ALPHA * (error_rate - self.error_rate)
+            self.samples += 1
+            self.updated_at = time.time()
+
+    def compute(self, min_size, max_size, time_budget, default_size):
+        """ :return: tuple (batch size, reason) """
+        with self._lock:
+            previous = self.size or default_size
+            if self.seconds_per_sms is None:
+                size, reason = default_size, "no measurement yet, using the configured batch size"
+                reason_code = 'no_measurement'
+            elif self.error_rate > AT_BATCH_MAX_ERROR_RATE:
+                size = previous // 2
+                reason = f"error rate {self.error_rate:.0%} above {AT_BATCH_MAX_ERROR_RATE:.0%}, halving the batch"
+                reason_code = 'error_rate'
+            else:
+                target = int(time_budget * AT_BATCH_SAFETY_FACTOR / max(self.seconds_per_sms, 1e-6))
+                size = min(target, previous * 2)
+                reason = (
+                    f"{self.seconds_per_sms * 1000:.1f} ms/sms over {self.samples} batches, "
+                    f"{time_budget}s budget: target {target}"
+                )
+                reason_code = 'latency'
+            clamped = max(min_size, min(size, max_size))
+            if clamped != size:
+                reason += f" (clamped to [{min_size}, {max_size}])"
+                reason_code = 'min_size' if clamped == min_size else 'max_size'
+            self.size, self.reason, self.reason_code = clamped, reason, reason_code
+            return clamped, reason
+
+    def get_info(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'reason': self.reason,
+                'reason_code': self.reason_code,
+                'seconds_per_sms': self.seconds_per_sms,
+                'error_rate': self.error_rate,
+                'samples': self.samples,
+                'updated_at': self.updated_at,
+            }
+
+
+class AdaptiveBatchSizerRegistry:
+    """ Process-level batch size controllers, one per Africastalking account. """
+
+    def __init__(self):
+        self._sizers = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._sizers:
+                self._sizers[key] = AdaptiveBatchSizer()
+            return self._sizers[key]
+
+    def items(self):
+        with self._lock:
+            return list(self._sizers.items())
+
+
+batch_sizers = AdaptiveBatchSizerRegistry()
@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+_logger = logging.getLogger(__name__)
+
+AT_API_URL = {
+    'production': 'https://api.africastalking.com',
+    'sandbox': 'https://api.sandbox.africastalking.com',
+}
+AT_TIMEOUT = 30
+# Connections kept alive per account, should cover the concurrent senders of a worker
+AT_POOL_MAXSIZE = 16
+# Registry bounds: a worker rarely talks to more than a handful of accounts
+AT_REGISTRY_MAX_SIZE = 32
+AT_REGISTRY_IDLE_TIMEOUT = 600  # seconds
+
+
+class AfricastalkingClientError(Exception):
+    """ Failed Africastalking request, with the HTTP status of the response if any
+    (None for network errors, a 2xx status for unreadable successful responses) """
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def get_at_environment(username):
+    # Same convention as the Africastalking SDK: the 'sandbox' user targets the sandbox API
+    return 'sandbox' if username == 'sandbox' else 'production'
+
+
+class AfricastalkingClient:
+    """ Minimal keep-alive HTTP client for the Africastalking SMS API.
+
+    Unlike the SDK, it holds no global state: one instance per account, each
+    with its own ``requests.Session`` so TLS connections are reused between calls.
+    """
+
+    def __init__(self, username, api_key, environment='production', base_url=None):
+        self.username = username
+        self.environment = environment
+        self.base_url = (base_url or AT_API_URL[environment]).rstrip('/')
+        self.last_used = time.monotonic()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=AT_POOL_MAXSIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'apiKey': api_key,
+            'Accept': 'application/json',
+        })
+
+    def send_sms(self, message, recipients, sender_id=None, enqueue=False):
+        url, data = self.prepare_send_sms(message, recipients, sender_id, enqueue)
+        return self._request('POST', url, data=data)
+
+    def prepare_send_sms(self, message, recipients, sender_id=None, enqueue=False):
+        """ Return the url and form data of a send request, e.g. to use with another HTTP client.
+
+        With ``enqueue``, Africastalking acknowledges the request right away and
+        sends the messages later on its side.
+        """
+        data = {
+            'username': self.username,
+            'to': ','.join(recipients),
+            'message': message,
+        }
+        if sender_id:
+            data['from'] = sender_id
+        if enqueue:
+            data['enqueue'] = 1
+        return self.base_url + '/version1/messaging', data
+
+    def fetch_user_data(self):
+        """ Application data of the account, e.g. {'UserData': {'balance': 'KES 1785.50'}} """
+        return self._request('GET', self.base_url + '/version1/user', params={'username': self.username})
+
+    @property
+    def headers(self):
+        return dict(self.session.headers)
+
+    def close(self):
+        self.session.close()
+
+    def _request(self, method, url, **kwargs):
+        response = self.session.request(method, url, timeout=AT_TIMEOUT, **kwargs)
+        if not 200 <= response.status_code < 300:
+            raise AfricastalkingClientError(response.text or response.reason, response.status_code)
+        try:
+            return response.json()
+        except ValueError:
+            # the request went through: the status tells callers not to send it again
+            raise AfricastalkingClientError(response.text, response.status_code)
+
+
+class AfricastalkingClientRegistry:
+    """ Process-level registry of ``AfricastalkingClient``, keyed by account.
+
+    Bounded in size (least recently used clients are closed first) and
+    clients idle for longer than ``idle_timeout`` are closed on next access.
+    """
+
+    def __init__(self, max_size=AT_REGISTRY_MAX_SIZE, idle_timeout=AT_REGISTRY_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_key(username, api_key, base_url=None):
+        # do not keep api keys around as dict keys
+        return username, hashlib.sha256((api_key or '').encode()).hexdigest(), get_at_environment(username), base_url
+
+    def get(self, username, api_key, base_url=None):
+        """ :param base_url: overrides the Africastalking API url of the environment (e.g. for a local stand-in) """
+        key = self._get_key(username, api_key, base_url)
+        now = time.monotonic()
+        to_close = []
+        with self._lock:
+            while self._clients:
+                oldest = next(iter(self._clients.values()))
+                if now - oldest.last_used <= self.idle_timeout:
+                    break
+                to_close.append(self._clients.popitem(last=False)[1])
+            client = self._clients.pop(key, None)
+            if client is None:
+                client = AfricastalkingClient(username, api_key, key[2], base_url)
+            client.last_used = now
+            self._clients[key] = client
+            while len(self._clients) > self.max_size:
+                to_close.append(self._clients.popitem(last=False)[1])
+        for old_client in to_close:
+            old_client.close()
+        return client
+
+    def invalidate(self, username, api_key):
+        key = self._get_key(username, api_key)[:3]
+        with self._lock:
+            clients = [self._clients.pop(client_key) for client_key in list(self._clients) if client_key[:3] == key]
+        for client in clients:
+            _logger.info('Africastalking SMS: closing pooled client of account %s', username)
+            client.close()
+
+    def clear(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+
+
+client_registry = AfricastalkingClientRegistry()
@@ -0,0 +1,42 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+AT_DEDUP_MAX_SIZE = 200000
+
+
+class RecentSendIndex:
+    """ Bounded process-level index of the recently sent (account, number, body).
+
+    Only a 16 bytes digest is kept per entry; the oldest entries are dropped
+    first once ``max_size`` is reached.
+    """
+
+    def __init__(self, max_size=AT_DEDUP_MAX_SIZE):
+        self.max_size = max_size
+        self._sent_at = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(account, number, body):
+        """ :param account: (username, shortcode), the shortcode may be unset """
+        return hashlib.blake2b('\0'.join(part or '' for part in (*account, number, body)).encode(), digest_size=16).digest()
+
+    def seen(self, key, window):
+        """ Whether ``key`` was sent less than ``window`` seconds ago """
+        with self._lock:
+            sent_at = self._sent_at.get(key)
+        return sent_at is not None and time.monotonic() - sent_at < window
+
+    def add(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                self._sent_at[key] = now
+                self._sent_at.move_to_end(key)
+            while len(self._sent_at) > self.max_size:
+                self._sent_at.popitem(last=False)
+
+
+recent_sends = RecentSendIndex()
@@ -0,0 +1,265 @@
+import asyncio
+import json
+import logging
+import time
+from collections import defaultdict
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from odoo import api, SUPERUSER_ID
+from odoo.modules.registry import Registry
+
+from .sms_api import AT_ACCEPTED_STATES, AT_DEFERRED, SmsApiAfricastalking, _at_update_breaker
+from .sms_at_client import AT_TIMEOUT, AfricastalkingClientError
+from .sms_at_metrics import get_metrics
+from .sms_at_throttle import rate_limiters
+
+_logger = logging.getLogger(__name__)
+
+
+class SmsAtDispatcher:
+    """ Long-running sender of the outgoing Africastalking sms.sms queue.
+
+    Rows are claimed with ``FOR UPDATE SKIP LOCKED`` and moved to the ``process``
+    state in a short transaction, so several dispatchers (on the same or on
+    different nodes) never claim the same sms. Requests are then sent
+    concurrently over aiohttp, and their results are applied and committed in
+    small batches. Claims older than ``lease_timeout`` (e.g. of a killed
+    dispatcher) are put back in the queue. As requests wait for their rate
+    limiter, nothing is claimed while the limiters are behind by more than half
+    the lease, and a request that waited that long renews the lease of its sms
+    right before being sent (see ``_renew_claims``).
+    """
+
+    def __init__(self, dbname, max_in_flight=1000, claim_size=500, commit_size=200,
+                 commit_interval=1.0, poll_interval=2.0, lease_timeout=600):
+        if aiohttp is None:
+            raise ImportError("The Africastalking SMS dispatcher requires the 'aiohttp' python package")
+        self.registry = Registry(dbname)
+        self.max_in_flight = max_in_flight
+        self.claim_size = claim_size
+        self.commit_size = commit_size
+        self.commit_interval = commit_interval
+        self.poll_interval = poll_interval
+        self.lease_timeout = lease_timeout
+        self.stopping = asyncio.Event()
+
+    def stop(self):
+        self.stopping.set()
+
+    async def run(self):
+        await asyncio.to_thread(self._release_expired_claims)
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        results = asyncio.Queue()
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+        timeout = aiohttp.ClientTimeout(total=AT_TIMEOUT)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as http:
+            committer = asyncio.create_task(self._commit_loop(results))
+            tasks = set()
+            while not self.stopping.is_set():
+                # do not claim more than what can be sent right away, claimed rows are leased
+                if in_flight.locked() or rate_limiters.get_max_delay() > self.lease_timeout / 2:
+                    await asyncio.sleep(0.05)
+                    continue
+                jobs = await asyncio.to_thread(self._claim_jobs)
+                if not jobs:
+                    await asyncio.to_thread(self._release_expired_claims)
+                    try:
+                        await asyncio.wait_for(self.stopping.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                for job in jobs:
+                    await in_flight.acquire()
+                    task = asyncio.create_task(self._send(http, job, results))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    task.add_done_callback(lambda _task: in_flight.release())
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            await results.put(None)
+            await committer
+
+    # ------------------------------------------------------------
+    # HTTP
+    # ------------------------------------------------------------
+
+    async def _send(self, http, job, results):
+        if job['breaker'].is_open():
+            await results.put((job['company_id'], job['body'], job['sender'], job['number_infos'], None, AT_DEFERRED, False))
+            return
+        if job['rate_limiter']:
+            delay = job['rate_limiter'].reserve(len(job['number_infos']))
+            if delay:
+                await asyncio.sleep(delay)
+        if time.monotonic() - job['leased_at'] > self.lease_timeout / 2:
+            # the lease may have expired while waiting, and the sms claimed again by another run
+            job['number_infos'] = await asyncio.to_thread(self._renew_claims, job)
+            if not job['number_infos']:
+                return
+        url, data = job['client'].prepare_send_sms(
+            job['body'], [info['number'] for info in job['number_infos']], job['sender'], job['enqueue'],
+        )
+        response = error = None
+        start = time.monotonic()
+        try:
+            async with http.post(url, data=data, headers=job['client'].headers) as http_response:
+                text = await http_response.text()
+                if 200 <= http_response.status < 300:
+                    try:
+                        response = json.loads(text)
+                    except ValueError:
+                        # accepted: the status tells not to send it again (see _at_get_error_payload)
+                        error = AfricastalkingClientError(text, http_response.status)
+                else:
+                    error = AfricastalkingClientError(text or http_response.reason, http_response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = AfricastalkingClientError(str(e) or e.__class__.__name__)
+        get_metrics(self.registry.db_name).observe(
+            'sms_at_send_request_duration_seconds', time.monotonic() - start, {'account': job['client'].username},
+        )
+        if error is not None:
+            _logger.warning('Africastalking SMS API error: %s', error)
+        _at_update_breaker(job['breaker'], response, error)
+        await results.put((job['company_id'], job['body'], job['sender'], job['number_infos'], response, error, job['enqueue']))
+
+    # ------------------------------------------------------------
+    # DATABASE
+    # ------------------------------------------------------------
+
+    def _claim_jobs(self):
+        with self.registry.cursor() as cr:
+            cr.execute("""
+                UPDATE sms_sms
+                   SET state = 'process',
+                       sms_at_claimed_at = NOW() AT TIME ZONE 'UTC'
+                 WHERE id IN (
+                    SELECT sms.id
+                      FROM sms_sms sms
+                 LEFT JOIN mail_message message ON message.id = sms.mail_message_id
+                      JOIN res_company company ON company.id = COALESCE(message.record_company_id, sms.record_company_id)
+                     WHERE sms.state = 'outgoing'
+                       AND sms.to_delete IS NOT TRUE
+                       AND company.sms_provider = 'africastalking'
+                       AND (sms.sms_at_next_attempt IS NULL OR sms.sms_at_next_attempt <= NOW() AT TIME ZONE 'UTC')
+                  ORDER BY CASE sms.sms_at_priority WHEN 'otp' THEN 0 WHEN 'transactional' THEN 1 ELSE 2 END, sms.id
+                     LIMIT %s
+                       FOR UPDATE OF sms SKIP LOCKED
+                 )
+             RETURNING id, sms_at_claimed_at
+            """, [self.claim_size])
+            rows = cr.fetchall()
+            if not rows:
+                return []
+            sms_ids = [sms_id for sms_id, _claimed_at in rows]
+            claimed_at = rows[0][1]
+            env = api.Environment(cr, SUPERUSER_ID, {'sms_at_dispatcher': True})
+            jobs = []
+            for sms_api, sms in env['sms.sms'].browse(sms_ids)._split_by_at_api():
+                if sms_api is None:
+                    # provider changed since the claim, give them back to the cron
+                    sms.write({'state': 'outgoing', 'sms_at_claimed_at': False})
+                    continue
+                if not sms_api._at_is_sending_allowed():
+                    # circuit breaker open: unclaim them until the end of its cooldown
+                    sms._at_defer(sms_api)
+                    continue
+                account_jobs, rejected_results = sms_api._at_prepare_dispatch_jobs(sms._at_prepare_messages())
+                for job in account_jobs:
+                    job.update(claimed_at=claimed_at, leased_at=time.monotonic())
+                jobs += account_jobs
+                if rejected_results:
+                    # not sent (invalid or duplicate numbers): final right away
+                    sms._handle_call_result_hook(rejected_results)
+                    sms._postprocess_iap_sent_sms(rejected_results, unlink_failed=False, unlink_sent=True)
+            _logger.info('Africastalking SMS dispatcher: claimed %s sms in %s requests', len(sms_ids), len(jobs))
+            return jobs
+
+    def _renew_claims(self, job):
+        """ Extend the lease of the sms of ``job`` that are still claimed by it, right before
+        sending them. The other ones were released meanwhile (and maybe claimed by another
+        run), and the journaled ones were already accepted: they are not sent.
+
+        :return: the number infos of the sms to send
+        """
+        uuids = [info['uuid'] for info in job['number_infos']]
+        with self.registry.cursor() as cr:
+            cr.execute("""
+                UPDATE sms_sms
+                   SET sms_at_claimed_at = NOW() AT TIME ZONE 'UTC'
+                 WHERE uuid = ANY(%s)
+                   AND state = 'process'
+                   AND sms_at_claimed_at = %s
+             RETURNING uuid
+            """, [uuids, job['claimed_at']])
+            renewed_uuids = {row[0] for row in cr.fetchall()}
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            renewed_uuids -= set(env['sms.africastalking.journal']._get_journaled_results(list(renewed_uuids)))
+        if len(renewed_uuids) < len(uuids):
+            _logger.warning('Africastalking SMS dispatcher: %s sms not sent, lease expired or already accepted', len(uuids) - len(renewed_uuids))
+        return [info for info in job['number_infos'] if info['uuid'] in renewed_uuids]
+
+    def _release_expired_claims(self):
+        with self.registry.cursor() as cr:
+            cr.execute("""
+                UPDATE sms_sms
+                   SET state = 'outgoing',
+                       sms_at_claimed_at = NULL
+                 WHERE state = 'process'
+                   AND sms_at_claimed_at < (NOW() AT TIME ZONE 'UTC') - make_interval(secs => %s)
+            """, [self.lease_timeout])
+            if cr.rowcount:
+                _logger.warning('Africastalking SMS dispatcher: released %s expired claims', cr.rowcount)
+
+    async def _commit_loop(self, results):
+        done = False
+        while not done:
+            batch = []
+            deadline = time.monotonic() + self.commit_interval
+            while len(batch) < self.commit_size:
+                try:
+                    item = await asyncio.wait_for(results.get(), max(deadline - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            if batch:
+                try:
+                    await asyncio.to_thread(self._apply_results, batch)
+                except Exception:
+                    # sms stay claimed, they will be released once their lease expires
+                    _logger.exception('Africastalking SMS dispatcher: could not apply %s results', len(batch))
+
+    def _apply_results(self, batch):
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {'sms_at_dispatcher': True})
+            sms_apis = {}
+            results_by_company = defaultdict(list)
+            for company_id, body, sender, number_infos, response, error, enqueued in batch:
+                if company_id not in sms_apis:
+                    sms_apis[company_id] = SmsApiAfricastalking(env)
+                    sms_apis[company_id]._set_company(env['res.company'].browse(company_id))
+                sms_api = sms_apis[company_id]
+                request_results = sms_api._at_prepare_results(
+                    number_infos, sms_api._at_process_send_response(response, error), enqueued, sender,
+                )
+                # same deduplication window as the send path of the workers
+                sms_api._at_register_sent([(body, sender, number_infos)], {result['uuid']: result for result in request_results})
+                results_by_company[company_id] += request_results
+            # journal the accepted sms first, so that they are not sent again if applying fails
+            with self.registry.cursor() as journal_cr:
+                env(cr=journal_cr)['sms.africastalking.journal']._add_to_journal([
+                    result
+                    for results in results_by_company.values()
+                    for result in results if result['state'] in AT_ACCEPTED_STATES
+                ])
+            for company_id, results in results_by_company.items():
+                sms_apis[company_id]._at_record_results_metrics(results)
+                sms = env['sms.sms'].search([('uuid', 'in', [result['uuid'] for result in results])])
+                sms._handle_call_result_hook(results)
+                sms._postprocess_iap_sent_sms(results, unlink_failed=False, unlink_sent=True)
@@ -0,0 +1,94 @@
+import functools
+import json
+import logging
+import math
+from collections import Counter
+
+from .sms_africastalking import get_country_prefix
+
+_logger = logging.getLogger(__name__)
+
+# GSM 03.38 default alphabet and its extension table (extended characters take 2 septets)
+GSM7_BASIC = frozenset(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM7_EXTENDED = frozenset("^{}\\[~]|€\f")
+
+GSM7_SINGLE_LENGTH, GSM7_CONCAT_LENGTH = 160, 153
+UCS2_SINGLE_LENGTH, UCS2_CONCAT_LENGTH = 70, 67
+
+
+@functools.lru_cache(maxsize=4096)
+def count_segments(body):
+    """ Encoding ('gsm7' or 'ucs2') and number of concatenated segments of ``body`` """
+    if not body:
+        return 'gsm7', 0
+    length = 0
+    for char in body:
+        if char in GSM7_BASIC:
+            length += 1
+        elif char in GSM7_EXTENDED:
+            length += 2
+        else:
+            break
+    else:
+        return 'gsm7', 1 if length <= GSM7_SINGLE_LENGTH else math.ceil(length / GSM7_CONCAT_LENGTH)
+    # UCS-2 counts UTF-16 code units (characters outside of the BMP take 2)
+    length = len(body.encode('utf-16-le')) // 2
+    return 'ucs2', 1 if length <= UCS2_SINGLE_LENGTH else math.ceil(length / UCS2_CONCAT_LENGTH)
+
+
+@functools.lru_cache(maxsize=8)
+def parse_price_table(raw_price_table):
+    """ Parse the ``sms_africastalking.price_table`` parameter: a JSON object of the
+    price of one segment per country prefix, e.g. {"254": 0.8, "256": 25}. An invalid
+    table is empty, and the prices that are not numbers are ignored. """
+    try:
+        price_table = json.loads(raw_price_table or '{}')
+    except ValueError:
+        price_table = None
+    if not isinstance(price_table, dict):
+        _logger.warning("Africastalking SMS: invalid price table %r", raw_price_table)
+        return {}
+    prices = {}
+    for prefix, price in price_table.items():
+        if isinstance(price, (int, float)) and not isinstance(price, bool):
+            prices[str(prefix)] = float(price)
+        else:
+            _logger.warning("Africastalking SMS: invalid price %r of prefix %s in the price table, ignored", price, prefix)
+    return prices
+
+
+class SegmentCostEstimator:
+    """ Accumulates the segments and estimated cost of (body, number) columns.
+
+    Identical bodies are classified once and numbers are only reduced to
+    their country prefix, so that campaigns can be fed in batches of
+    rendered bodies without keeping them around.
+    """
+
+    def __init__(self, price_table):
+        self.price_table = price_table
+        self.sms_count = 0
+        self.segment_count = 0
+        self.cost = 0.0
+        self.unpriced_segment_count = 0
+        self.encodings = Counter()
+
+    def add_batch(self, bodies, numbers):
+        segments_by_body = {body: count_segments(body) for body in set(bodies)}
+        segments_by_prefix = Counter()
+        for body, number in zip(bodies, numbers):
+            encoding, segments = segments_by_body[body]
+            self.encodings[encoding] += 1
+            segments_by_prefix[get_country_prefix(number)] += segments
+        self.sms_count += len(bodies)
+        for prefix, segments in segments_by_prefix.items():
+            self.segment_count += segments
+            price = self.price_table.get(prefix)
+            if price is None:
+                self.unpriced_segment_count += segments
+            else:
+                self.cost += segments * price
+        return [segments_by_body[body][1] for body in bodies]
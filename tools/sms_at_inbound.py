@@ -0,0 +1,56 @@
+import threading
+import time
+from collections import OrderedDict
+
+AT_PARTNER_CACHE_MAX_SIZE = 100000
+AT_OPT_OUT_KEYWORDS = 'STOP,STOPALL,UNSUBSCRIBE,CANCEL,END,QUIT'
+
+
+def parse_opt_out_keywords(raw_keywords):
+    """ Parse the ``sms_africastalking.inbound.opt_out_keywords`` parameter (comma separated) """
+    return frozenset(keyword.strip().upper() for keyword in (raw_keywords or '').split(',') if keyword.strip())
+
+
+def is_opt_out(text, keywords):
+    """ Whether the first word of an inbound message is an opt-out keyword """
+    words = (text or '').split(maxsplit=1)
+    return bool(words) and words[0].strip('.!').upper() in keywords
+
+
+class PartnerPhoneCache:
+    """ Bounded process-level index of E.164 number -> partner id (or False), per database.
+
+    Entries expire after ``ttl`` seconds so that new or updated partners are
+    eventually resolved; the oldest entries are dropped first once
+    ``max_size`` is reached.
+    """
+
+    def __init__(self, max_size=AT_PARTNER_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, dbname, numbers, ttl):
+        """ :return: a tuple (dict {number: partner id or False} of the cached numbers, list of missing numbers) """
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for number in numbers:
+                entry = self._entries.get((dbname, number))
+                if entry is not None and now - entry[1] < ttl:
+                    found[number] = entry[0]
+                else:
+                    missing.append(number)
+        return found, missing
+
+    def set_many(self, dbname, partner_id_by_number):
+        now = time.monotonic()
+        with self._lock:
+            for number, partner_id in partner_id_by_number.items():
+                self._entries[dbname, number] = (partner_id, now)
+                self._entries.move_to_end((dbname, number))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+partner_phone_cache = PartnerPhoneCache()
@@ -0,0 +1,35 @@
+import functools
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Priority lanes of the sms queue, in the order they are dispatched
+AT_PRIORITY_LANES = [
+    ('otp', 'OTP'),
+    ('transactional', 'Transactional'),
+    ('bulk', 'Bulk'),
+]
+AT_LANE_CAPACITIES = 'otp:1000,transactional:4000'
+
+
+@functools.lru_cache(maxsize=8)
+def parse_lane_capacities(raw_capacities):
+    """ Parse the ``sms_africastalking.lanes.capacity`` parameter, e.g. 'otp:1000,transactional:4000':
+    the number of sms of each lane sent at most per queue run. Lanes without capacity
+    (bulk by default) get what the previous lanes left.
+
+    :return: a dict {lane: capacity}
+    """
+    lanes = dict(AT_PRIORITY_LANES)
+    capacities = {}
+    for item in (raw_capacities or '').split(','):
+        lane, _sep, capacity = item.partition(':')
+        try:
+            if lane.strip() in lanes:
+                capacities[lane.strip()] = int(capacity)
+                continue
+        except ValueError:
+            pass
+        if item.strip():
+            _logger.warning("Africastalking SMS: invalid lane capacity %r", item)
+    return capacities
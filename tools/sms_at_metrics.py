@@ -0,0 +1,244 @@
+import fcntl
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+
+from odoo.tools import config
+
+_logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histograms
+AT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Upper bounds (seconds) of the histograms of the time spent in the queue
+AT_QUEUE_LATENCY_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0, 14400.0)
+# Delay between two dumps of the metrics of a worker
+AT_METRICS_FLUSH_INTERVAL = 5.0
+
+AT_METRICS_HELP = {
+    'sms_at_send_request_duration_seconds': ('histogram', "Duration of the Africastalking send requests"),
+    'sms_at_messages_total': ('counter', "Messages handled by the Africastalking send path, per resulting state"),
+    'sms_at_failures_total': ('counter', "Messages that failed to be sent, per failure type"),
+    'sms_at_cost_total': ('counter', "Cost of the sent messages as reported by Africastalking, per currency"),
+    'sms_at_callbacks_total': ('counter', "Status callbacks received"),
+    'sms_at_callback_duration_seconds': ('histogram', "Processing time of the status callbacks"),
+    'sms_at_queue_latency_seconds': ('histogram', "Time from the creation of the messages to their acceptance, per priority lane"),
+    'sms_at_queue_depth': ('gauge', "Messages waiting in the queue, per priority lane"),
+    'sms_at_queue_oldest_seconds': ('gauge', "Age of the oldest message waiting in the queue, per priority lane"),
+    'sms_at_batch_size': ('gauge', "Last adaptive send batch size, per account"),
+    'sms_at_batch_size_reason': ('gauge', "Why the last adaptive send batch size was picked (1 for the current reason)"),
+    'sms_at_batch_seconds_per_sms': ('gauge', "Smoothed sending time per message of the adaptive batches, per account"),
+    'sms_at_batch_error_rate': ('gauge', "Smoothed error rate of the adaptive batches, per account"),
+}
+AT_METRICS_BUCKETS = {
+    'sms_at_queue_latency_seconds': AT_QUEUE_LATENCY_BUCKETS,
+}
+
+
+class MetricsRegistry:
+    """ In-process counters, histograms and gauges of one database.
+
+    As Odoo runs several worker processes, each process regularly dumps its own
+    metrics to a file (one per host and pid) in the data directory; a scrape
+    merges the files of all the processes. Files of dead processes of the local
+    host are folded into an archive file so that counters never go backward (the
+    liveness of the processes of other hosts sharing the data directory cannot
+    be checked, their own scrapes archive them). Gauges are process state (e.g.
+    of the cron worker): the most recently set value wins.
+    """
+
+    def __init__(self, dbname):
+        self.dbname = dbname
+        self.directory = os.path.join(config['data_dir'], 'sms_africastalking_metrics', dbname)
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+
+    # ------------------------------------------------------------
+    # RECORDING
+    # ------------------------------------------------------------
+
+    def inc(self, name, labels=None, value=1.0):
+        with self._lock:
+            self._counters[self._key(name, labels)] += value
+        self._maybe_flush()
+
+    def observe(self, name, value, labels=None):
+        buckets = AT_METRICS_BUCKETS.get(name, AT_LATENCY_BUCKETS)
+        with self._lock:
+            histogram = self._histograms.setdefault(self._key(name, labels), [0] * len(buckets) + [0, 0.0])
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += 1  # count
+            histogram[-1] += value  # sum
+        self._maybe_flush()
+
+    def set_gauge(self, name, value, labels=None):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = [value, time.time()]
+        self._maybe_flush()
+
+    @staticmethod
+    def _key(name, labels):
+        return json.dumps([name, sorted((labels or {}).items())])
+
+    # ------------------------------------------------------------
+    # MULTI-PROCESS
+    # ------------------------------------------------------------
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._last_flush >= AT_METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._last_flush = time.monotonic()
+            snapshot = {'counters': dict(self._counters), 'histograms': dict(self._histograms), 'gauges': dict(self._gauges)}
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f'{_get_hostname()}-{os.getpid()}.json')
+            with open(path + '.tmp', 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            _logger.warning("Africastalking SMS: could not write the metrics to %s", self.directory, exc_info=True)
+
+    def collect(self):
+        """ Merge the metrics of all the processes sharing the data directory.
+
+        :return: a dict {'counters': {key: value}, 'histograms': {key: [...]}, 'gauges': {key: [value, set at]}}
+        """
+        self.flush()
+        merged = {'counters': defaultdict(float), 'histograms': {}, 'gauges': {}}
+        os.makedirs(self.directory, exist_ok=True)
+        hostname = _get_hostname()
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            archive_path = os.path.join(self.directory, 'archive.json')
+            archive = self._load(archive_path) or {'counters': {}, 'histograms': {}}
+            archive.setdefault('gauges', {})
+            archive_changed = False
+            for filename in os.listdir(self.directory):
+                if not filename.endswith('.json') or filename == 'archive.json':
+                    continue
+                # files named {hostname}-{pid}.json, or {pid}.json before the hostname was added
+                file_hostname, _sep, pid = filename[:-5].rpartition('-')
+                if not pid.isdigit():
+                    continue
+                path = os.path.join(self.directory, filename)
+                snapshot = self._load(path)
+                if snapshot is None:
+                    continue
+                if (file_hostname or hostname) != hostname or self._is_alive(int(pid)):
+                    self._merge(merged, snapshot)
+                else:
+                    self._merge(archive, snapshot)
+                    archive_changed = True
+                    os.unlink(path)
+            if archive_changed:
+                with open(archive_path + '.tmp', 'w') as f:
+                    json.dump(archive, f)
+                os.replace(archive_path + '.tmp', archive_path)
+        self._merge(merged, archive)
+        return merged
+
+    @staticmethod
+    def _load(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _is_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    @staticmethod
+    def _merge(target, snapshot):
+        for key, value in snapshot.get('counters', {}).items():
+            target['counters'][key] = target['counters'].get(key, 0.0) + value
+        for key, values in snapshot.get('histograms', {}).items():
+            if key in target['histograms']:
+                target['histograms'][key] = [a + b for a, b in zip(target['histograms'][key], values)]
+            else:
+                target['histograms'][key] = list(values)
+        for key, (value, set_at) in snapshot.get('gauges', {}).items():
+            if key not in target['gauges'] or target['gauges'][key][1] < set_at:
+                target['gauges'][key] = [value, set_at]
+
+    # ------------------------------------------------------------
+    # EXPOSITION
+    # ------------------------------------------------------------
+
+    def render(self, gauges=()):
+        """ Metrics of all processes in the Prometheus text format (0.0.4)
+
+        :param gauges: values computed at scrape time, as tuples (name, labels, value)
+        """
+        merged = self.collect()
+        series_by_name = defaultdict(list)
+        for name, labels, value in gauges:
+            series_by_name[name].append(([list(label) for label in sorted(labels.items())], value))
+        for key, value in merged['counters'].items():
+            name, labels = json.loads(key)
+            series_by_name[name].append((labels, value))
+        for key, (value, _set_at) in merged['gauges'].items():
+            name, labels = json.loads(key)
+            series_by_name[name].append((labels, value))
+        for key, values in merged['histograms'].items():
+            name, labels = json.loads(key)
+            series_by_name[name].append((labels, values))
+
+        lines = []
+        for name in sorted(series_by_name):
+            metric_type, help_text = AT_METRICS_HELP.get(name, ('untyped', name))
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}']
+            for labels, value in sorted(series_by_name[name]):
+                if metric_type != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+                    continue
+                for bound, count in zip(AT_METRICS_BUCKETS.get(name, AT_LATENCY_BUCKETS), value):
+                    lines.append(f'{name}_bucket{_format_labels(labels + [["le", str(bound)]])} {count}')
+                lines.append(f'{name}_bucket{_format_labels(labels + [["le", "+Inf"]])} {value[-2]}')
+                lines.append(f'{name}_count{_format_labels(labels)} {value[-2]}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+def _get_hostname():
+    return socket.gethostname()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_metrics(dbname):
+    """ Return the metrics registry of the database ``dbname`` for this process """
+    with _registries_lock:
+        if dbname not in _registries:
+            _registries[dbname] = MetricsRegistry(dbname)
+        return _registries[dbname]
@@ -0,0 +1,30 @@
+class PrefixTrie:
+    """ Digit trie of number prefixes, for longest-prefix lookups.
+
+    Lookups walk at most one node per digit of the number, whatever the
+    number of prefixes, and fall back to the value of the longest prefix
+    found on the way.
+    """
+    __slots__ = ('_root',)
+
+    def __init__(self, items=()):
+        self._root = {}
+        for prefix, value in items:
+            self.insert(prefix, value)
+
+    def insert(self, prefix, value):
+        node = self._root
+        for digit in prefix:
+            node = node.setdefault(digit, {})
+        node[None] = value
+
+    def lookup(self, number, default=None):
+        """ Value of the longest prefix of ``number`` (E.164, the leading + is ignored) """
+        value = self._root.get(None, default)
+        node = self._root
+        for digit in number.lstrip('+'):
+            node = node.get(digit)
+            if node is None:
+                break
+            value = node.get(None, value)
+        return value
@@ -0,0 +1,174 @@
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """ Thread-safe token bucket: ``rate`` tokens per second, bursts up to ``capacity``. """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self._tokens = self.capacity
+        self._timestamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def configure(self, rate, capacity=None):
+        with self._lock:
+            self.rate = float(rate)
+            self.capacity = float(capacity or max(rate, 1))
+            self._tokens = min(self._tokens, self.capacity)
+
+    def reserve(self, tokens=1):
+        """ Consume ``tokens``, possibly going into debt: a request of more tokens than
+        the capacity (e.g. a multi-recipient request) waits until all of them are paid for.
+
+        :return: the delay in seconds to wait before the tokens may be used
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._timestamp) * self.rate)
+            self._timestamp = now
+            self._tokens -= tokens
+            return max(-self._tokens / self.rate, 0.0)
+
+    def get_delay(self):
+        """ Delay in seconds a request would wait right now (the current debt), without consuming anything """
+        with self._lock:
+            tokens = min(self.capacity, self._tokens + (time.monotonic() - self._timestamp) * self.rate)
+            return max(-tokens / self.rate, 0.0)
+
+    def acquire(self, tokens=1):
+        """ Block until ``tokens`` are available and consume them. """
+        delay = self.reserve(tokens)
+        if delay:
+            time.sleep(delay)
+
+
+class TokenBucketRegistry:
+    """ Process-level token buckets, one per Africastalking account. """
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, rate):
+        """ Return the bucket of ``key`` limited to ``rate`` per second, or None if ``rate`` is not positive. """
+        if not rate or rate <= 0:
+            return None
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate)
+            elif bucket.rate != rate:
+                bucket.configure(rate)
+            return bucket
+
+    def get_max_delay(self):
+        """ Longest delay a request would wait right now on one of the buckets """
+        with self._lock:
+            buckets = list(self._buckets.values())
+        return max((bucket.get_delay() for bucket in buckets), default=0.0)
+
+
+rate_limiters = TokenBucketRegistry()
+
+
+class CircuitBreaker:
+    """ Per-account circuit breaker of the send path.
+
+    It opens on an insufficient balance, or after ``failure_threshold``
+    consecutive failed requests (gateway errors). While open, nothing is sent;
+    once ``cooldown`` seconds have passed, the caller probes the account (see
+    ``SmsApiAfricastalking._at_is_sending_allowed``) and closes it.
+    """
+    REASON_BALANCE = 'balance'
+    REASON_GATEWAY = 'gateway'
+
+    def __init__(self, failure_threshold=5):
+        self.failure_threshold = failure_threshold
+        self.opened_at = None
+        self.reason = None
+        self.consecutive_failures = 0
+        self.balance = None
+        self.balance_checked_at = None
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def trip(self, reason):
+        with self._lock:
+            if self.opened_at is None:
+                self.opened_at = time.monotonic()
+            self.reason = reason
+
+    def close(self):
+        with self._lock:
+            self.opened_at = None
+            self.reason = None
+            self.consecutive_failures = 0
+
+    def postpone(self):
+        """ Probe failed: restart the cooldown """
+        with self._lock:
+            if self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+    def cooldown_elapsed(self, cooldown):
+        opened_at = self.opened_at
+        return opened_at is None or time.monotonic() - opened_at >= cooldown
+
+    def cooldown_remaining(self, cooldown):
+        """ Seconds left before the cooldown is over, 0 when closed """
+        opened_at = self.opened_at
+        return 0.0 if opened_at is None else max(cooldown - (time.monotonic() - opened_at), 0.0)
+
+    def record_success(self):
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            trip = self.consecutive_failures >= self.failure_threshold
+        if trip:
+            self.trip(self.REASON_GATEWAY)
+
+    def get_cached_balance(self, ttl):
+        """ :return: the balance if checked less than ``ttl`` seconds ago, else None """
+        if self.balance_checked_at is not None and time.monotonic() - self.balance_checked_at < ttl:
+            return self.balance
+        return None
+
+    def set_balance(self, balance):
+        self.balance = balance
+        self.balance_checked_at = time.monotonic()
+
+
+class CircuitBreakerRegistry:
+    """ Process-level circuit breakers, one per Africastalking account. """
+
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, failure_threshold=5):
+        with self._lock:
+            if key not in self._breakers:
+                self._breakers[key] = CircuitBreaker(failure_threshold)
+            breaker = self._breakers[key]
+            breaker.failure_threshold = failure_threshold
+            return breaker
+
+
+circuit_breakers = CircuitBreakerRegistry()
+
+
+def compute_backoff(attempt, base_delay, max_delay):
+    """ Jittered exponential backoff: delay in seconds before the retry number ``attempt`` (from 1).
+
+    The delay doubles at each attempt (capped to ``max_delay``) and is drawn
+    in its upper half, so that the retries of successive batches are spread out.
+    """
+    delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
@@ -0,0 +1,118 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+_logger = logging.getLogger(__name__)
+_trace_logger = logging.getLogger(__name__ + '.spans')
+
+_current = threading.local()
+_file_lock = threading.Lock()
+
+
+class Trace:
+    """ Spans of one sampled operation (a send, a callback), as events of the
+    Chrome Trace Event Format, so that exported files can be loaded in
+    chrome://tracing or Perfetto. Spans may be recorded from other threads. """
+    __slots__ = ('name', 'events')
+
+    def __init__(self, name):
+        self.name = name
+        self.events = []
+
+    @contextmanager
+    def span(self, name, **args):
+        timestamp = time.time_ns() // 1000
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            # list.append is atomic: no lock needed for the spans of the send threads
+            self.events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': timestamp,
+                'dur': (time.perf_counter_ns() - start) // 1000,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': args,
+            })
+
+    def log(self, name, **args):
+        """ Structured instant record, e.g. a summary of a provider response """
+        self.events.append({
+            'name': name,
+            'ph': 'i',
+            's': 't',
+            'ts': time.time_ns() // 1000,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args,
+        })
+
+
+def get_trace_settings(env):
+    """ :return: a tuple (sample rate, export file path or None) from the system parameters """
+    ICP = env['ir.config_parameter'].sudo()
+    return float(ICP.get_param('sms_africastalking.trace.sample_rate', 0)), ICP.get_param('sms_africastalking.trace.file') or None
+
+
+@contextmanager
+def start_trace(env, name, **args):
+    """ Root span of an operation, sampled at ``sms_africastalking.trace.sample_rate``.
+    Nested calls are plain spans of the current trace.
+
+    :return: the trace, or None when not sampled
+    """
+    trace = getattr(_current, 'trace', None)
+    if trace is not None:
+        # nested in a root span: same sampling decision as the root
+        with span(name, trace or None, **args):
+            yield trace or None
+        return
+    sample_rate, path = get_trace_settings(env)
+    if not sample_rate or random.random() >= sample_rate:
+        _current.trace = False
+        try:
+            yield None
+        finally:
+            _current.trace = None
+        return
+    trace = _current.trace = Trace(name)
+    try:
+        with trace.span(name, **args):
+            yield trace
+    finally:
+        _current.trace = None
+        _export(trace, path)
+
+
+def current_trace():
+    """ Sampled trace of the current thread, if any """
+    return getattr(_current, 'trace', None) or None
+
+
+def span(name, trace=None, **args):
+    """ Span of ``trace`` (default: the current trace of the thread), a no-op when not sampled """
+    trace = trace or current_trace()
+    if trace is None:
+        return nullcontext()
+    return trace.span(name, **args)
+
+
+def _export(trace, path):
+    if not path:
+        _trace_logger.info("%s", json.dumps(trace.events))
+        return
+    # JSON Array Format of the trace events: the closing bracket is optional
+    lines = ''.join(json.dumps(event) + ',\n' for event in trace.events)
+    try:
+        with _file_lock, open(path, 'a') as f:
+            if not f.tell():
+                f.write('[\n')
+            f.write(lines)
+    except OSError:
+        _logger.warning("Africastalking SMS: could not export the trace to %s", path, exc_info=True)
@@ -18,6 +18,7 @@ class SmsAfricastalkingAccountManage(models.TransientModel):
     sms_at_username = fields.Char(related='company_id.sms_at_username', readonly=False)
     sms_at_shortcode = fields.Char(related='company_id.sms_at_shortcode', readonly=False)
     sms_at_api_key = fields.Char(related='company_id.sms_at_api_key', readonly=False)
+    sms_at_enqueue = fields.Boolean(related='company_id.sms_at_enqueue', readonly=False)
     test_number = fields.Char("Test Number")
 
     def action_send_test(self):